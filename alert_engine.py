@@ -0,0 +1,344 @@
+"""
+Motor de alertas por vencimiento
+Calcula el momento de disparo de cada alerta activa, las mantiene en un min-heap
+y duerme hasta el vencimiento más próximo en lugar de revisar todas las alertas
+periódicamente.
+"""
+
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# Margen de tolerancia: una alerta se dispara 30s antes de alcanzar el límite
+MARGEN_TOLERANCIA = 30
+
+# Cada cuántos segundos se leen de la BD las alertas/tareas modificadas por otros procesos
+ALERT_ENGINE_POLL_SECONDS = float(os.getenv('ALERT_ENGINE_POLL_SECONDS', '15'))
+
+# Espera antes de reintentar una alerta vencida cuyo envío falló
+ALERT_ENGINE_RETRY_SECONDS = float(os.getenv('ALERT_ENGINE_RETRY_SECONDS', '60'))
+
+
+def parse_timestamp(value):
+    """
+    Convierte un timestamp ISO de la BD a segundos epoch. Sin zona horaria se asume
+    hora local del servidor, que es lo que guarda parse_date_flexible
+    """
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return dt.timestamp()
+
+
+def alert_limit_seconds(alerta):
+    """Tiempo máximo configurado en la alerta, en segundos"""
+    return ((alerta.get('aviso_dias') or 0) * 86400
+            + (alerta.get('aviso_horas') or 0) * 3600
+            + (alerta.get('aviso_minutos') or 0) * 60)
+
+
+def alert_elapsed_seconds(alerta, now=None):
+    """
+    Tiempo que cuenta para la alerta en el instante now:
+    - sin_actualizar: segundos desde la última actualización de la tarea
+    - tiempo_total: segundos acumulados en progreso más la sesión abierta
+    """
+    now = time.time() if now is None else now
+
+    if alerta.get('tipo_alerta', 'sin_actualizar') == 'sin_actualizar':
+        last_update = parse_timestamp(alerta.get('last_update'))
+        return now - last_update if last_update is not None else 0
+
+    elapsed = alerta.get('accumulated_seconds') or 0
+    session_start = parse_timestamp(alerta.get('open_session_start'))
+    if session_start is not None:
+        elapsed += now - session_start
+    return elapsed
+
+
+def compute_alert_deadline(alerta):
+    """
+    Calcula el momento (epoch) en que la alerta debe dispararse.
+
+    Returns:
+        float o None si la alerta no puede vencer en su estado actual
+        (desactivada, sin límite, sin email o tarea fuera de "en_progreso")
+    """
+    if not alerta.get('aviso_activado') or not alerta.get('email_aviso'):
+        return None
+    if alerta.get('status') != 'en_progreso':
+        return None
+
+    limite = alert_limit_seconds(alerta)
+    if limite <= 0:
+        return None
+
+    if alerta.get('tipo_alerta', 'sin_actualizar') == 'sin_actualizar':
+        last_update = parse_timestamp(alerta.get('last_update'))
+        if last_update is None:
+            return None
+        return last_update + limite - MARGEN_TOLERANCIA
+
+    # tiempo_total: solo corre el reloj mientras hay una sesión abierta
+    session_start = parse_timestamp(alerta.get('open_session_start'))
+    if session_start is None:
+        return None
+    return session_start + limite - (alerta.get('accumulated_seconds') or 0) - MARGEN_TOLERANCIA
+
+
+class AlertDeadlineEngine:
+    """
+    Planificador de alertas basado en vencimientos.
+
+    Cada alerta activa ocupa una entrada (task_id, vencimiento) en un min-heap.
+    El hilo del motor duerme hasta el vencimiento más próximo (o hasta la
+    siguiente lectura de cambios) y solo recalcula las alertas afectadas.
+
+    Args:
+        fetch_alerts: función(task_ids=None, changed_since=None) que devuelve las
+                      filas de alerta con los datos de tiempo de su tarea
+        fire: función(task_id) llamada al vencer una alerta; devuelve el nuevo
+              vencimiento (epoch) si la alerta debe seguir programada, o None
+    """
+
+    def __init__(self, fetch_alerts, fire, poll_seconds=ALERT_ENGINE_POLL_SECONDS,
+                 retry_seconds=ALERT_ENGINE_RETRY_SECONDS):
+        self.fetch_alerts = fetch_alerts
+        self.fire = fire
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._changes_mark = None
+        self._next_poll = 0.0
+        self._stats = {'fired': 0, 'reloads': 0, 'refreshes': 0, 'last_reload_seconds': None}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _schedule_locked(self, task_id, deadline):
+        if deadline is None:
+            self._deadlines.pop(task_id, None)
+            return
+        self._deadlines[task_id] = deadline
+        heapq.heappush(self._heap, (deadline, task_id))
+
+    def _apply_rows_locked(self, rows):
+        for row in rows:
+            self._schedule_locked(row['task_id'], compute_alert_deadline(row))
+
+        # Compactar el heap si acumula demasiadas entradas obsoletas
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(deadline, task_id) for task_id, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    @staticmethod
+    def _db_now(offset_seconds=0):
+        """Marca temporal en el formato de CURRENT_TIMESTAMP de SQLite (UTC)"""
+        return (datetime.utcnow() + timedelta(seconds=offset_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def reload(self):
+        """Recalcula desde cero los vencimientos de todas las alertas activas"""
+        start = time.monotonic()
+        # Solape de 2s: CURRENT_TIMESTAMP tiene resolución de segundos
+        mark = self._db_now(-2)
+        rows = self.fetch_alerts()
+
+        with self._cond:
+            self._heap = []
+            self._deadlines = {}
+            self._apply_rows_locked(rows)
+            self._changes_mark = mark
+            self._stats['reloads'] += 1
+            self._stats['last_reload_seconds'] = round(time.monotonic() - start, 3)
+            self._cond.notify()
+
+        print(f"[ALERT ENGINE] {len(self._deadlines)} alertas programadas "
+              f"({self._stats['last_reload_seconds']}s)")
+
+    def refresh(self, task_ids):
+        """Recalcula el vencimiento de las alertas de las tareas indicadas"""
+        if not self.running:
+            return
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+
+        rows = self.fetch_alerts(task_ids=task_ids)
+        with self._cond:
+            encontradas = {row['task_id'] for row in rows}
+            for task_id in task_ids:
+                if task_id not in encontradas:
+                    self._schedule_locked(task_id, None)
+            self._apply_rows_locked(rows)
+            self._stats['refreshes'] += 1
+            self._cond.notify()
+
+    def _pull_changes(self):
+        """Aplica las alertas y tareas modificadas desde la última lectura (incluye otros procesos)"""
+        mark = self._db_now(-2)
+        rows = self.fetch_alerts(changed_since=self._changes_mark)
+        with self._cond:
+            self._apply_rows_locked(rows)
+            self._changes_mark = mark
+
+    def _pop_due_locked(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, task_id = heapq.heappop(self._heap)
+            # Ignorar entradas obsoletas (la alerta se reprogramó o se eliminó)
+            if self._deadlines.get(task_id) == deadline:
+                del self._deadlines[task_id]
+                due.append(task_id)
+        return due
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                now = time.time()
+                if now >= self._next_poll:
+                    self._pull_changes()
+                    self._next_poll = now + self.poll_seconds
+
+                with self._cond:
+                    due = self._pop_due_locked(time.time())
+                    if not due:
+                        next_deadline = self._heap[0][0] if self._heap else float('inf')
+                        wait = min(next_deadline, self._next_poll) - time.time()
+                        if wait > 0:
+                            self._cond.wait(wait)
+                        continue
+
+                for task_id in due:
+                    if self._stop.is_set():
+                        break
+                    try:
+                        new_deadline = self.fire(task_id)
+                    except Exception as e:
+                        print(f"[ALERT ENGINE] Error al disparar alerta de {task_id}: {str(e)}")
+                        new_deadline = time.time() + self.retry_seconds
+
+                    self._stats['fired'] += 1
+                    if new_deadline is not None and new_deadline <= time.time():
+                        # Vencida pero no enviada (ej: fallo de email): reintentar más tarde
+                        new_deadline = time.time() + self.retry_seconds
+                    with self._cond:
+                        self._schedule_locked(task_id, new_deadline)
+
+            except Exception as e:
+                print(f"[ALERT ENGINE] Error en el bucle del motor de alertas: {str(e)}")
+                time.sleep(self.poll_seconds)
+
+    def start(self):
+        """Carga todas las alertas y arranca el hilo del motor"""
+        if self.running:
+            return
+        self._stop.clear()
+        self.reload()
+        self._next_poll = time.time() + self.poll_seconds
+        self._thread = threading.Thread(target=self._run, name='alert-engine', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Detiene el hilo del motor y descarta los vencimientos programados"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        with self._cond:
+            self._heap = []
+            self._deadlines = {}
+
+    def get_stats(self):
+        """Devuelve el número de alertas programadas, el próximo vencimiento y contadores"""
+        with self._cond:
+            next_deadline = min(self._deadlines.values()) if self._deadlines else None
+            return dict(
+                self._stats,
+                running=self.running,
+                scheduled=len(self._deadlines),
+                next_deadline=datetime.fromtimestamp(next_deadline, timezone.utc).isoformat() if next_deadline else None
+            )
+
+
+if __name__ == '__main__':
+    # Uso: python alert_engine.py bench [--alerts N] [--iterations N]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Utilidades del motor de alertas')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='Mide reload(), refresh() y el coste de un despertar sin cambios con N alertas activas (en una BD temporal)'
+    )
+    bench_parser.add_argument('--alerts', type=int, default=50000)
+    bench_parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        import random
+        import db
+
+        with db._bench_database(db.ConnectionPool, tasks=0):
+            # Tareas en progreso (con su sesión abierta), mitad con alerta sin_actualizar y
+            # mitad tiempo_total; los límites (1-30 días) quedan lejos para que ninguna alerta venza durante la prueba
+            start = time.perf_counter()
+            ahora = datetime.now().isoformat()
+            task_ids = [f'alert{i}' for i in range(args.alerts)]
+            db.save_tasks_bulk(
+                [{'id': task_id, 'name': f'Tarea {task_id}', 'list_id': 'bench-list',
+                  'status': 'en_progreso', 'date_updated': ahora} for task_id in task_ids],
+                [{'task_id': task_id, 'old_status': 'pendiente', 'new_status': 'en_progreso', 'changed_at': ahora}
+                 for task_id in task_ids]
+            )
+            with db.get_db() as conn:
+                conn.executemany("""
+                    INSERT INTO task_alerts (task_id, aviso_activado, email_aviso, aviso_dias, tipo_alerta)
+                    VALUES (?, 1, 'bench@example.com', ?, ?)
+                """, [(task_id, 1 + i % 30, 'sin_actualizar' if i % 2 == 0 else 'tiempo_total')
+                      for i, task_id in enumerate(task_ids)])
+                conn.commit()
+            print(f"[BENCH] {args.alerts:,} alertas creadas en {time.perf_counter() - start:.1f}s")
+
+            engine = AlertDeadlineEngine(fetch_alerts=db.get_alert_timings, fire=lambda task_id: None,
+                                         poll_seconds=3600)
+            engine.start()
+            try:
+                start = time.perf_counter()
+                engine.reload()
+                print(f"[BENCH] reload(): {(time.perf_counter() - start) * 1000:.1f} ms "
+                      f"({engine.get_stats()['scheduled']:,} alertas programadas)")
+
+                rng = random.Random(0)
+                for batch in (1, 100):
+                    start = time.perf_counter()
+                    for _ in range(args.iterations):
+                        engine.refresh(rng.sample(task_ids, batch))
+                    elapsed = (time.perf_counter() - start) / args.iterations
+                    print(f"[BENCH] refresh() de {batch} tareas: {elapsed * 1000:.2f} ms")
+
+                # Despertar sin cambios ni vencimientos: lectura de cambios y consulta del heap
+                # (tras salir de la ventana de solape de 2s de los cambios anteriores)
+                time.sleep(3)
+                engine._pull_changes()
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    engine._pull_changes()
+                    with engine._cond:
+                        engine._pop_due_locked(time.time())
+                elapsed = (time.perf_counter() - start) / args.iterations
+                print(f"[BENCH] Despertar sin cambios: {elapsed * 1000:.2f} ms")
+            finally:
+                engine.stop()
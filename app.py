@@ -2,19 +2,32 @@ import sys
 print(f"[STARTUP] Python version: {sys.version}", flush=True)
 print(f"[STARTUP] Iniciando aplicación...", flush=True)
 
-from flask import Flask, render_template, jsonify, request, redirect, session, url_for
+from flask import Flask, render_template, jsonify, request, redirect, session, url_for, has_request_context, Response
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import contextlib
+import hashlib
+import io
 import json
 import os
-import re
 from dotenv import load_dotenv
 import time
+import threading
 import smtplib
+import sqlite3
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from urllib.parse import quote
+import click
 import db  # Importar módulo de base de datos
+from clickup_api import clickup_get, clickup_get_pages, run_parallel, SyncTimings, rate_limit_key
+from alert_engine import AlertDeadlineEngine, alert_elapsed_seconds, compute_alert_deadline
+from email_outbox import OutboxSender, post_to_brevo
+from leader_lease import LeaderLease
+from webhook_parsing import parse_webhook_body, WebhookParseError
+from webhook_archive import WebhookRetention, WEBHOOK_RETENTION_INTERVAL_HOURS
+from live_updates import TimeTrackingBroadcaster, ChangeSequence, prune_changes, LIVE_PRUNE_INTERVAL_MINUTES
+from cache import create_cache
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 import atexit
@@ -62,6 +75,37 @@ SMTP_EMAIL = os.getenv('SMTP_EMAIL', '')  # Email del remitente
 # Configuración de webhook
 WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
 
+# Modo asíncrono de webhooks: se guarda el payload, se responde 202 y un pool de workers lo procesa
+WEBHOOK_ASYNC_MODE = os.getenv('WEBHOOK_ASYNC_MODE', 'false').lower() in ('1', 'true', 'yes')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '2'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '5'))
+WEBHOOK_CLAIM_TIMEOUT = int(os.getenv('WEBHOOK_CLAIM_TIMEOUT', '300'))  # Segundos antes de reintentar un webhook reclamado
+WEBHOOK_POLL_INTERVAL = 1.0
+
+# Coalescencia en la cola asíncrona: los eventos de una tarea esperan esta ventana (ms) y los
+# que llegan seguidos se aplican de una vez (0 = desactivada)
+WEBHOOK_COALESCE_WINDOW_MS = int(os.getenv('WEBHOOK_COALESCE_WINDOW_MS', '500'))
+WEBHOOK_COALESCE_MAX_EVENTS = int(os.getenv('WEBHOOK_COALESCE_MAX_EVENTS', '50'))
+
+# Idempotencia: claves de webhooks ya procesados que cada proceso recuerda en memoria
+# (delante del índice único de webhooks_log) y durante cuánto tiempo
+WEBHOOK_DEDUP_LRU_SIZE = int(os.getenv('WEBHOOK_DEDUP_LRU_SIZE', '10000'))
+WEBHOOK_DEDUP_LRU_TTL_SECONDS = int(os.getenv('WEBHOOK_DEDUP_LRU_TTL_SECONDS', '86400'))
+
+# /api/project/<type>/<id>/tasks: 'local' responde al momento desde la BD y refresca desde
+# ClickUp en segundo plano si los datos tienen más de PROJECT_TASKS_MAX_AGE_SECONDS;
+# 'live' consulta siempre ClickUp (también con ?source=live)
+PROJECT_TASKS_MODE = os.getenv('PROJECT_TASKS_MODE', 'local')
+PROJECT_TASKS_MAX_AGE_SECONDS = int(os.getenv('PROJECT_TASKS_MAX_AGE_SECONDS', '300'))
+
+# Jerarquía (espacios, carpetas y listas) servida desde la BD durante este tiempo tras
+# sincronizarla; los webhooks de espacios, carpetas y listas la invalidan antes
+HIERARCHY_CACHE_TTL_SECONDS = int(os.getenv('HIERARCHY_CACHE_TTL_SECONDS', '3600'))
+
+# Sincronización incremental: margen (ms) que se vuelve a pedir por debajo de la marca
+# para cubrir desfases de reloj y actualizaciones en curso
+SYNC_WATERMARK_OVERLAP_MS = int(os.getenv('SYNC_WATERMARK_OVERLAP_MS', '60000'))
+
 # Configuración de Google OAuth y Sheets
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
@@ -85,155 +129,172 @@ alertas_tareas = {}
 
 alertas_config = {}
 
-# Caché de tareas actualizado vía webhook
+# Caché de tareas actualizado vía webhook (LRU con TTL, compartida entre workers con CACHE_BACKEND=sqlite)
 # Estructura: {tarea_id: {datos_tarea, timestamp_actualizacion}}
-tareas_cache = {}
+tareas_cache = create_cache('tareas')
+
+# Claves de idempotencia de los webhooks ya procesados en este proceso (ver clave_idempotencia)
+webhooks_procesados = create_cache('webhook_dedup', backend='memory', max_entries=WEBHOOK_DEDUP_LRU_SIZE,
+                                   ttl_seconds=WEBHOOK_DEDUP_LRU_TTL_SECONDS)
+
+# Carpetas y listas de un espacio que ClickUp devolvió a cada usuario en su última consulta en
+# vivo (clave: <hash del token>:<space_id>). Desde la BD solo se sirve lo que ese usuario puede ver
+jerarquia_visible = create_cache('hierarchy_visible', ttl_seconds=HIERARCHY_CACHE_TTL_SECONDS)
 
 # ============================================================================
 # SCHEDULER DE BACKEND PARA VERIFICACIÓN AUTOMÁTICA DE ALERTAS
 # ============================================================================
 
-def verificar_alertas_automaticamente():
-    """
-    Función ejecutada por el scheduler de backend cada 5 minutos.
-    Verifica todas las alertas activas independientemente del frontend.
-    """
-    with app.app_context():
-        try:
-            print("\n" + "⏰"*40)
-            print("⏰ SCHEDULER BACKEND: Verificación automática de alertas")
-            print(f"⏰ Timestamp: {datetime.now().isoformat()}")
-            print("⏰"*40)
+# Cada cuánto se recargan todas las alertas desde la BD (red de seguridad del motor de alertas)
+ALERT_RECONCILE_MINUTES = int(os.getenv('ALERT_RECONCILE_MINUTES', '30'))
 
-            # Obtener todas las alertas activas
-            alertas_activas = db.get_all_active_alerts()
-            print(f"📋 [SCHEDULER] Alertas activas encontradas: {len(alertas_activas)}")
+# Elección de líder (motor de alertas, envío de emails, retención) y workers de la cola de
+# webhooks. Desactivar en los comandos de la CLI: BACKGROUND_JOBS_ENABLED=false flask --app app ...
+BACKGROUND_JOBS_ENABLED = os.getenv('BACKGROUND_JOBS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
 
-            if len(alertas_activas) == 0:
-                print("⏰ [SCHEDULER] No hay alertas activas. Esperando próxima ejecución...")
-                print("⏰"*40 + "\n")
-                return
 
-            alertas_enviadas = 0
+def disparar_alerta_vencida(tarea_id):
+    """
+    Llamada por el motor de alertas cuando vence una alerta.
+    Vuelve a comprobar la alerta con datos frescos y encola el email si corresponde.
 
-            for alerta in alertas_activas:
-                tarea_id = alerta['task_id']
-                tarea_nombre = alerta['task_name']
-                tipo_alerta = alerta.get('tipo_alerta', 'sin_actualizar')
+    Returns:
+        nuevo vencimiento (epoch) si la alerta sigue programada, o None
+    """
+    with app.app_context():
+        filas = db.get_alert_timings(task_ids=[tarea_id])
+        if not filas:
+            return None
+        alerta = filas[0]
+
+        # Recalcular: la tarea pudo cambiar desde que se programó
+        vencimiento = compute_alert_deadline(alerta)
+        if vencimiento is None or vencimiento > time.time():
+            return vencimiento
+
+        tipo_alerta = alerta.get('tipo_alerta', 'sin_actualizar')
+        tarea_nombre = alerta['task_name']
+        tiempo_calculado = alert_elapsed_seconds(alerta)
+        horas = int(tiempo_calculado // 3600)
+        minutos = int((tiempo_calculado % 3600) // 60)
+        if tipo_alerta == 'sin_actualizar':
+            tiempo_str = f"{horas} horas y {minutos} minutos sin actualizar"
+        else:
+            tiempo_str = f"{horas} horas y {minutos} minutos en progreso"
 
-                try:
-                    # Obtener tarea de BD
-                    tarea_bd = db.get_task(tarea_id)
-                    if not tarea_bd:
-                        continue
-
-                    # Calcular tiempo según el tipo de alerta
-                    tiempo_max_segundos = (alerta.get('aviso_dias', 0) * 86400) + (alerta['aviso_horas'] * 3600) + (alerta['aviso_minutos'] * 60)
-                    tiempo_calculado = 0
-                    tiempo_str = ""
-
-                    # Verificar que la tarea esté en progreso para ambos tipos de alerta
-                    if tarea_bd['status'] != 'en_progreso':
-                        continue
-
-                    if tipo_alerta == 'sin_actualizar':
-                        # Calcular tiempo desde la última actualización
-                        tiempo_data = db.calculate_time_since_last_update(tarea_id)
-                        tiempo_calculado = tiempo_data['seconds_since_update']
-
-                        horas = int(tiempo_calculado // 3600)
-                        minutos = int((tiempo_calculado % 3600) // 60)
-                        tiempo_str = f"{horas} horas y {minutos} minutos sin actualizar"
-
-                    else:  # tiempo_total
-
-                        tiempo_data = db.calculate_task_time_in_progress(tarea_id)
-                        tiempo_calculado = tiempo_data['total_seconds']
-
-                        # Sumar sesión actual si aplica
-                        if tiempo_data['is_currently_in_progress'] and tiempo_data['current_session_start']:
-                            try:
-                                session_start = datetime.fromisoformat(tiempo_data['current_session_start'])
-                                from datetime import timezone
-                                now = datetime.now(timezone.utc)
-                                tiempo_sesion = (now - session_start).total_seconds()
-                                tiempo_calculado += tiempo_sesion
-                            except:
-                                pass
-
-                        horas = int(tiempo_calculado // 3600)
-                        minutos = int((tiempo_calculado % 3600) // 60)
-                        tiempo_str = f"{horas} horas y {minutos} minutos en progreso"
-
-                    # Verificar si superó el límite (con margen de 30s)
-                    MARGEN_TOLERANCIA = 30
-                    if tiempo_calculado >= (tiempo_max_segundos - MARGEN_TOLERANCIA):
-                        print(f"🚨 [SCHEDULER] Alerta activada para tarea: {tarea_nombre} (tipo: {tipo_alerta})")
-
-                        proyecto_nombre = db.get_task_project_name(tarea_id)
-                        tarea_url = alerta['task_url']
-
-                        # Enviar email
-                        if enviar_email_alerta(alerta['email_aviso'], tarea_nombre, proyecto_nombre, tarea_url, tiempo_str, tipo_alerta):
-                            print(f"✅ [SCHEDULER] Email enviado para: {tarea_nombre}")
-                            db.deactivate_task_alert(tarea_id)
-                            alertas_enviadas += 1
-                        else:
-                            print(f"❌ [SCHEDULER] Error al enviar email para: {tarea_nombre}")
+        print(f"🚨 [ALERT ENGINE] Alerta activada para tarea: {tarea_nombre} (tipo: {tipo_alerta})")
 
-                except Exception as e:
-                    print(f"❌ [SCHEDULER] Error procesando {tarea_nombre}: {str(e)}")
+        # Fencing: un líder que perdió la concesión no debe encolar alertas
+        if not scheduler_lease.check():
+            print(f"[ALERT ENGINE] Concesión perdida, no se encola la alerta de {tarea_nombre}")
+            return None
 
-            print("⏰"*40)
-            print(f"⏰ SCHEDULER: Verificación completada - {alertas_enviadas} alertas enviadas")
-            print("⏰"*40 + "\n")
+        proyecto_nombre = db.get_task_project_name(tarea_id)
+        if encolar_email_alerta(tarea_id, alerta['email_aviso'], tarea_nombre, proyecto_nombre, alerta['task_url'],
+                                tiempo_str, tipo_alerta, activada_en=alerta.get('ultima_actualizacion')):
+            # La alerta se desactiva cuando el worker de envío confirma el email
+            print(f"✅ [ALERT ENGINE] Email encolado para: {tarea_nombre}")
+            return None
 
-        except Exception as e:
-            print(f"❌ [SCHEDULER] Error crítico: {str(e)}")
-            import traceback
-            traceback.print_exc()
+        print(f"❌ [ALERT ENGINE] Error al encolar email para: {tarea_nombre}")
+        return vencimiento
 
-# Inicializar scheduler solo en el worker principal
-# Usar file lock para asegurar que solo un worker ejecute el scheduler
-import fcntl
 
-def init_scheduler():
-    """Inicializa el scheduler solo en un worker (usando file lock)"""
-    lock_file_path = '/tmp/scheduler_lock'
+alert_engine = AlertDeadlineEngine(fetch_alerts=db.get_alert_timings, fire=disparar_alerta_vencida)
 
-    try:
-        # Intentar abrir/crear el archivo de lock
-        lock_file = open(lock_file_path, 'w')
-        # Intentar obtener lock exclusivo (no bloqueante)
-        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-
-        # Si llegamos aquí, somos el worker principal
-        print(f"[STARTUP] Este worker obtuvo el lock del scheduler (PID: {os.getpid()})", flush=True)
-
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(
-            func=verificar_alertas_automaticamente,
-            trigger=IntervalTrigger(minutes=5),
-            id='verificar_alertas_job',
-            name='Verificar alertas de tareas automáticamente',
-            replace_existing=True
-        )
+# Archivo de los webhooks antiguos y vacuum incremental (lo programa el proceso líder)
+webhook_retention = WebhookRetention()
 
-        scheduler.start()
-        print("[STARTUP] ✓ Scheduler de backend iniciado (verificación cada 5 minutos)", flush=True)
 
-        # Asegurar shutdown cuando se cierre la app
-        atexit.register(lambda: scheduler.shutdown())
+def verificar_alertas_automaticamente():
+    """
+    Reconciliación periódica del motor de alertas (cada ALERT_RECONCILE_MINUTES).
+    El envío de alertas lo hace el motor al vencer cada una; este job solo
+    recalcula todos los vencimientos desde la BD por si se perdió algún cambio.
+    """
+    try:
+        print(f"⏰ [SCHEDULER] Reconciliando motor de alertas ({datetime.now().isoformat()})")
+        alert_engine.reload()
+    except Exception as e:
+        print(f"❌ [SCHEDULER] Error crítico: {str(e)}")
+        import traceback
+        traceback.print_exc()
 
-        return True
+# Solo el proceso con la concesión 'alert_scheduler' (tabla scheduler_leases) ejecuta
+# el motor de alertas, el envío de emails, la reconciliación periódica y la retención de webhooks
+_reconcile_scheduler = None
+
+
+def iniciar_tareas_lider(fencing_token):
+    """Arranca el scheduler de alertas al obtener la concesión de liderazgo"""
+    global _reconcile_scheduler
+
+    # El motor recarga todas las alertas: las que vencieron sin líder se disparan ahora
+    alert_engine.start()
+
+    # Worker que envía por lotes los emails de la bandeja de salida
+    email_sender.start()
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(
+        func=verificar_alertas_automaticamente,
+        trigger=IntervalTrigger(minutes=ALERT_RECONCILE_MINUTES),
+        id='verificar_alertas_job',
+        name='Reconciliar motor de alertas',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=webhook_retention.run_once,
+        trigger=IntervalTrigger(hours=WEBHOOK_RETENTION_INTERVAL_HOURS),
+        id='retencion_webhooks_job',
+        name='Archivar webhooks antiguos y vacuum incremental',
+        next_run_time=datetime.now() + timedelta(minutes=5),
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=prune_changes,
+        trigger=IntervalTrigger(minutes=LIVE_PRUNE_INTERVAL_MINUTES),
+        id='purgar_cambios_tiempo_job',
+        name='Purgar el registro de cambios de tiempo',
+        next_run_time=datetime.now(),
+        replace_existing=True
+    )
+    scheduler.start()
+    _reconcile_scheduler = scheduler
+
+    print(f"[STARTUP] ✓ Motor de alertas iniciado (PID: {os.getpid()}, token {fencing_token}, "
+          f"reconciliación cada {ALERT_RECONCILE_MINUTES} minutos)", flush=True)
+
+
+def detener_tareas_lider():
+    """Detiene el scheduler de alertas al perder la concesión de liderazgo"""
+    global _reconcile_scheduler
+
+    if _reconcile_scheduler is not None:
+        _reconcile_scheduler.shutdown(wait=False)
+        _reconcile_scheduler = None
+    alert_engine.stop()
+    email_sender.stop()
+    print(f"[SCHEDULER] Motor de alertas detenido (PID: {os.getpid()})", flush=True)
+
+
+scheduler_lease = LeaderLease('alert_scheduler', on_elected=iniciar_tareas_lider, on_demoted=detener_tareas_lider)
 
-    except IOError:
-        # Otro worker ya tiene el lock
-        print(f"[STARTUP] Otro worker ya tiene el scheduler activo (PID: {os.getpid()})", flush=True)
-        return False
 
-# Intentar inicializar el scheduler
-init_scheduler()
+def init_scheduler():
+    """
+    Arranca la elección de líder del scheduler.
+    Todos los workers de esta máquina (comparten el fichero SQLite) compiten por
+    la concesión; si el líder muere, otro la toma al caducar
+    (SCHEDULER_LEASE_TTL_SECONDS) y arranca el motor.
+    """
+    if not BACKGROUND_JOBS_ENABLED:
+        print("[STARTUP] Tareas en segundo plano desactivadas (BACKGROUND_JOBS_ENABLED)", flush=True)
+        return
+    scheduler_lease.start()
+    # Al cerrar el proceso se libera la concesión para que otro worker la tome sin esperar
+    atexit.register(scheduler_lease.release)
+    print(f"[STARTUP] Elección de líder del scheduler iniciada ({scheduler_lease.holder_id})", flush=True)
 
 # ============================================================================
 
@@ -260,7 +321,14 @@ def api_health():
     return jsonify({
         'status': 'healthy',
         'service': 'virtualcontroller',
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now().isoformat(),
+        'db_pool': db.get_pool_stats(),
+        'scheduler_lease': scheduler_lease.get_stats(),
+        'alert_engine': alert_engine.get_stats(),
+        'email_outbox': email_sender.get_stats(),
+        'live_time_tracking': live_time_tracking.get_stats(),
+        'tareas_cache': tareas_cache.get_stats(),
+        'task_read_cache': db.get_task_cache_stats()
     }), 200
 
 @app.route('/api/endpoints')
@@ -437,7 +505,7 @@ def fetch_task_from_clickup_api(task_id, access_token=None):
         # 1. Token proporcionado como argumento
         # 2. Token de sesión (si existe)
         # 3. Token de configuración CLICKUP_API_TOKEN
-        if not access_token and 'access_token' in session:
+        if not access_token and has_request_context() and 'access_token' in session:
             access_token = session['access_token']
 
         if not access_token and CLICKUP_API_TOKEN:
@@ -454,10 +522,10 @@ def fetch_task_from_clickup_api(task_id, access_token=None):
             'Content-Type': 'application/json'
         }
 
-        url = f'https://api.clickup.com/api/v2/task/{task_id}'
+        url = f'/task/{task_id}'
         print(f"[INFO] Obteniendo detalles de tarea {task_id} desde API de ClickUp...")
 
-        response = requests.get(url, headers=headers, timeout=10)
+        response = clickup_get(url, headers=headers, timeout=10)
 
         if response.status_code == 200:
             task_data = response.json()
@@ -579,115 +647,13 @@ def webhook_clickup():
             print(f"[ERROR] Token inválido en webhook. Header: {token_header}, Query: {token_query}")
             return jsonify({'error': 'Unauthorized', 'message': 'Token inválido'}), 401
 
-        # Obtener datos del webhook de forma más robusta
-        # Usar get_json con force=True para ignorar Content-Type y silent=True para no lanzar excepciones
-        data = None
-        raw_data = None
-
+        # Un único parseo de los bytes recibidos; la reparación de JSON malformado
+        # solo se intenta si el parseo estricto falla (ver webhook_parsing)
         try:
-            # Intentar primero con el Content-Type correcto
-            data = request.get_json(silent=True)
-
-            # Si no funciona, intentar forzar el parseo
-            if data is None:
-                print("[WARNING] No se pudo parsear JSON con Content-Type, intentando force=True")
-                data = request.get_json(force=True, silent=True)
-
-            # Si aún no funciona, intentar leer el body raw
-            if data is None:
-                raw_data = request.get_data(as_text=True)
-                print(f"[DEBUG] Body raw recibido ({len(raw_data)} caracteres):")
-                print(f"[DEBUG] {raw_data[:1000]}")  # Primeros 1000 caracteres para ver el problema
-
-                if raw_data:
-                    try:
-                        # Intentar parsear el JSON directamente
-                        data = json.loads(raw_data)
-                    except json.JSONDecodeError as e:
-                        print(f"[ERROR] Error al parsear JSON: {str(e)}")
-                        print(f"[DEBUG] Línea con error (aproximada):")
-
-                        # Intentar mostrar la línea con el error
-                        try:
-                            lines = raw_data.split('\n')
-                            error_line = e.lineno - 1 if e.lineno <= len(lines) else 0
-                            if error_line >= 0 and error_line < len(lines):
-                                print(f"[DEBUG] Línea {e.lineno}: {lines[error_line]}")
-                                print(f"[DEBUG] Posición del error: {' ' * (e.colno - 1)}^")
-                        except:
-                            pass
-
-                        # Intentar limpiar problemas comunes de JSON
-                        print("[INFO] Intentando limpiar JSON malformado...")
-                        try:
-                            # Limpiar problemas comunes:
-                            # 1. Trailing commas: {"key": value,}
-                            # 2. Valores undefined o null mal escritos
-                            # 3. Valores vacíos: "key": , -> "key": null
-                            # 4. Arrays vacíos malformados: "key": , -> "key": []
-                            cleaned_data = raw_data
-
-                            # Remover trailing commas antes de } o ]
-                            cleaned_data = re.sub(r',\s*}', '}', cleaned_data)
-                            cleaned_data = re.sub(r',\s*]', ']', cleaned_data)
-
-                            # Arreglar valores vacíos: "key": , -> "key": null
-                            # Primero, reemplazar arrays/objetos vacíos explícitos
-                            cleaned_data = re.sub(r':\s*,', ': null,', cleaned_data)
-                            cleaned_data = re.sub(r':\s*\n', ': null\n', cleaned_data)
-
-                            # Casos específicos de Make.com donde arrays están vacíos
-                            # "assignees": , -> "assignees": []
-                            cleaned_data = re.sub(r'"assignees"\s*:\s*null', '"assignees": []', cleaned_data)
-                            cleaned_data = re.sub(r'"tags"\s*:\s*null', '"tags": []', cleaned_data)
-                            cleaned_data = re.sub(r'"custom_fields"\s*:\s*null', '"custom_fields": {}', cleaned_data)
-
-                            # Intentar parsear el JSON limpio
-                            data = json.loads(cleaned_data)
-                            print("[INFO] ✓ JSON limpiado exitosamente")
-                            print(f"[DEBUG] JSON limpio: {json.dumps(data, indent=2)}")
-
-                        except json.JSONDecodeError as e2:
-                            print(f"[ERROR] No se pudo limpiar el JSON: {str(e2)}")
-
-                            # Si Make.com está enviando datos malformados, intentar extraer al menos
-                            # los campos esenciales manualmente
-                            print("[WARNING] Intentando extraer campos básicos del JSON malformado...")
-                            try:
-                                # Buscar task_id usando regex
-                                task_id_match = re.search(r'"task_id"\s*:\s*"([^"]+)"', raw_data)
-                                event_match = re.search(r'"event"\s*:\s*"([^"]+)"', raw_data)
-
-                                if task_id_match:
-                                    # Crear un objeto mínimo con los datos extraídos
-                                    data = {
-                                        'task_id': task_id_match.group(1),
-                                        'event': event_match.group(1) if event_match else 'taskStatusUpdated',
-                                        '_extracted_from_malformed': True,
-                                        '_original_error': str(e)
-                                    }
-                                    print(f"[INFO] ✓ Extraído task_id: {data['task_id']}")
-                                    print("[INFO] Se obtendrán los detalles completos desde la API de ClickUp")
-                                else:
-                                    # No se pudo extraer nada útil
-                                    return jsonify({
-                                        'error': 'Bad Request',
-                                        'message': 'El JSON está malformado y no se pudieron extraer campos básicos',
-                                        'details': str(e),
-                                        'line': e.lineno,
-                                        'column': e.colno,
-                                        'suggestion': 'Verifica la configuración del webhook en Make.com. Asegúrate de enviar JSON válido.'
-                                    }), 400
-                            except Exception as e3:
-                                print(f"[ERROR] No se pudieron extraer campos básicos: {str(e3)}")
-                                return jsonify({
-                                    'error': 'Bad Request',
-                                    'message': 'El cuerpo de la solicitud no es JSON válido',
-                                    'details': str(e),
-                                    'line': e.lineno,
-                                    'column': e.colno
-                                }), 400
-
+            raw_body = request.get_data(cache=False)
+            data, modo_parseo = parse_webhook_body(raw_body) if raw_body else (None, None)
+        except WebhookParseError as e:
+            return jsonify(dict(e.details, error='Bad Request', message=e.message)), 400
         except Exception as e:
             print(f"[ERROR] Excepción al obtener datos JSON: {str(e)}")
             import traceback
@@ -702,7 +668,9 @@ def webhook_clickup():
             print("[ERROR] Webhook recibido sin datos JSON o con datos vacíos")
             return jsonify({'error': 'Bad Request', 'message': 'No se recibieron datos válidos'}), 400
 
-        print(f"[INFO] Webhook recibido: {json.dumps(data, indent=2)}")
+        # El cuerpo válido se registra y se guarda tal cual, sin volver a serializarlo
+        raw_text = raw_body.decode('utf-8') if modo_parseo == 'strict' else None
+        print(f"[INFO] Webhook recibido ({len(raw_body)} bytes, {modo_parseo}): {raw_text or json.dumps(data)}")
 
         # Detectar tipo de evento
         event_type = data.get('event') or data.get('event_type', 'unknown')
@@ -713,44 +681,44 @@ def webhook_clickup():
         folder_id = data.get('folder_id')
         space_id = data.get('space_id')
 
+        # Reintentos de ClickUp / Make.com: se descartan sin volver a procesarlos
+        dedup_key = clave_idempotencia(event_type, data)
+        if dedup_key and webhooks_procesados.get(dedup_key):
+            db.count_webhook_duplicate(dedup_key)
+            return respuesta_webhook_duplicado(event_type, dedup_key)
+
+        # Modo asíncrono: guardar el payload y responder de inmediato; los workers lo procesan
+        if WEBHOOK_ASYNC_MODE:
+            webhook_log_id = db.log_webhook(
+                event_type=event_type,
+                payload=data,
+                task_id=task_id,
+                list_id=list_id,
+                folder_id=folder_id,
+                space_id=space_id,
+                queued=True,
+                dedup_key=dedup_key,
+                payload_json=raw_text
+            )
+            if webhook_log_id is None:
+                return respuesta_webhook_duplicado(event_type, dedup_key)
+            _webhook_queue_event.set()
+            print(f"[INFO] Evento '{event_type}' encolado (webhook_log_id: {webhook_log_id})")
+
+            return jsonify({
+                'success': True,
+                'queued': True,
+                'event_type': event_type,
+                'webhook_log_id': webhook_log_id,
+                'timestamp': datetime.now().isoformat()
+            }), 202
+
         # Si es un evento de tarea pero faltan datos completos, obtenerlos de la API
-        if 'task' in event_type.lower() and task_id:
-            # Verificar si tenemos los datos mínimos necesarios
-            if not data.get('task_name') and not data.get('name'):
-                print(f"[INFO] Webhook incompleto detectado, obteniendo detalles de tarea {task_id} desde API...")
-                task_details = fetch_task_from_clickup_api(task_id)
-
-                if task_details:
-                    # Enriquecer los datos del webhook con la información completa
-                    data['task_name'] = task_details.get('name', 'Sin nombre')
-                    data['status'] = task_details.get('status', {}).get('status', 'Sin estado')
-                    data['list_id'] = task_details.get('list', {}).get('id')
-                    data['folder_id'] = task_details.get('folder', {}).get('id')
-                    data['space_id'] = task_details.get('space', {}).get('id')
-                    data['url'] = task_details.get('url', '')
-                    data['description'] = task_details.get('description', '')
-                    data['priority'] = task_details.get('priority', {}).get('priority')
-                    data['assignees'] = task_details.get('assignees', [])
-                    data['date_created'] = task_details.get('date_created')
-                    data['date_updated'] = task_details.get('date_updated')
-                    data['due_date'] = task_details.get('due_date')
-                    data['start_date'] = task_details.get('start_date')
-                    data['time_estimate'] = task_details.get('time_estimate')
-                    data['time_spent'] = task_details.get('time_spent')
-                    data['tags'] = task_details.get('tags', [])
-                    data['custom_fields'] = task_details.get('custom_fields', [])
-
-                    # Actualizar IDs si no estaban presentes
-                    if not list_id:
-                        list_id = data.get('list_id')
-                    if not folder_id:
-                        folder_id = data.get('folder_id')
-                    if not space_id:
-                        space_id = data.get('space_id')
-
-                    print(f"[INFO] Datos de tarea {task_id} enriquecidos desde API")
-                else:
-                    print(f"[WARNING] No se pudieron obtener detalles de la tarea {task_id} desde API")
+        if enriquecer_webhook(event_type, data):
+            raw_text = None
+        list_id = list_id or data.get('list_id')
+        folder_id = folder_id or data.get('folder_id')
+        space_id = space_id or data.get('space_id')
 
         # Registrar webhook en base de datos
         webhook_log_id = db.log_webhook(
@@ -759,31 +727,21 @@ def webhook_clickup():
             task_id=task_id,
             list_id=list_id,
             folder_id=folder_id,
-            space_id=space_id
+            space_id=space_id,
+            dedup_key=dedup_key,
+            payload_json=raw_text
         )
+        if webhook_log_id is None:
+            return respuesta_webhook_duplicado(event_type, dedup_key)
 
         print(f"[INFO] Procesando evento '{event_type}' (webhook_log_id: {webhook_log_id})")
 
-        # Extraer el timestamp del webhook (viene de Make.com en el nivel superior)
-        webhook_timestamp = data.get('timestamp')
-
-        # Procesar según el tipo de evento
-        result = None
-
-        if 'task' in event_type.lower():
-            result = process_task_event(event_type, data, webhook_timestamp)
-        elif 'list' in event_type.lower():
-            result = process_list_event(event_type, data)
-        elif 'folder' in event_type.lower():
-            result = process_folder_event(event_type, data)
-        elif 'space' in event_type.lower():
-            result = process_space_event(event_type, data)
-        else:
-            print(f"[WARNING] Tipo de evento no reconocido: {event_type}")
-            result = {'status': 'ignored', 'message': 'Evento no soportado'}
+        result = despachar_evento_webhook(event_type, data)
 
         # Marcar webhook como procesado
         db.mark_webhook_processed(webhook_log_id, error=None)
+        if dedup_key:
+            webhooks_procesados.set(dedup_key, True)
 
         return jsonify({
             'success': True,
@@ -805,7 +763,287 @@ def webhook_clickup():
         return jsonify({'error': 'Internal Server Error', 'message': error_msg}), 500
 
 
-def process_task_event(event_type, data, webhook_timestamp=None):
+def clave_idempotencia(event_type, data):
+    """
+    Clave de idempotencia de un webhook, calculada sobre el payload recibido (antes de enriquecerlo).
+
+    Usa los IDs de history_items que envía ClickUp; si no vienen, un hash de
+    (evento, ID del objeto, date_updated). Devuelve None si el payload no permite
+    distinguir un reintento de un evento nuevo (ese webhook se procesa siempre).
+    """
+    history_ids = sorted(
+        str(item['id']) for item in (data.get('history_items') or [])
+        if isinstance(item, dict) and item.get('id')
+    )
+    if history_ids:
+        return f"{event_type}:history:{','.join(history_ids)}"
+
+    objeto_id = data.get('task_id') or data.get('list_id') or data.get('folder_id') or data.get('space_id')
+    date_updated = data.get('date_updated') or data.get('date_updated_unix')
+    if objeto_id and date_updated:
+        digest = hashlib.sha1(f"{event_type}|{objeto_id}|{date_updated}".encode('utf-8')).hexdigest()
+        return f"{event_type}:hash:{digest}"
+    return None
+
+
+def respuesta_webhook_duplicado(event_type, dedup_key):
+    """Respuesta a un reintento ya procesado (o en proceso): 200 para que el emisor no insista"""
+    print(f"[WEBHOOK] Duplicado descartado: '{event_type}' ({dedup_key})")
+    return jsonify({
+        'success': True,
+        'duplicate': True,
+        'event_type': event_type,
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+
+def enriquecer_webhook(event_type, data):
+    """
+    Completa en el propio diccionario los datos de una tarea que llegan
+    incompletos en el webhook (ej: solo task_id), consultando la API de ClickUp.
+
+    Returns:
+        bool: True si se modificó data
+    """
+    task_id = data.get('task_id')
+    if 'task' not in event_type.lower() or not task_id:
+        return False
+
+    # Verificar si tenemos los datos mínimos necesarios
+    if data.get('task_name') or data.get('name'):
+        return False
+
+    print(f"[INFO] Webhook incompleto detectado, obteniendo detalles de tarea {task_id} desde API...")
+    task_details = fetch_task_from_clickup_api(task_id)
+
+    if task_details:
+        # Enriquecer los datos del webhook con la información completa
+        data['task_name'] = task_details.get('name', 'Sin nombre')
+        data['status'] = task_details.get('status', {}).get('status', 'Sin estado')
+        data['list_id'] = task_details.get('list', {}).get('id')
+        data['folder_id'] = task_details.get('folder', {}).get('id')
+        data['space_id'] = task_details.get('space', {}).get('id')
+        data['url'] = task_details.get('url', '')
+        data['description'] = task_details.get('description', '')
+        data['priority'] = task_details.get('priority', {}).get('priority')
+        data['assignees'] = task_details.get('assignees', [])
+        data['date_created'] = task_details.get('date_created')
+        data['date_updated'] = task_details.get('date_updated')
+        data['due_date'] = task_details.get('due_date')
+        data['start_date'] = task_details.get('start_date')
+        data['time_estimate'] = task_details.get('time_estimate')
+        data['time_spent'] = task_details.get('time_spent')
+        data['tags'] = task_details.get('tags', [])
+        data['custom_fields'] = task_details.get('custom_fields', [])
+
+        print(f"[INFO] Datos de tarea {task_id} enriquecidos desde API")
+        return True
+
+    print(f"[WARNING] No se pudieron obtener detalles de la tarea {task_id} desde API")
+    return False
+
+
+def despachar_evento_webhook(event_type, data, recibido_en=None):
+    """
+    Procesa un webhook ya registrado según su tipo de evento
+
+    Args:
+        recibido_en: momento de recepción (ISO UTC) si el webhook se procesa más tarde desde la cola
+    """
+    # Extraer el timestamp del webhook (viene de Make.com en el nivel superior)
+    webhook_timestamp = data.get('timestamp')
+
+    if 'task' in event_type.lower():
+        return process_task_event(event_type, data, webhook_timestamp, recibido_en=recibido_en)
+    elif 'list' in event_type.lower():
+        return process_list_event(event_type, data)
+    elif 'folder' in event_type.lower():
+        return process_folder_event(event_type, data)
+    elif 'space' in event_type.lower():
+        return process_space_event(event_type, data)
+
+    print(f"[WARNING] Tipo de evento no reconocido: {event_type}")
+    return {'status': 'ignored', 'message': 'Evento no soportado'}
+
+
+# ============================================================================
+# COLA ASÍNCRONA DE WEBHOOKS (WEBHOOK_ASYNC_MODE)
+# ============================================================================
+
+# Despierta a los workers cuando llega un webhook nuevo
+_webhook_queue_event = threading.Event()
+
+
+def fecha_recepcion_utc(fila):
+    """received_at de una fila de webhooks_log (UTC, 'YYYY-MM-DD HH:MM:SS') en ISO UTC"""
+    if not fila.get('received_at'):
+        return None
+    return str(fila['received_at']).replace(' ', 'T') + 'Z'
+
+
+def procesar_webhook_encolado(fila):
+    """Procesa un webhook reclamado de la cola (fila de webhooks_log)"""
+    event_type = fila['event_type']
+    data = json.loads(fila['payload'])
+
+    enriquecer_webhook(event_type, data)
+
+    print(f"[WEBHOOK QUEUE] Procesando evento '{event_type}' (webhook_log_id: {fila['id']}, intento {fila['attempts']})")
+    return despachar_evento_webhook(event_type, data, recibido_en=fecha_recepcion_utc(fila))
+
+
+def aplicar_eventos_tarea(eventos):
+    """
+    Aplica de una vez varios eventos consecutivos de una misma tarea
+
+    Los intermedios solo registran en el historial cada transición de estado
+    distinta (con su propio momento de recepción); el último se procesa completo
+    (guardar tarea, caché y alertas) partiendo del estado que dejaron los anteriores.
+
+    Cada transición se guarda con el id del webhook que la originó: si el lote
+    falla y se reintenta, las que ya quedaron registradas no se repiten.
+
+    Args:
+        eventos: lista de (event_type, data, recibido_en, webhook_log_id) en orden de llegada
+    """
+    task_id = eventos[-1][1].get('task_id')
+    registrados = db.get_recorded_webhook_changes(task_id, [evento[3] for evento in eventos])
+    old_task = db.get_task(task_id)
+    estado_previo = (old_task.get('status'), old_task.get('status_text')) if old_task else (None, None)
+
+    for event_type, data, recibido_en, webhook_log_id in eventos[:-1]:
+        # Los eventos sin estado (ej: solo task_id) no aportan transiciones
+        if not data.get('status'):
+            continue
+        estado = estado_interno(data['status'])
+        if estado != estado_previo[0] and webhook_log_id not in registrados:
+            registrar_cambio_estado(task_id, estado_previo[0], estado_previo[1], estado, data,
+                                    webhook_timestamp=data.get('timestamp'), recibido_en=recibido_en,
+                                    webhook_log_id=webhook_log_id)
+        estado_previo = (estado, data['status'])
+
+    event_type, data, recibido_en, webhook_log_id = eventos[-1]
+    enriquecer_webhook(event_type, data)
+    return process_task_event(event_type, data, data.get('timestamp'), recibido_en=recibido_en,
+                              estado_previo=estado_previo, webhook_log_id=webhook_log_id,
+                              cambio_registrado=webhook_log_id in registrados)
+
+
+def procesar_webhooks_coalescidos(filas):
+    """Procesa varios webhooks reclamados juntos de una misma tarea (ver db.claim_next_webhook)"""
+    print(f"[WEBHOOK QUEUE] Coalesciendo {len(filas)} eventos de la tarea {filas[0]['task_id']} "
+          f"(webhook_log_id: {filas[0]['id']}-{filas[-1]['id']})")
+    return aplicar_eventos_tarea([
+        (fila['event_type'], json.loads(fila['payload']), fecha_recepcion_utc(fila), fila['id']) for fila in filas
+    ])
+
+
+def _webhook_worker_loop():
+    """Bucle de un worker: reclama webhooks pendientes y los procesa hasta agotar la cola"""
+    while True:
+        # Limpiar antes de reclamar: un webhook encolado después despierta la espera siguiente
+        _webhook_queue_event.clear()
+        try:
+            fila = db.claim_next_webhook(WEBHOOK_CLAIM_TIMEOUT, WEBHOOK_MAX_ATTEMPTS,
+                                         coalesce_seconds=WEBHOOK_COALESCE_WINDOW_MS / 1000,
+                                         max_coalesced=WEBHOOK_COALESCE_MAX_EVENTS)
+        except Exception as e:
+            print(f"[WEBHOOK QUEUE] Error al reclamar webhook: {str(e)}")
+            time.sleep(WEBHOOK_POLL_INTERVAL)
+            continue
+
+        if fila is None:
+            # Dormir hasta que venza la ventana de coalescencia del webhook más antiguo
+            # que la está esperando, o como mucho WEBHOOK_POLL_INTERVAL
+            espera = WEBHOOK_POLL_INTERVAL
+            try:
+                pendiente = db.get_webhook_coalesce_wait(WEBHOOK_COALESCE_WINDOW_MS / 1000, WEBHOOK_MAX_ATTEMPTS)
+                if pendiente is not None:
+                    espera = min(espera, pendiente + 0.001)
+            except Exception as e:
+                print(f"[WEBHOOK QUEUE] Error al consultar la cola: {str(e)}")
+            _webhook_queue_event.wait(espera)
+            continue
+
+        filas = [fila] + fila.pop('coalesced', [])
+        try:
+            with app.app_context():
+                if len(filas) > 1:
+                    procesar_webhooks_coalescidos(filas)
+                else:
+                    procesar_webhook_encolado(fila)
+            for procesada in filas:
+                db.mark_webhook_processed(procesada['id'], error=None)
+                if procesada.get('dedup_key'):
+                    webhooks_procesados.set(procesada['dedup_key'], True)
+        except Exception as e:
+            error_msg = str(e)
+            print(f"[WEBHOOK QUEUE] Error al procesar webhook {fila['id']}: {error_msg}")
+            import traceback
+            traceback.print_exc()
+
+            for fallida in filas:
+                if fallida['attempts'] >= WEBHOOK_MAX_ATTEMPTS:
+                    db.mark_webhook_processed(fallida['id'], error=error_msg)
+                else:
+                    db.release_webhook(fallida['id'], error=error_msg)
+
+
+def start_webhook_workers():
+    """Arranca el pool de workers de la cola de webhooks si el modo asíncrono está activo"""
+    if not WEBHOOK_ASYNC_MODE or not BACKGROUND_JOBS_ENABLED:
+        return
+
+    for i in range(max(1, WEBHOOK_WORKERS)):
+        threading.Thread(target=_webhook_worker_loop, name=f'webhook-worker-{i}', daemon=True).start()
+    print(f"[STARTUP] ✓ Cola asíncrona de webhooks activa con {WEBHOOK_WORKERS} workers (PID: {os.getpid()})", flush=True)
+
+
+def estado_interno(status):
+    """Traduce el estado de ClickUp al estado interno: pendiente, en_progreso o completada"""
+    status = (status or '').lower()
+    if status in ['complete', 'closed', 'completed']:
+        return 'completada'
+    elif 'progress' in status or 'review' in status or 'doing' in status:
+        return 'en_progreso'
+    return 'pendiente'
+
+
+def registrar_cambio_estado(task_id, old_status, old_status_text, estado, data, webhook_timestamp=None,
+                            recibido_en=None, webhook_log_id=None):
+    """Guarda en el historial el paso de old_status a estado con el momento que corresponde al evento"""
+    date_updated = data.get('date_updated') or data.get('date_updated_unix')
+
+    # Usar el timestamp del webhook si está disponible, sino parse_date_flexible del date_updated
+    changed_at_timestamp = None
+
+    # Si la tarea está cambiando A estado "en_progreso" (desde cualquier otro estado),
+    # usar timestamp actual UTC para que el temporizador comience desde 0
+    if estado == 'en_progreso' and old_status != 'en_progreso':
+        changed_at_timestamp = recibido_en or datetime.utcnow().isoformat() + 'Z'
+        print(f"[INFO] Tarea cambiando a 'en_progreso', usando timestamp de recepción UTC: {changed_at_timestamp}")
+    elif webhook_timestamp:
+        # El timestamp del webhook ya viene en formato ISO
+        changed_at_timestamp = parse_date_flexible(webhook_timestamp)
+        print(f"[INFO] Usando timestamp del webhook para cambio de estado: {changed_at_timestamp}")
+    elif date_updated:
+        changed_at_timestamp = parse_date_flexible(date_updated)
+        print(f"[INFO] Usando date_updated para cambio de estado: {changed_at_timestamp}")
+
+    db.save_status_change(
+        task_id=task_id,
+        old_status=old_status,
+        new_status=estado,
+        old_status_text=old_status_text,
+        new_status_text=data.get('status', 'Sin estado'),
+        changed_at=changed_at_timestamp,
+        webhook_log_id=webhook_log_id
+    )
+    print(f"[INFO] Cambio de estado registrado: {task_id} de '{old_status}' a '{estado}' en {changed_at_timestamp}")
+
+
+def process_task_event(event_type, data, webhook_timestamp=None, recibido_en=None, estado_previo=None,
+                       webhook_log_id=None, cambio_registrado=False):
     """
     Procesa eventos relacionados con tareas
 
@@ -813,6 +1051,12 @@ def process_task_event(event_type, data, webhook_timestamp=None):
         event_type: Tipo de evento (taskCreated, taskUpdated, etc.)
         data: Datos del webhook
         webhook_timestamp: Timestamp del webhook en formato ISO (opcional)
+        recibido_en: Momento de recepción del webhook en ISO UTC (opcional, para webhooks encolados).
+                     Si no se indica se usa el momento actual.
+        estado_previo: (status, status_text) de la tarea antes de este evento, si ya se conoce
+                       (eventos coalescidos); si no, se lee de la BD.
+        webhook_log_id: webhook que originó el evento; se guarda con el cambio de estado (opcional).
+        cambio_registrado: el cambio de estado de este webhook ya se registró en un intento anterior.
     """
     print(f"\n[WEBHOOK] ===== Recibido evento: {event_type} =====")
     print(f"[WEBHOOK] Timestamp: {datetime.now().isoformat()}")
@@ -833,8 +1077,7 @@ def process_task_event(event_type, data, webhook_timestamp=None):
         # Eliminar tarea de la base de datos
         db.delete_task(task_id)
         # Eliminar del caché
-        if task_id in tareas_cache:
-            del tareas_cache[task_id]
+        tareas_cache.delete(task_id)
 
         print(f"[INFO] Tarea {task_id} eliminada")
         return {'status': 'deleted', 'task_id': task_id}
@@ -856,17 +1099,16 @@ def process_task_event(event_type, data, webhook_timestamp=None):
     tags = data.get('tags', [])
     custom_fields = data.get('custom_fields', [])
 
-    # Obtener el estado anterior de la tarea
-    old_task = db.get_task(task_id)
-    old_status = old_task.get('status') if old_task else None
-    old_status_text = old_task.get('status_text') if old_task else None
+    # Obtener el estado anterior de la tarea (si viene de un lote coalescido ya se conoce)
+    if estado_previo is not None:
+        old_status, old_status_text = estado_previo
+    else:
+        old_task = db.get_task(task_id)
+        old_status = old_task.get('status') if old_task else None
+        old_status_text = old_task.get('status_text') if old_task else None
 
     # Determinar el estado de la tarea
-    estado = 'pendiente'
-    if status in ['complete', 'closed', 'completed']:
-        estado = 'completada'
-    elif 'progress' in status or 'review' in status or 'doing' in status:
-        estado = 'en_progreso'
+    estado = estado_interno(status)
 
     # Preparar datos de tarea para guardar en BD
     task_data = {
@@ -897,38 +1139,17 @@ def process_task_event(event_type, data, webhook_timestamp=None):
 
     # Registrar cambio de estado si ha cambiado
     if old_status != estado:
-        # Usar el timestamp del webhook si está disponible, sino parse_date_flexible del date_updated
-        changed_at_timestamp = None
-
-        # Si la tarea está cambiando A estado "en_progreso" (desde cualquier otro estado),
-        # usar timestamp actual UTC para que el temporizador comience desde 0
-        if estado == 'en_progreso' and old_status != 'en_progreso':
-            changed_at_timestamp = datetime.utcnow().isoformat() + 'Z'
-            print(f"[INFO] Tarea cambiando a 'en_progreso', usando timestamp actual UTC: {changed_at_timestamp}")
-        elif webhook_timestamp:
-            # El timestamp del webhook ya viene en formato ISO
-            changed_at_timestamp = parse_date_flexible(webhook_timestamp)
-            print(f"[INFO] Usando timestamp del webhook para cambio de estado: {changed_at_timestamp}")
-        elif date_updated:
-            changed_at_timestamp = parse_date_flexible(date_updated)
-            print(f"[INFO] Usando date_updated para cambio de estado: {changed_at_timestamp}")
-
-        db.save_status_change(
-            task_id=task_id,
-            old_status=old_status,
-            new_status=estado,
-            old_status_text=old_status_text,
-            new_status_text=data.get('status', 'Sin estado'),
-            changed_at=changed_at_timestamp
-        )
-        print(f"[INFO] Cambio de estado registrado: {task_id} de '{old_status}' a '{estado}' en {changed_at_timestamp}")
+        if not cambio_registrado:
+            registrar_cambio_estado(task_id, old_status, old_status_text, estado, data,
+                                    webhook_timestamp=webhook_timestamp, recibido_en=recibido_en,
+                                    webhook_log_id=webhook_log_id)
     elif estado == 'en_progreso':
         # Si la tarea ya estaba en progreso, verificar si tiene historial
         # Si no tiene historial de entrada a "en_progreso", crear uno con timestamp actual UTC
         history = db.get_status_history(task_id)
         has_progress_entry = any(h['new_status'] == 'en_progreso' for h in history)
         if not has_progress_entry:
-            changed_at_timestamp = datetime.utcnow().isoformat() + 'Z'
+            changed_at_timestamp = recibido_en or datetime.utcnow().isoformat() + 'Z'
             db.save_status_change(
                 task_id=task_id,
                 old_status=None,
@@ -937,10 +1158,10 @@ def process_task_event(event_type, data, webhook_timestamp=None):
                 new_status_text=data.get('status', 'Sin estado'),
                 changed_at=changed_at_timestamp
             )
-            print(f"[INFO] Creado registro inicial para tarea en progreso: {task_id} con timestamp actual UTC: {changed_at_timestamp}")
+            print(f"[INFO] Creado registro inicial para tarea en progreso: {task_id} con timestamp de recepción UTC: {changed_at_timestamp}")
 
     # Guardar en caché para acceso rápido
-    tareas_cache[task_id] = {
+    tareas_cache.set(task_id, {
         'id': task_id,
         'nombre': task_name,
         'estado': estado,
@@ -951,7 +1172,7 @@ def process_task_event(event_type, data, webhook_timestamp=None):
         'timestamp_cache': datetime.now().isoformat(),
         'horas_trabajadas': data.get('horas_trabajadas', 0),
         'minutos_trabajados': data.get('minutos_trabajados', 0),
-    }
+    })
 
     print(f"[INFO] Tarea {task_id} guardada en BD y caché: {task_name}")
 
@@ -967,6 +1188,9 @@ def process_task_event(event_type, data, webhook_timestamp=None):
         else:
             print(f"[WEBHOOK] - No hay alerta configurada para tarea {task_id}")
 
+    # Recalcular el vencimiento de la alerta de la tarea en el motor de alertas
+    alert_engine.refresh([task_id])
+
     return {'status': 'saved', 'task_id': task_id, 'name': task_name}
 
 
@@ -977,11 +1201,19 @@ def process_list_event(event_type, data):
         return {'status': 'error', 'message': 'list_id requerido'}
 
     list_name = data.get('list_name') or data.get('name', 'Sin nombre')
-    space_id = data.get('space_id')
-    folder_id = data.get('folder_id')
+    anterior = db.get_list(list_id) or {}
+    # Si el payload no trae la ubicación se conserva la guardada
+    space_id = data.get('space_id') or anterior.get('space_id')
+    folder_id = data['folder_id'] if 'folder_id' in data else anterior.get('folder_id')
     archived = data.get('archived', False)
 
+    # La lista pudo cambiar de espacio: invalidar el anterior y el nuevo
+    if anterior.get('space_id') and anterior.get('space_id') != space_id:
+        invalidar_jerarquia(space_id=anterior['space_id'])
+    invalidar_jerarquia(space_id=space_id)
+
     if event_type == 'listDeleted':
+        db.archive_lists([list_id])
         print(f"[INFO] Lista {list_id} eliminada")
         return {'status': 'deleted', 'list_id': list_id}
 
@@ -999,10 +1231,14 @@ def process_folder_event(event_type, data):
         return {'status': 'error', 'message': 'folder_id requerido'}
 
     folder_name = data.get('folder_name') or data.get('name', 'Sin nombre')
-    space_id = data.get('space_id')
+    anterior = db.get_folder(folder_id) or {}
+    space_id = data.get('space_id') or anterior.get('space_id')
     hidden = data.get('hidden', False)
 
+    invalidar_jerarquia(space_id=space_id)
+
     if event_type == 'folderDeleted':
+        db.delete_folder(folder_id)
         print(f"[INFO] Carpeta {folder_id} eliminada")
         return {'status': 'deleted', 'folder_id': folder_id}
 
@@ -1019,9 +1255,15 @@ def process_space_event(event_type, data):
         return {'status': 'error', 'message': 'space_id requerido'}
 
     space_name = data.get('space_name') or data.get('name', 'Sin nombre')
-    team_id = data.get('team_id')
+    anterior = db.get_space(space_id) or {}
+    team_id = data.get('team_id') or anterior.get('team_id')
+
+    # Sin team conocido se invalidan los espacios de todos los teams
+    db.invalidate_sync_scopes(f'hierarchy:team:{team_id}:%' if team_id else 'hierarchy:team:%')
+    invalidar_jerarquia(space_id=space_id)
 
     if event_type == 'spaceDeleted':
+        db.delete_space(space_id)
         print(f"[INFO] Espacio {space_id} eliminado")
         return {'status': 'deleted', 'space_id': space_id}
 
@@ -1150,32 +1392,25 @@ def check_and_send_alert(task_id, task_name, task_url, date_updated, alert_confi
             print(f"📤 [EMAIL] Proyecto: {proyecto_nombre}")
             print(f"📤 [EMAIL] Tiempo: {tiempo_str}")
 
-            email_enviado = enviar_email_alerta(
+            email_encolado = encolar_email_alerta(
+                task_id,
                 email_destino,
                 task_name,
                 proyecto_nombre,
                 task_url,
                 tiempo_str,
-                tipo_alerta
+                tipo_alerta,
+                activada_en=alert_config.get('ultima_actualizacion')
             )
 
-            if email_enviado:
+            if email_encolado:
                 print("\n" + "✅"*20)
-                print("✅ EMAIL ENVIADO EXITOSAMENTE")
+                print("✅ EMAIL ENCOLADO PARA ENVÍO")
                 print("✅"*20)
-                print(f"✅ [RESULT] Alerta enviada a: {email_destino}")
+                print(f"✅ [RESULT] Alerta para: {email_destino}")
                 print(f"✅ [RESULT] Tarea: {task_name}")
                 print(f"✅ [RESULT] Tiempo: {tiempo_str}")
-
-                # Desactivar la alerta después del envío
-                db.deactivate_task_alert(task_id)
-                print(f"🔕 [RESULT] Alerta desactivada automáticamente")
-
-                # También actualizar la caché en memoria si existe
-                if task_id in alertas_tareas:
-                    alertas_tareas[task_id]['aviso_activado'] = False
-                    alertas_tareas[task_id]['ultimo_envio_email'] = datetime.now().isoformat()
-
+                print(f"🔕 [RESULT] La alerta se desactivará al confirmarse el envío")
                 print("✅"*20 + "\n")
             else:
                 print("\n" + "❌"*20)
@@ -1210,10 +1445,11 @@ def obtener_cache_tareas():
 
         if task_id:
             # Devolver una tarea específica
-            if task_id in tareas_cache:
+            tarea = tareas_cache.get(task_id)
+            if tarea is not None:
                 return jsonify({
                     'success': True,
-                    'task': tareas_cache[task_id]
+                    'task': tarea
                 }), 200
             else:
                 return jsonify({
@@ -1222,10 +1458,12 @@ def obtener_cache_tareas():
                 }), 404
         else:
             # Devolver todo el caché
+            tareas = tareas_cache.values()
             return jsonify({
                 'success': True,
-                'tasks': list(tareas_cache.values()),
-                'count': len(tareas_cache),
+                'tasks': tareas,
+                'count': len(tareas),
+                'stats': tareas_cache.get_stats(),
                 'timestamp': datetime.now().isoformat()
             }), 200
 
@@ -1239,8 +1477,7 @@ def limpiar_cache_tareas():
     Endpoint para limpiar el caché de tareas (útil para testing y mantenimiento)
     """
     try:
-        global tareas_cache
-        tareas_cache = {}
+        tareas_cache.clear()
 
         print("[INFO] Caché de tareas limpiado")
 
@@ -1253,17 +1490,46 @@ def limpiar_cache_tareas():
         print(f"[ERROR] Error al limpiar caché: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_window(value):
+    """Convierte una ventana como '15m', '1h', '7d' o '900' (segundos) a segundos"""
+    value = value.strip().lower()
+    if value[-1:] in WINDOW_UNITS:
+        return int(value[:-1]) * WINDOW_UNITS[value[-1]]
+    return int(value)
+
+
 @app.route('/api/webhook/stats', methods=['GET'])
 def obtener_stats_webhooks():
     """
     Endpoint para obtener estadísticas de webhooks procesados
+
+    Query params:
+        window: solo los últimos 15m, 1h, 24h, 7d... o N segundos (por defecto, desde el principio)
     """
     try:
-        stats = db.get_webhook_stats()
+        window = request.args.get('window')
+        try:
+            window_seconds = parse_window(window) if window else None
+        except ValueError:
+            return jsonify({'error': f"Ventana no válida: '{window}' (ej: 15m, 1h, 24h, 7d)"}), 400
+        if window_seconds is not None and window_seconds <= 0:
+            return jsonify({'error': 'La ventana debe ser mayor que cero'}), 400
+
+        stats = db.get_webhook_stats(window_seconds)
 
         return jsonify({
             'success': True,
+            'window_seconds': window_seconds,
             'stats': stats,
+            'queue': dict(db.get_webhook_queue_stats(), async_mode=WEBHOOK_ASYNC_MODE),
+            'dedup': {
+                'duplicates': sum(fila['duplicates'] or 0 for fila in stats),
+                'memory': webhooks_procesados.get_stats()
+            },
+            'retention': webhook_retention.get_stats(),
             'timestamp': datetime.now().isoformat()
         }), 200
 
@@ -1280,14 +1546,69 @@ def get_headers():
         'Content-Type': 'application/json'
     }
 
+def jerarquia_vigente(scopes):
+    """True si todos los ámbitos de la jerarquía se sincronizaron hace menos de HIERARCHY_CACHE_TTL_SECONDS"""
+    for scope in scopes:
+        edad = db.get_scope_sync_age(scope)
+        if edad is None or edad > HIERARCHY_CACHE_TTL_SECONDS:
+            return False
+    return True
+
+
+def scope_jerarquia(tipo, objeto_id, headers):
+    """
+    Ámbito de vigencia de la jerarquía ('team' o 'space') para el token de headers.
+
+    Cada usuario entra con su propio token de ClickUp y solo ve sus espacios y
+    listas, así que la vigencia se lleva por usuario (los webhooks la invalidan
+    para todos).
+    """
+    return f'hierarchy:{tipo}:{objeto_id}:{rate_limit_key(headers)}'
+
+
+def invalidar_jerarquia(space_id=None):
+    """Invalida las carpetas y listas cacheadas de un espacio para todos los usuarios (de todos si no se conoce)"""
+    db.invalidate_sync_scopes(f'hierarchy:space:{space_id}:%' if space_id else 'hierarchy:space:%')
+
+
+def obtener_espacios_locales(headers):
+    """
+    Espacios del usuario desde la BD, o None si hay que pedirlos a ClickUp.
+
+    Qué teams y espacios ve el usuario se guarda en su sesión en la última
+    consulta en vivo; los datos de cada espacio salen de la tabla spaces.
+    """
+    team_ids = session.get('hierarchy_team_ids')
+    space_ids = session.get('hierarchy_space_ids')
+    if team_ids is None or space_ids is None:
+        return None
+    if not jerarquia_vigente([scope_jerarquia('team', team_id, headers) for team_id in team_ids]):
+        return None
+
+    guardados = {space['id']: space for space in db.get_all_spaces()}
+    if any(space_id not in guardados for space_id in space_ids):
+        return None
+    return [{
+        'id': space_id,
+        'name': guardados[space_id]['name'],
+        'team_id': guardados[space_id]['team_id']
+    } for space_id in space_ids]
+
+
 @app.route('/api/spaces')
 def get_spaces():
+    """Espacios de los teams del usuario; desde la BD si la jerarquía está vigente (?refresh=1 fuerza ClickUp)"""
     try:
         headers = get_headers()
         if not headers:
             return jsonify({'error': 'No autenticado', 'redirect': '/login'}), 401
 
-        teams_response = requests.get('https://api.clickup.com/api/v2/team', headers=headers, timeout=10)
+        if not request.args.get('refresh'):
+            espacios = obtener_espacios_locales(headers)
+            if espacios is not None:
+                return jsonify({'spaces': espacios, 'source': 'local'})
+
+        teams_response = clickup_get('/team', headers=headers, timeout=10)
 
         if teams_response.status_code == 401:
             session.clear()
@@ -1303,9 +1624,10 @@ def get_spaces():
         teams = teams_response.json()['teams']
 
         all_spaces = []
+        completo = True
         for team in teams:
-            spaces_response = requests.get(
-                f'https://api.clickup.com/api/v2/team/{team["id"]}/space',
+            spaces_response = clickup_get(
+                f'/team/{team["id"]}/space',
                 headers=headers,
                 timeout=10
             )
@@ -1323,20 +1645,85 @@ def get_spaces():
                     db.save_space(space['id'], space['name'], team['id'], metadata=space)
                     print(f"[INFO] Espacio {space['id']} guardado en BD: {space['name']}")
 
-        return jsonify({'spaces': all_spaces})
+                # El team está completo para este usuario: marcarlo como sincronizado. Los espacios
+                # que no devuelve no se borran (puede ser que no tenga acceso); los borra el webhook
+                db.mark_scope_synced(scope_jerarquia('team', team['id'], headers))
+            else:
+                completo = False
+
+        if completo:
+            session['hierarchy_team_ids'] = [team['id'] for team in teams]
+            session['hierarchy_space_ids'] = [space['id'] for space in all_spaces]
+
+        return jsonify({'spaces': all_spaces, 'source': 'live'})
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def obtener_proyectos_locales(space_id, headers):
+    """
+    Carpetas y listas de un espacio desde la BD, con la misma forma que
+    sync_projects_from_api, o None si hay que pedirlas a ClickUp.
+
+    Solo se devuelven las que ClickUp le devolvió a este usuario en su última
+    consulta en vivo del espacio (jerarquia_visible).
+    """
+    visible = jerarquia_visible.get(f'{rate_limit_key(headers)}:{space_id}')
+    if visible is None:
+        return None
+    visibles_folders, visibles_listas = set(visible['folder_ids']), set(visible['list_ids'])
+    folders, listas = db.get_space_hierarchy(space_id)
+    folders = [folder for folder in folders if folder['id'] in visibles_folders]
+    listas = [lista for lista in listas if lista['id'] in visibles_listas]
+    folder_ids = {folder['id'] for folder in folders}
+
+    proyectos = []
+    for folder in folders:
+        proyectos.append({
+            'id': f'folder_{folder["id"]}',
+            'name': f'📁 {folder["name"]}',
+            'type': 'folder',
+            'folder_id': folder['id']
+        })
+        for lista in listas:
+            if lista['folder_id'] == folder['id']:
+                proyectos.append({
+                    'id': f'list_{lista["id"]}',
+                    'name': f'  📄 {lista["name"]}',
+                    'type': 'list',
+                    'list_id': lista['id']
+                })
+
+    for lista in listas:
+        if lista['folder_id'] not in folder_ids:
+            proyectos.append({
+                'id': f'list_{lista["id"]}',
+                'name': f'📄 {lista["name"]}',
+                'type': 'list',
+                'list_id': lista['id']
+            })
+    return proyectos
+
+
 @app.route('/api/space/<space_id>/projects')
 def get_projects(space_id):
-    """Obtiene todas las carpetas y listas de un espacio, siempre sincronizando desde la API de ClickUp"""
+    """
+    Obtiene todas las carpetas y listas de un espacio
+
+    Si este usuario sincronizó la jerarquía del espacio hace menos de
+    HIERARCHY_CACHE_TTL_SECONDS (y ningún webhook la invalidó) se responde desde
+    la BD sin llamar a ClickUp; si no, o con ?refresh=1, se sincroniza desde la API.
+    """
     try:
         headers = get_headers()
         if not headers:
             return jsonify({'error': 'No autenticado', 'redirect': '/login'}), 401
 
-        # Siempre sincronizar desde la API para obtener datos actualizados
+        if not request.args.get('refresh') and jerarquia_vigente([scope_jerarquia('space', space_id, headers)]):
+            proyectos = obtener_proyectos_locales(space_id, headers)
+            if proyectos is not None:
+                return jsonify({'projects': proyectos, 'source': 'local'})
+
         print(f"[INFO] Sincronizando proyectos desde API para space {space_id}...")
         return sync_projects_from_api(space_id, headers)
 
@@ -1345,14 +1732,30 @@ def get_projects(space_id):
         return jsonify({'error': str(e)}), 500
 
 
+def marcar_jerarquia_sincronizada(space_id, folder_ids, list_ids, headers):
+    """
+    Tras una sincronización completa de un espacio: guarda qué carpetas y listas
+    ve este usuario y marca el espacio como vigente para él.
+
+    Lo que ClickUp no devuelve no se borra: puede ser que este usuario no tenga
+    acceso. Las bajas reales llegan por webhook (folderDeleted, listDeleted...).
+    """
+    jerarquia_visible.set(f'{rate_limit_key(headers)}:{space_id}',
+                          {'folder_ids': list(folder_ids), 'list_ids': list(list_ids)})
+    db.mark_scope_synced(scope_jerarquia('space', space_id, headers))
+
+
 def sync_projects_from_api(space_id, headers):
     """Sincroniza proyectos desde la API de ClickUp y los guarda en la BD"""
     try:
         proyectos = []
+        folder_ids = []
+        list_ids = []
+        completo = True
 
         # Obtener folders del space desde la API
-        folders_response = requests.get(
-            f'https://api.clickup.com/api/v2/space/{space_id}/folder',
+        folders_response = clickup_get(
+            f'/space/{space_id}/folder',
             headers=headers,
             timeout=10
         )
@@ -1362,6 +1765,7 @@ def sync_projects_from_api(space_id, headers):
             for folder in folders:
                 # Guardar folder en BD
                 db.save_folder(folder['id'], folder['name'], space_id, folder.get('hidden', False), metadata=folder)
+                folder_ids.append(folder['id'])
 
                 proyectos.append({
                     'id': f'folder_{folder["id"]}',
@@ -1371,8 +1775,8 @@ def sync_projects_from_api(space_id, headers):
                 })
 
                 # Obtener las listas dentro de cada folder
-                folder_lists_response = requests.get(
-                    f'https://api.clickup.com/api/v2/folder/{folder["id"]}/list',
+                folder_lists_response = clickup_get(
+                    f'/folder/{folder["id"]}/list',
                     headers=headers,
                     timeout=10
                 )
@@ -1381,6 +1785,7 @@ def sync_projects_from_api(space_id, headers):
                         # Guardar lista en BD
                         db.save_list(lista['id'], lista['name'], space_id, folder['id'],
                                    lista.get('archived', False), metadata=lista)
+                        list_ids.append(lista['id'])
 
                         proyectos.append({
                             'id': f'list_{lista["id"]}',
@@ -1388,10 +1793,14 @@ def sync_projects_from_api(space_id, headers):
                             'type': 'list',
                             'list_id': lista['id']
                         })
+                else:
+                    completo = False
+        else:
+            completo = False
 
         # Obtener listas sin folder (directamente en el space)
-        lists_response = requests.get(
-            f'https://api.clickup.com/api/v2/space/{space_id}/list',
+        lists_response = clickup_get(
+            f'/space/{space_id}/list',
             headers=headers,
             timeout=10
         )
@@ -1402,6 +1811,7 @@ def sync_projects_from_api(space_id, headers):
                 # Guardar lista en BD
                 db.save_list(lista['id'], lista['name'], space_id, None,
                            lista.get('archived', False), metadata=lista)
+                list_ids.append(lista['id'])
 
                 proyectos.append({
                     'id': f'list_{lista["id"]}',
@@ -1409,28 +1819,135 @@ def sync_projects_from_api(space_id, headers):
                     'type': 'list',
                     'list_id': lista['id']
                 })
+        else:
+            completo = False
+
+        if completo:
+            marcar_jerarquia_sincronizada(space_id, folder_ids, list_ids, headers)
 
         print(f"[INFO] Proyectos sincronizados desde API para space {space_id}")
-        return jsonify({'projects': proyectos})
+        return jsonify({'projects': proyectos, 'source': 'live'})
 
     except Exception as e:
         print(f"[ERROR] Error al sincronizar proyectos: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Listas que este proceso está refrescando en segundo plano (evita refrescos duplicados)
+_listas_refrescando = set()
+_listas_refrescando_lock = threading.Lock()
+
+
+def refrescar_listas_en_segundo_plano(list_ids, headers):
+    """
+    Sincroniza las listas desde ClickUp en un hilo aparte.
+
+    Returns:
+        bool: True si hay un refresco en curso para alguna de las listas
+    """
+    with _listas_refrescando_lock:
+        pendientes = [lista_id for lista_id in list_ids if lista_id not in _listas_refrescando]
+        _listas_refrescando.update(pendientes)
+        en_curso = any(lista_id in _listas_refrescando for lista_id in list_ids)
+    if not pendientes:
+        return en_curso
+
+    def _refrescar():
+        try:
+            for lista_id, total, error in run_parallel(lambda lista_id: sincronizar_tareas_de_lista(lista_id, headers), pendientes):
+                if error:
+                    print(f"[ERROR] Error al refrescar la lista {lista_id} en segundo plano: {str(error)}")
+                else:
+                    print(f"[INFO] Lista {lista_id} refrescada en segundo plano: {total} tareas")
+        finally:
+            with _listas_refrescando_lock:
+                _listas_refrescando.difference_update(pendientes)
+
+    threading.Thread(target=_refrescar, name='project-refresh', daemon=True).start()
+    return True
+
+
+def _fecha_actualizacion_utc(value):
+    """date_updated de la BD (hora local sin zona) en ISO UTC con 'Z', como la respuesta de ClickUp"""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return value
+    return dt.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+
+
+def obtener_tareas_locales(list_ids):
+    """Tareas de las listas desde la BD, en el mismo formato que obtener_tareas_de_lista"""
+    filas = db.get_tasks_by_lists(list_ids)
+    tiempos = db.get_time_tracking_bulk([fila['id'] for fila in filas])
+
+    tareas = []
+    for fila in filas:
+        tiempo = tiempos.get(fila['id'], {})
+        tiempo_total_segundos = tiempo.get('total_seconds', 0)
+        tareas.append({
+            'id': fila['id'],
+            'nombre': fila['name'],
+            'estado': fila['status'],
+            'estado_texto': fila['status_text'] or 'Sin estado',
+            'url': fila['url'],
+            'fecha_actualizacion': _fecha_actualizacion_utc(fila['date_updated']),
+            'horas_trabajadas': int(tiempo_total_segundos // 3600),
+            'minutos_trabajados': int((tiempo_total_segundos % 3600) // 60),
+            'tiempo_total_segundos': tiempo_total_segundos,
+            'sesion_actual_inicio': tiempo.get('current_session_start'),
+            'actualmente_en_progreso': tiempo.get('is_currently_in_progress', False),
+            'alerta': alertas_tareas.get(fila['id'], {
+                'aviso_activado': False,
+                'email_aviso': '',
+                'aviso_horas': 0,
+                'aviso_minutos': 0
+            })
+        })
+    return tareas
+
+
 @app.route('/api/project/<project_type>/<project_id>/tasks')
 def get_project_tasks(project_type, project_id):
-    """Obtiene las tareas de un proyecto específico (folder o list)"""
+    """
+    Obtiene las tareas de un proyecto específico (folder o list)
+
+    En modo local responde desde la BD y, si los datos superan la ventana de
+    frescura, lanza un refresco desde ClickUp en segundo plano. La respuesta
+    indica el origen (source), la antigüedad de los datos (data_age_seconds) y
+    si hay un refresco en curso (refreshing).
+    """
     try:
         headers = get_headers()
         if not headers:
             return jsonify({'error': 'No autenticado', 'redirect': '/login'}), 401
 
+        if request.args.get('source', PROJECT_TASKS_MODE) == 'local':
+            if project_type == 'folder':
+                list_ids = [lista['id'] for lista in db.get_lists_by_folder(project_id)]
+            else:
+                list_ids = [project_id]
+
+            edades = db.get_lists_sync_age(list_ids) if list_ids else {}
+            # Solo si todas las listas se sincronizaron alguna vez; si no, consulta en vivo
+            if list_ids and all(edades.get(lista_id) is not None for lista_id in list_ids):
+                antiguas = [lista_id for lista_id in list_ids if edades[lista_id] > PROJECT_TASKS_MAX_AGE_SECONDS]
+                refrescando = refrescar_listas_en_segundo_plano(antiguas, headers) if antiguas else False
+
+                return jsonify({
+                    'tasks': obtener_tareas_locales(list_ids),
+                    'source': 'local',
+                    'data_age_seconds': int(max(edades.values())),
+                    'refreshing': refrescando
+                })
+
         todas_tareas = []
 
         if project_type == 'folder':
             # Si es un folder, obtener todas las listas del folder
-            folder_lists_response = requests.get(
-                f'https://api.clickup.com/api/v2/folder/{project_id}/list',
+            folder_lists_response = clickup_get(
+                f'/folder/{project_id}/list',
                 headers=headers,
                 timeout=10
             )
@@ -1443,7 +1960,7 @@ def get_project_tasks(project_type, project_id):
             tareas = obtener_tareas_de_lista(project_id, headers)
             todas_tareas.extend(tareas)
 
-        return jsonify({'tasks': todas_tareas})
+        return jsonify({'tasks': todas_tareas, 'source': 'live', 'data_age_seconds': 0, 'refreshing': False})
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1456,14 +1973,14 @@ def get_lists(space_id):
         if not headers:
             return jsonify({'error': 'No autenticado', 'redirect': '/login'}), 401
 
-        folders_response = requests.get(
-            f'https://api.clickup.com/api/v2/space/{space_id}/folder',
+        folders_response = clickup_get(
+            f'/space/{space_id}/folder',
             headers=headers,
             timeout=10
         )
 
-        lists_response = requests.get(
-            f'https://api.clickup.com/api/v2/space/{space_id}/list',
+        lists_response = clickup_get(
+            f'/space/{space_id}/list',
             headers=headers,
             timeout=10
         )
@@ -1479,8 +1996,8 @@ def get_lists(space_id):
         if folders_response.status_code == 200:
             folders = folders_response.json()['folders']
             for folder in folders:
-                folder_lists = requests.get(
-                    f'https://api.clickup.com/api/v2/folder/{folder["id"]}/list',
+                folder_lists = clickup_get(
+                    f'/folder/{folder["id"]}/list',
                     headers=headers,
                     timeout=10
                 )
@@ -1516,6 +2033,55 @@ def calcular_tiempo_en_progreso(tarea_id, estado_actual, headers):
         traceback.print_exc()
         return 0, 0
 
+def _interpretar_time_in_status(task_id, data):
+    """
+    Extrae de una respuesta de Time in Status el tiempo en el estado actual.
+
+    Returns:
+        tuple: (tiempo_en_segundos, timestamp_inicio_calculado) o (None, None) si no se encuentra
+    """
+    # La estructura de respuesta puede variar, intentar diferentes formatos
+    time_in_current_ms = None
+
+    # Intentar obtener el tiempo del estado actual desde diferentes estructuras posibles
+    # Formato 1: current_status.total_time
+    if 'current_status' in data:
+        current_status = data['current_status']
+        if isinstance(current_status, dict):
+            total_time = current_status.get('total_time')
+            if isinstance(total_time, dict):
+                time_in_current_ms = total_time.get('by_minute') or total_time.get('total')
+            elif isinstance(total_time, (int, float)):
+                time_in_current_ms = total_time
+
+    # Formato 2: status_history con el último estado
+    if time_in_current_ms is None and 'status_history' in data:
+        history = data['status_history']
+        if isinstance(history, list) and len(history) > 0:
+            last_status = history[-1]
+            if isinstance(last_status, dict):
+                time_in_current_ms = last_status.get('total_time') or last_status.get('duration')
+
+    # Formato 3: respuesta directa con 'time' o 'duration'
+    if time_in_current_ms is None:
+        time_in_current_ms = data.get('time') or data.get('duration') or data.get('total_time')
+
+    if time_in_current_ms:
+        # Convertir a segundos (asumiendo que viene en milisegundos)
+        time_in_current_seconds = int(time_in_current_ms) / 1000 if time_in_current_ms > 10000 else int(time_in_current_ms)
+
+        # Calcular el timestamp de inicio restando el tiempo del timestamp actual
+        now = datetime.utcnow()
+        start_timestamp = now - timedelta(seconds=time_in_current_seconds)
+        start_timestamp_iso = start_timestamp.isoformat() + 'Z'
+
+        print(f"[INFO] Tarea {task_id}: Tiempo en estado actual desde API: {time_in_current_seconds}s, inicio calculado: {start_timestamp_iso}")
+        return time_in_current_seconds, start_timestamp_iso
+
+    print(f"[WARNING] No se pudo extraer el tiempo del estado actual de la respuesta para tarea {task_id}")
+    return None, None
+
+
 def get_task_time_in_current_status(task_id, headers):
     """
     Obtiene el tiempo que una tarea ha estado en su estado actual usando la API de ClickUp.
@@ -1525,8 +2091,8 @@ def get_task_time_in_current_status(task_id, headers):
         tuple: (tiempo_en_segundos, timestamp_inicio_calculado) o (None, None) si falla
     """
     try:
-        response = requests.get(
-            f'https://api.clickup.com/api/v2/task/{task_id}/time_in_status',
+        response = clickup_get(
+            f'/task/{task_id}/time_in_status',
             headers=headers,
             timeout=10
         )
@@ -1534,46 +2100,7 @@ def get_task_time_in_current_status(task_id, headers):
         if response.status_code == 200:
             data = response.json()
             print(f"[DEBUG] Time in Status API response para tarea {task_id}: {json.dumps(data, indent=2)}")
-
-            # La estructura de respuesta puede variar, intentar diferentes formatos
-            time_in_current_ms = None
-
-            # Intentar obtener el tiempo del estado actual desde diferentes estructuras posibles
-            # Formato 1: current_status.total_time
-            if 'current_status' in data:
-                current_status = data['current_status']
-                if isinstance(current_status, dict):
-                    total_time = current_status.get('total_time')
-                    if isinstance(total_time, dict):
-                        time_in_current_ms = total_time.get('by_minute') or total_time.get('total')
-                    elif isinstance(total_time, (int, float)):
-                        time_in_current_ms = total_time
-
-            # Formato 2: status_history con el último estado
-            if time_in_current_ms is None and 'status_history' in data:
-                history = data['status_history']
-                if isinstance(history, list) and len(history) > 0:
-                    last_status = history[-1]
-                    if isinstance(last_status, dict):
-                        time_in_current_ms = last_status.get('total_time') or last_status.get('duration')
-
-            # Formato 3: respuesta directa con 'time' o 'duration'
-            if time_in_current_ms is None:
-                time_in_current_ms = data.get('time') or data.get('duration') or data.get('total_time')
-
-            if time_in_current_ms:
-                # Convertir a segundos (asumiendo que viene en milisegundos)
-                time_in_current_seconds = int(time_in_current_ms) / 1000 if time_in_current_ms > 10000 else int(time_in_current_ms)
-
-                # Calcular el timestamp de inicio restando el tiempo del timestamp actual
-                now = datetime.utcnow()
-                start_timestamp = now - timedelta(seconds=time_in_current_seconds)
-                start_timestamp_iso = start_timestamp.isoformat() + 'Z'
-
-                print(f"[INFO] Tarea {task_id}: Tiempo en estado actual desde API: {time_in_current_seconds}s, inicio calculado: {start_timestamp_iso}")
-                return time_in_current_seconds, start_timestamp_iso
-            else:
-                print(f"[WARNING] No se pudo extraer el tiempo del estado actual de la respuesta para tarea {task_id}")
+            return _interpretar_time_in_status(task_id, data)
 
         elif response.status_code == 404:
             print(f"[WARNING] Time in Status no disponible para tarea {task_id} (puede no estar habilitado o no soportado en el plan)")
@@ -1592,196 +2119,363 @@ def get_task_time_in_current_status(task_id, headers):
     return None, None
 
 
-def obtener_tareas_de_lista(lista_id, headers):
-    """Obtiene todas las tareas de una lista con su estado, fechas de comienzo y término"""
-    try:
-        print(f"[INFO] Obteniendo tareas de la lista {lista_id}")
-        tasks_response = requests.get(
-            f'https://api.clickup.com/api/v2/list/{lista_id}/task',
-            headers=headers,
-            params={'include_closed': 'true'},
-            timeout=10
-        )
+# ClickUp acepta como máximo 100 tareas por petición de bulk_time_in_status
+BULK_TIME_IN_STATUS_CHUNK = 100
 
-        tareas_procesadas = []
-
-        if tasks_response.status_code == 200:
-            tasks = tasks_response.json()['tasks']
-            print(f"[INFO] Se encontraron {len(tasks)} tareas en la lista {lista_id}")
-            for tarea in tasks:
-                # Determinar el estado de la tarea
-                status_type = tarea.get('status', {}).get('status', '').lower()
-                estado = 'pendiente'
-
-                # Los estados pueden variar, pero generalmente:
-                # - 'complete', 'closed' = completada
-                # - 'in progress', 'in review' = en progreso
-                # - todo lo demás = pendiente
-                if status_type in ['complete', 'closed', 'completed']:
-                    estado = 'completada'
-                elif 'progress' in status_type or 'review' in status_type or 'doing' in status_type:
-                    estado = 'en_progreso'
-
-                # Fecha de última actualización (enviar como ISO con timezone para conversión en cliente)
-                fecha_actualizacion_dt = datetime.utcfromtimestamp(int(tarea['date_updated']) / 1000)
-                fecha_actualizacion = fecha_actualizacion_dt.isoformat() + 'Z'
-
-                # Guardar tarea en la base de datos PRIMERO (necesario para calcular tiempo)
-                task_data = {
-                    'id': tarea['id'],
-                    'name': tarea['name'],
-                    'list_id': lista_id,
-                    'status': estado,
-                    'status_text': tarea.get('status', {}).get('status', 'Sin estado'),
-                    'url': tarea['url'],
-                    'description': tarea.get('description', ''),
-                    'priority': tarea.get('priority', {}).get('priority') if isinstance(tarea.get('priority'), dict) else tarea.get('priority'),
-                    'assignees': tarea.get('assignees', []),
-                    'date_created': parse_date_flexible(tarea.get('date_created')),
-                    'date_updated': parse_date_flexible(tarea.get('date_updated')),
-                    'due_date': parse_date_flexible(tarea.get('due_date')),
-                    'start_date': parse_date_flexible(tarea.get('start_date')),
-                    'time_estimate': tarea.get('time_estimate'),
-                    'time_spent': tarea.get('time_spent'),
-                    'tags': tarea.get('tags', []),
-                    'custom_fields': tarea.get('custom_fields', []),
-                    'metadata': tarea
-                }
+# Tokens cuya cuenta no tiene acceso al endpoint bulk (403/404): usan el endpoint por
+# tarea hasta que caduca la entrada, por si cambia el plan de la cuenta
+BULK_TIME_IN_STATUS_RETRY_SECONDS = int(os.getenv('BULK_TIME_IN_STATUS_RETRY_SECONDS', '3600'))
+bulk_time_in_status_no_disponible = create_cache('bulk_time_in_status_off', max_entries=1000,
+                                                 ttl_seconds=BULK_TIME_IN_STATUS_RETRY_SECONDS)
 
-                # Verificar si la tarea existe para detectar cambio de estado
-                old_task = db.get_task(tarea['id'])
-                old_status = old_task.get('status') if old_task else None
-
-                # Guardar la tarea
-                db.save_task(task_data)
-                print(f"[INFO] Tarea {tarea['id']} guardada en BD: {tarea['name']}")
-
-                # IMPORTANTE: Registrar cambio de estado ANTES de calcular tiempo
-                # Esto asegura que el historial esté completo cuando se calcula el tiempo
-                if old_status != estado:
-                    print(f"[INFO] Detectado cambio de estado para tarea {tarea['id']}: '{old_status}' → '{estado}'")
-
-                    # Determinar el timestamp correcto del cambio
-                    if estado == 'en_progreso' and old_status != 'en_progreso':
-                        # Tarea entrando a "en_progreso": intentar obtener el tiempo real desde ClickUp
-                        time_in_status, calculated_start = get_task_time_in_current_status(tarea['id'], headers)
-
-                        if calculated_start:
-                            # Usar el timestamp calculado desde la API de Time in Status
-                            changed_at = calculated_start
-                            print(f"[INFO] Tarea cambiando A 'en_progreso', usando timestamp desde Time in Status API: {changed_at}")
-                        else:
-                            # Fallback: usar date_updated como aproximación
-                            changed_at = fecha_actualizacion
-                            print(f"[INFO] Tarea cambiando A 'en_progreso', Time in Status no disponible, usando date_updated: {changed_at}")
-
-                    elif old_status == 'en_progreso' and estado != 'en_progreso':
-                        # Tarea saliendo DE "en_progreso": usar date_updated
-                        changed_at = fecha_actualizacion
-                        print(f"[INFO] Tarea cambiando DESDE 'en_progreso' a '{estado}', usando date_updated: {changed_at}")
-                    else:
-                        # Otros cambios: usar date_updated
-                        changed_at = parse_date_flexible(tarea.get('date_updated'))
-                        print(f"[INFO] Usando date_updated para cambio: {changed_at}")
-
-                    db.save_status_change(
-                        task_id=tarea['id'],
-                        old_status=old_status,
-                        new_status=estado,
-                        old_status_text=old_task.get('status_text') if old_task else None,
-                        new_status_text=task_data['status_text'],
-                        changed_at=changed_at
-                    )
-                    print(f"[INFO] Cambio de estado registrado en historial: {tarea['id']}")
-                elif estado == 'en_progreso':
-                    # Si la tarea ya estaba en progreso, verificar si tiene historial
-                    # Si no tiene historial de entrada a "en_progreso", crear uno usando Time in Status de ClickUp
-                    history = db.get_status_history(tarea['id'])
-                    has_progress_entry = any(h['new_status'] == 'en_progreso' for h in history)
-                    if not has_progress_entry:
-                        # Intentar obtener el tiempo exacto desde la API de ClickUp
-                        time_in_status, calculated_start = get_task_time_in_current_status(tarea['id'], headers)
-
-                        if calculated_start:
-                            # Usar el timestamp calculado desde la API de Time in Status
-                            changed_at = calculated_start
-                            print(f"[INFO] Usando timestamp calculado desde Time in Status API: {changed_at}")
-                        else:
-                            # Fallback: usar date_updated si la API no está disponible
-                            changed_at = fecha_actualizacion
-                            print(f"[INFO] Time in Status API no disponible, usando date_updated como fallback: {changed_at}")
-
-                        db.save_status_change(
-                            task_id=tarea['id'],
-                            old_status=None,
-                            new_status=estado,
-                            old_status_text=None,
-                            new_status_text=task_data['status_text'],
-                            changed_at=changed_at
-                        )
-                        print(f"[INFO] Creado registro inicial para tarea en progreso: {tarea['id']} con timestamp: {changed_at}")
-
-                # Calcular tiempo en estado "in progress" usando el historial
-                # NOTA: Esto se hace DESPUÉS de registrar el cambio de estado para que el tiempo sea correcto
-                print(f"[INFO] Calculando tiempo para tarea: {tarea['name']} (ID: {tarea['id']})")
-
-                # Obtener información completa del tiempo en progreso
-                try:
-                    time_data = db.calculate_task_time_in_progress(tarea['id'])
-                    tiempo_total_segundos = time_data['total_seconds']
-                    sesion_actual_inicio = time_data['current_session_start']
-                    actualmente_en_progreso = time_data['is_currently_in_progress']
 
-                    # Calcular horas y minutos para compatibilidad
-                    horas_trabajadas = int(tiempo_total_segundos // 3600)
-                    minutos_trabajados = int((tiempo_total_segundos % 3600) // 60)
+def get_tasks_time_in_current_status(task_ids, headers):
+    """
+    Obtiene el tiempo en el estado actual de varias tareas con el endpoint
+    bulk_time_in_status de ClickUp (en bloques de 100 tareas).
 
-                    print(f"[INFO] Tiempo calculado para tarea {tarea['id']}: {horas_trabajadas}h {minutos_trabajados}m (total: {tiempo_total_segundos}s, en progreso: {actualmente_en_progreso})")
-                except Exception as e:
-                    # Si hay error al calcular tiempo, usar valores por defecto para no bloquear el listado de tareas
-                    print(f"[ERROR] Error al calcular tiempo para tarea {tarea['id']}: {str(e)}")
-                    import traceback
-                    traceback.print_exc()
-                    # Valores por defecto
-                    tiempo_total_segundos = 0
-                    sesion_actual_inicio = None
-                    actualmente_en_progreso = False
-                    horas_trabajadas = 0
-                    minutos_trabajados = 0
-                    print(f"[WARNING] Usando valores por defecto para tarea {tarea['id']} para evitar bloqueo del listado")
-
-                # Obtener configuración de alerta para esta tarea desde el diccionario en memoria
-                alerta_config = alertas_tareas.get(tarea['id'], {
-                    'aviso_activado': False,
-                    'email_aviso': '',
-                    'aviso_horas': 0,
-                    'aviso_minutos': 0
-                })
+    Si el endpoint bulk no está disponible para la cuenta del token, se usa
+    get_task_time_in_current_status tarea a tarea. Si el token no es válido (401)
+    no se sigue pidiendo nada: todas las tareas quedan sin datos.
 
-                tareas_procesadas.append({
-                    'id': tarea['id'],
-                    'nombre': tarea['name'],
-                    'estado': estado,
-                    'estado_texto': tarea.get('status', {}).get('status', 'Sin estado'),
-                    'url': tarea['url'],
-                    'fecha_actualizacion': fecha_actualizacion,
-                    'horas_trabajadas': int(horas_trabajadas),
-                    'minutos_trabajados': int(minutos_trabajados),
-                    # Información completa para cálculo en tiempo real en el frontend
-                    'tiempo_total_segundos': tiempo_total_segundos,
-                    'sesion_actual_inicio': sesion_actual_inicio,
-                    'actualmente_en_progreso': actualmente_en_progreso,
-                    'alerta': alerta_config
-                })
+    Returns:
+        dict: {task_id: (tiempo_en_segundos, timestamp_inicio_calculado)}; (None, None) si no se pudo obtener
+    """
+    task_ids = list(dict.fromkeys(task_ids))
+    resultados = {}
+    pendientes = []
+    token_key = rate_limit_key(headers)
+    bulk_disponible = not bulk_time_in_status_no_disponible.get(token_key, False)
+
+    for i in range(0, len(task_ids), BULK_TIME_IN_STATUS_CHUNK):
+        bloque = task_ids[i:i + BULK_TIME_IN_STATUS_CHUNK]
+        if not bulk_disponible:
+            pendientes.extend(bloque)
+            continue
+
+        try:
+            response = clickup_get(
+                '/task/bulk_time_in_status/task_ids',
+                headers=headers,
+                params={'task_ids': bloque},
+                timeout=10
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"[WARNING] Error en bulk time in status ({len(bloque)} tareas): {str(e)}")
+            pendientes.extend(bloque)
+            continue
+
+        if response.status_code == 200:
+            data = response.json()
+            for task_id in bloque:
+                task_data = data.get(task_id)
+                resultados[task_id] = _interpretar_time_in_status(task_id, task_data) if isinstance(task_data, dict) else (None, None)
+            print(f"[INFO] Time in Status obtenido en bloque para {len(bloque)} tareas")
+        elif response.status_code == 401:
+            # Token caducado o revocado: el endpoint por tarea fallaría igual
+            print("[WARNING] Token no autorizado (401) en bulk time in status, se omite el Time in Status")
+            for task_id in task_ids:
+                resultados.setdefault(task_id, (None, None))
+            return resultados
+        elif response.status_code in (403, 404):
+            # Endpoint no disponible para la cuenta/plan de este token: usar el endpoint por tarea
+            print(f"[WARNING] bulk_time_in_status no disponible ({response.status_code}), usando Time in Status por tarea")
+            bulk_time_in_status_no_disponible.set(token_key, True)
+            bulk_disponible = False
+            pendientes.extend(bloque)
+        else:
+            print(f"[WARNING] Error en bulk time in status: {response.status_code}, usando Time in Status por tarea")
+            pendientes.extend(bloque)
+
+    for task_id in pendientes:
+        resultados[task_id] = get_task_time_in_current_status(task_id, headers)
+
+    return resultados
+
+
+def procesar_pagina_tareas(lista_id, tasks, headers):
+    """
+    Procesa y persiste una página de tareas de una lista de ClickUp.
+
+    Detecta cambios de estado, guarda tareas e historial en una única
+    transacción y devuelve las tareas con su tiempo en progreso y alertas.
+    """
+    tareas_procesadas = []
+
+    # 1. Preparar los datos de todas las tareas de la página
+    filas = []
+    for tarea in tasks:
+        # Determinar el estado de la tarea
+        status_type = tarea.get('status', {}).get('status', '').lower()
+        estado = 'pendiente'
+
+        # Los estados pueden variar, pero generalmente:
+        # - 'complete', 'closed' = completada
+        # - 'in progress', 'in review' = en progreso
+        # - todo lo demás = pendiente
+        if status_type in ['complete', 'closed', 'completed']:
+            estado = 'completada'
+        elif 'progress' in status_type or 'review' in status_type or 'doing' in status_type:
+            estado = 'en_progreso'
+
+        # Fecha de última actualización (enviar como ISO con timezone para conversión en cliente)
+        fecha_actualizacion_dt = datetime.utcfromtimestamp(int(tarea['date_updated']) / 1000)
+        fecha_actualizacion = fecha_actualizacion_dt.isoformat() + 'Z'
+
+        task_data = {
+            'id': tarea['id'],
+            'name': tarea['name'],
+            'list_id': lista_id,
+            'status': estado,
+            'status_text': tarea.get('status', {}).get('status', 'Sin estado'),
+            'url': tarea['url'],
+            'description': tarea.get('description', ''),
+            'priority': tarea.get('priority', {}).get('priority') if isinstance(tarea.get('priority'), dict) else tarea.get('priority'),
+            'assignees': tarea.get('assignees', []),
+            'date_created': parse_date_flexible(tarea.get('date_created')),
+            'date_updated': parse_date_flexible(tarea.get('date_updated')),
+            'due_date': parse_date_flexible(tarea.get('due_date')),
+            'start_date': parse_date_flexible(tarea.get('start_date')),
+            'time_estimate': tarea.get('time_estimate'),
+            'time_spent': tarea.get('time_spent'),
+            'tags': tarea.get('tags', []),
+            'custom_fields': tarea.get('custom_fields', []),
+            'metadata': tarea
+        }
+        filas.append((tarea, estado, fecha_actualizacion, task_data))
+
+    # 2. Estado anterior de todas las tareas en una sola consulta (para detectar cambios)
+    task_ids = [tarea['id'] for tarea, _, _, _ in filas]
+    estados_anteriores = db.get_tasks_status_map(task_ids)
+    sin_cambio_en_progreso = [
+        tarea['id'] for tarea, estado, _, _ in filas
+        if estado == 'en_progreso' and estados_anteriores.get(tarea['id'], {}).get('status') == 'en_progreso'
+    ]
+    con_historial_progreso = db.get_tasks_with_progress_entry(sin_cambio_en_progreso)
+
+    # Tareas que entran a "en_progreso" o que ya estaban sin historial de entrada:
+    # obtener su tiempo real en el estado con peticiones bulk a ClickUp
+    necesitan_time_in_status = [
+        tarea['id'] for tarea, estado, _, _ in filas
+        if estado == 'en_progreso' and (
+            estados_anteriores.get(tarea['id'], {}).get('status') != 'en_progreso'
+            or tarea['id'] not in con_historial_progreso
+        )
+    ]
+    tiempos_en_estado = get_tasks_time_in_current_status(necesitan_time_in_status, headers) if necesitan_time_in_status else {}
+
+    # 3. Calcular los cambios de estado a registrar
+    cambios_estado = []
+    for tarea, estado, fecha_actualizacion, task_data in filas:
+        old_task = estados_anteriores.get(tarea['id'])
+        old_status = old_task.get('status') if old_task else None
+
+        if old_status != estado:
+            print(f"[INFO] Detectado cambio de estado para tarea {tarea['id']}: '{old_status}' → '{estado}'")
+
+            # Determinar el timestamp correcto del cambio
+            if estado == 'en_progreso' and old_status != 'en_progreso':
+                # Tarea entrando a "en_progreso": intentar obtener el tiempo real desde ClickUp
+                time_in_status, calculated_start = tiempos_en_estado.get(tarea['id'], (None, None))
+
+                if calculated_start:
+                    # Usar el timestamp calculado desde la API de Time in Status
+                    changed_at = calculated_start
+                    print(f"[INFO] Tarea cambiando A 'en_progreso', usando timestamp desde Time in Status API: {changed_at}")
+                else:
+                    # Fallback: usar date_updated como aproximación
+                    changed_at = fecha_actualizacion
+                    print(f"[INFO] Tarea cambiando A 'en_progreso', Time in Status no disponible, usando date_updated: {changed_at}")
+
+            elif old_status == 'en_progreso' and estado != 'en_progreso':
+                # Tarea saliendo DE "en_progreso": usar date_updated
+                changed_at = fecha_actualizacion
+                print(f"[INFO] Tarea cambiando DESDE 'en_progreso' a '{estado}', usando date_updated: {changed_at}")
+            else:
+                # Otros cambios: usar date_updated
+                changed_at = parse_date_flexible(tarea.get('date_updated'))
+                print(f"[INFO] Usando date_updated para cambio: {changed_at}")
+
+            cambios_estado.append({
+                'task_id': tarea['id'],
+                'old_status': old_status,
+                'new_status': estado,
+                'old_status_text': old_task.get('status_text') if old_task else None,
+                'new_status_text': task_data['status_text'],
+                'changed_at': changed_at
+            })
+        elif estado == 'en_progreso' and tarea['id'] not in con_historial_progreso:
+            # La tarea ya estaba en progreso pero no tiene historial de entrada a "en_progreso":
+            # crear uno usando Time in Status de ClickUp
+            time_in_status, calculated_start = tiempos_en_estado.get(tarea['id'], (None, None))
+
+            if calculated_start:
+                # Usar el timestamp calculado desde la API de Time in Status
+                changed_at = calculated_start
+                print(f"[INFO] Usando timestamp calculado desde Time in Status API: {changed_at}")
+            else:
+                # Fallback: usar date_updated si la API no está disponible
+                changed_at = fecha_actualizacion
+                print(f"[INFO] Time in Status API no disponible, usando date_updated como fallback: {changed_at}")
+
+            cambios_estado.append({
+                'task_id': tarea['id'],
+                'old_status': None,
+                'new_status': estado,
+                'old_status_text': None,
+                'new_status_text': task_data['status_text'],
+                'changed_at': changed_at
+            })
+            print(f"[INFO] Creado registro inicial para tarea en progreso: {tarea['id']} con timestamp: {changed_at}")
+
+    # 4. Guardar tareas y cambios de estado en una única transacción
+    # IMPORTANTE: el historial debe estar completo ANTES de calcular el tiempo
+    guardadas, cambios = db.save_tasks_bulk([task_data for _, _, _, task_data in filas], cambios_estado)
+    print(f"[INFO] Lista {lista_id}: {guardadas} tareas y {cambios} cambios de estado guardados en BD")
+    alert_engine.refresh(cambio['task_id'] for cambio in cambios_estado)
+
+    # 5. Calcular tiempo en estado "in progress" usando el historial
+    for tarea, estado, fecha_actualizacion, task_data in filas:
+        # Obtener información completa del tiempo en progreso
+        try:
+            time_data = db.calculate_task_time_in_progress(tarea['id'])
+            tiempo_total_segundos = time_data['total_seconds']
+            sesion_actual_inicio = time_data['current_session_start']
+            actualmente_en_progreso = time_data['is_currently_in_progress']
+
+            # Calcular horas y minutos para compatibilidad
+            horas_trabajadas = int(tiempo_total_segundos // 3600)
+            minutos_trabajados = int((tiempo_total_segundos % 3600) // 60)
+        except Exception as e:
+            # Si hay error al calcular tiempo, usar valores por defecto para no bloquear el listado de tareas
+            print(f"[ERROR] Error al calcular tiempo para tarea {tarea['id']}: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            # Valores por defecto
+            tiempo_total_segundos = 0
+            sesion_actual_inicio = None
+            actualmente_en_progreso = False
+            horas_trabajadas = 0
+            minutos_trabajados = 0
+            print(f"[WARNING] Usando valores por defecto para tarea {tarea['id']} para evitar bloqueo del listado")
+
+        # Obtener configuración de alerta para esta tarea desde el diccionario en memoria
+        alerta_config = alertas_tareas.get(tarea['id'], {
+            'aviso_activado': False,
+            'email_aviso': '',
+            'aviso_horas': 0,
+            'aviso_minutos': 0
+        })
 
+        tareas_procesadas.append({
+            'id': tarea['id'],
+            'nombre': tarea['name'],
+            'estado': estado,
+            'estado_texto': tarea.get('status', {}).get('status', 'Sin estado'),
+            'url': tarea['url'],
+            'fecha_actualizacion': fecha_actualizacion,
+            'horas_trabajadas': int(horas_trabajadas),
+            'minutos_trabajados': int(minutos_trabajados),
+            # Información completa para cálculo en tiempo real en el frontend
+            'tiempo_total_segundos': tiempo_total_segundos,
+            'sesion_actual_inicio': sesion_actual_inicio,
+            'actualmente_en_progreso': actualmente_en_progreso,
+            'alerta': alerta_config
+        })
+
+    return tareas_procesadas
+
+
+def iterar_tareas_de_lista(lista_id, headers):
+    """
+    Generador que recorre todas las páginas de tareas de una lista.
+
+    Cada página se procesa y persiste en cuanto llega (mientras se descarga la
+    siguiente) y se produce la lista de tareas procesadas de esa página.
+    """
+    print(f"[INFO] Obteniendo tareas de la lista {lista_id}")
+    paginas = clickup_get_pages(
+        f'/list/{lista_id}/task',
+        headers=headers,
+        items_key='tasks',
+        params={'include_closed': 'true'}
+    )
+    for numero, tasks in enumerate(paginas):
+        print(f"[INFO] Página {numero} de la lista {lista_id}: {len(tasks)} tareas")
+        yield procesar_pagina_tareas(lista_id, tasks, headers)
+
+    # Todas las páginas procesadas: la copia local de la lista está al día
+    db.mark_scope_synced(f'list:{lista_id}')
+
+
+def obtener_tareas_de_lista(lista_id, headers):
+    """Obtiene todas las tareas de una lista con su estado, fechas de comienzo y término"""
+    tareas_procesadas = []
+    try:
+        for pagina in iterar_tareas_de_lista(lista_id, headers):
+            tareas_procesadas.extend(pagina)
+        print(f"[INFO] Se encontraron {len(tareas_procesadas)} tareas en la lista {lista_id}")
         return tareas_procesadas
 
     except requests.exceptions.RequestException as e:
         print(f"[ERROR] Error al obtener tareas de la lista {lista_id}: {str(e)}")
-        return []
+        return tareas_procesadas
     except Exception as e:
         print(f"[ERROR] Error inesperado en obtener_tareas_de_lista: {str(e)}")
-        return []
+        return tareas_procesadas
+
+
+def sincronizar_tareas_de_lista(lista_id, headers):
+    """
+    Sincroniza todas las tareas de una lista sin acumularlas en memoria.
+
+    Los errores de ClickUp se propagan para que el llamador no avance la marca
+    de sincronización incremental.
+
+    Returns:
+        int: número de tareas sincronizadas
+    """
+    total = 0
+    for pagina in iterar_tareas_de_lista(lista_id, headers):
+        total += len(pagina)
+    return total
+
+
+def sincronizar_tareas_de_equipo(team_id, headers, desde_ms):
+    """
+    Sincroniza solo las tareas del team actualizadas después de desde_ms,
+    usando el endpoint filtrado /team/{team_id}/task con date_updated_gt.
+
+    Returns:
+        tuple: (número de tareas sincronizadas, date_updated máximo visto en ms)
+    """
+    total = 0
+    max_date_updated = desde_ms
+    paginas = clickup_get_pages(
+        f'/team/{team_id}/task',
+        headers=headers,
+        items_key='tasks',
+        params={
+            'include_closed': 'true',
+            'date_updated_gt': max(0, desde_ms - SYNC_WATERMARK_OVERLAP_MS)
+        }
+    )
+    for tasks in paginas:
+        # El endpoint del team mezcla tareas de varias listas: procesarlas agrupadas por lista
+        tareas_por_lista = {}
+        for tarea in tasks:
+            lista_id = (tarea.get('list') or {}).get('id')
+            if lista_id:
+                tareas_por_lista.setdefault(lista_id, []).append(tarea)
+
+        for lista_id, tareas in tareas_por_lista.items():
+            procesar_pagina_tareas(lista_id, tareas, headers)
+            total += len(tareas)
+
+        max_date_updated = max(max_date_updated, max(int(tarea['date_updated']) for tarea in tasks))
+
+    print(f"[INFO] Team {team_id}: {total} tareas actualizadas desde la última sincronización")
+    return total, max_date_updated
 
 @app.route('/api/alerta/tarea/guardar', methods=['POST'])
 def guardar_alerta_tarea():
@@ -1798,6 +2492,7 @@ def guardar_alerta_tarea():
 
         # Guardar en base de datos
         db.save_task_alert(tarea_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta)
+        alert_engine.refresh([tarea_id])
 
         # Mantener también en memoria para compatibilidad
         alertas_tareas[tarea_id] = {
@@ -1845,8 +2540,70 @@ def obtener_alerta_tarea_endpoint(tarea_id):
         print(f"[ERROR] Error al obtener alerta de tarea: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def construir_email_alerta(tarea_nombre, proyecto_nombre, tarea_url, tiempo_en_progreso, tipo_alerta='sin_actualizar'):
+    """Construye el asunto y el HTML del email de alerta. Devuelve (subject, html_content)"""
+    # Personalizar el mensaje según el tipo de alerta
+    if tipo_alerta == 'sin_actualizar':
+        titulo_alerta = "Alerta: Tarea sin actualizar"
+        mensaje_tiempo = f"⏱️ Esta tarea lleva <strong>{tiempo_en_progreso}</strong> sin actualizaciones y ha superado el tiempo máximo configurado."
+    else:  # tiempo_total
+        titulo_alerta = "Alerta de Tiempo Total en Tarea"
+        mensaje_tiempo = f"⏱️ Esta tarea lleva <strong>{tiempo_en_progreso}</strong> en estado \"En Progreso\" y ha superado el tiempo máximo configurado."
+
+    # Crear el cuerpo del email en HTML
+    html_content = f"""
+    <html>
+      <head>
+        <style>
+          body {{ font-family: Arial, sans-serif; line-height: 1.6; }}
+          .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+          .header {{ background-color: #f8d7da; color: #721c24; padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
+          .content {{ background-color: #f9f9f9; padding: 20px; border-radius: 5px; }}
+          .btn {{ background-color: #667eea; color: white; padding: 12px 24px; text-decoration: none;
+                 border-radius: 5px; display: inline-block; margin-top: 15px; }}
+          .footer {{ color: #666; font-size: 12px; margin-top: 20px; padding-top: 20px; border-top: 1px solid #ddd; }}
+          .warning-icon {{ font-size: 48px; margin-bottom: 10px; }}
+        </style>
+      </head>
+      <body>
+        <div class="container">
+          <div class="header">
+            <div class="warning-icon">⚠️</div>
+            <h2 style="margin: 0;">{titulo_alerta}</h2>
+          </div>
+          <div class="content">
+            <p><strong>Proyecto:</strong> {proyecto_nombre}</p>
+            <p><strong>Tarea:</strong> {tarea_nombre}</p>
+            <p style="font-size: 16px; color: #d9534f;">
+              {mensaje_tiempo}
+            </p>
+            <p>Por favor, revisa el estado de esta tarea y toma las acciones necesarias:</p>
+            <a href="{tarea_url}" class="btn">Ver Tarea en ClickUp</a>
+          </div>
+          <div class="footer">
+            <p>Este es un email automático del sistema Virtual Controller.</p>
+            <p>La alerta ha sido desactivada automáticamente. Para recibir una nueva alerta,
+               reactiva la configuración desde el panel de control.</p>
+          </div>
+        </div>
+      </body>
+    </html>
+    """
+
+    # Personalizar el subject según el tipo de alerta
+    if tipo_alerta == 'sin_actualizar':
+        subject = f"⚠️ Alerta: Tarea sin actualizar \"{tarea_nombre}\" - {proyecto_nombre}"
+    else:
+        subject = f"⚠️ Alerta: Demora en tarea \"{tarea_nombre}\" - {proyecto_nombre}"
+
+    return subject, html_content
+
+
 def enviar_email_alerta(email_destino, tarea_nombre, proyecto_nombre, tarea_url, tiempo_en_progreso, tipo_alerta='sin_actualizar'):
-    """Envía un email de alerta usando Brevo API (no SMTP porque Render bloquea puerto 587)"""
+    """
+    Envía un email de alerta de forma inmediata usando Brevo API (no SMTP porque Render bloquea puerto 587).
+    Las alertas normales usan encolar_email_alerta; este envío directo queda para el email de prueba.
+    """
     try:
         # Verificar configuración
         if not BREVO_API_KEY or not SMTP_EMAIL:
@@ -1854,89 +2611,13 @@ def enviar_email_alerta(email_destino, tarea_nombre, proyecto_nombre, tarea_url,
             return False
 
         print(f"[EMAIL] Enviando alerta para '{tarea_nombre}' a {email_destino}...")
-
-        # Personalizar el mensaje según el tipo de alerta
-        if tipo_alerta == 'sin_actualizar':
-            titulo_alerta = "Alerta: Tarea sin actualizar"
-            mensaje_tiempo = f"⏱️ Esta tarea lleva <strong>{tiempo_en_progreso}</strong> sin actualizaciones y ha superado el tiempo máximo configurado."
-        else:  # tiempo_total
-            titulo_alerta = "Alerta de Tiempo Total en Tarea"
-            mensaje_tiempo = f"⏱️ Esta tarea lleva <strong>{tiempo_en_progreso}</strong> en estado \"En Progreso\" y ha superado el tiempo máximo configurado."
-
-        # Crear el cuerpo del email en HTML
-        html_content = f"""
-        <html>
-          <head>
-            <style>
-              body {{ font-family: Arial, sans-serif; line-height: 1.6; }}
-              .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-              .header {{ background-color: #f8d7da; color: #721c24; padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
-              .content {{ background-color: #f9f9f9; padding: 20px; border-radius: 5px; }}
-              .btn {{ background-color: #667eea; color: white; padding: 12px 24px; text-decoration: none;
-                     border-radius: 5px; display: inline-block; margin-top: 15px; }}
-              .footer {{ color: #666; font-size: 12px; margin-top: 20px; padding-top: 20px; border-top: 1px solid #ddd; }}
-              .warning-icon {{ font-size: 48px; margin-bottom: 10px; }}
-            </style>
-          </head>
-          <body>
-            <div class="container">
-              <div class="header">
-                <div class="warning-icon">⚠️</div>
-                <h2 style="margin: 0;">{titulo_alerta}</h2>
-              </div>
-              <div class="content">
-                <p><strong>Proyecto:</strong> {proyecto_nombre}</p>
-                <p><strong>Tarea:</strong> {tarea_nombre}</p>
-                <p style="font-size: 16px; color: #d9534f;">
-                  {mensaje_tiempo}
-                </p>
-                <p>Por favor, revisa el estado de esta tarea y toma las acciones necesarias:</p>
-                <a href="{tarea_url}" class="btn">Ver Tarea en ClickUp</a>
-              </div>
-              <div class="footer">
-                <p>Este es un email automático del sistema Virtual Controller.</p>
-                <p>La alerta ha sido desactivada automáticamente. Para recibir una nueva alerta,
-                   reactiva la configuración desde el panel de control.</p>
-              </div>
-            </div>
-          </body>
-        </html>
-        """
-
-        # Personalizar el subject según el tipo de alerta
-        if tipo_alerta == 'sin_actualizar':
-            subject = f"⚠️ Alerta: Tarea sin actualizar \"{tarea_nombre}\" - {proyecto_nombre}"
-        else:
-            subject = f"⚠️ Alerta: Demora en tarea \"{tarea_nombre}\" - {proyecto_nombre}"
-
-        # Preparar el payload para la API de Brevo
-        payload = {
-            "sender": {
-                "name": "Virtual Controller",
-                "email": SMTP_EMAIL
-            },
-            "to": [
-                {
-                    "email": email_destino,
-                    "name": email_destino.split('@')[0]
-                }
-            ],
-            "subject": subject,
-            "htmlContent": html_content
-        }
+        subject, html_content = construir_email_alerta(tarea_nombre, proyecto_nombre, tarea_url, tiempo_en_progreso, tipo_alerta)
 
         print(f"[EMAIL] Enviando vía Brevo API...")
-
-        # Enviar usando la API de Brevo
-        response = requests.post(
-            'https://api.brevo.com/v3/smtp/email',
-            headers={
-                'accept': 'application/json',
-                'api-key': BREVO_API_KEY,
-                'content-type': 'application/json'
-            },
-            json=payload,
-            timeout=10
+        response = post_to_brevo(
+            [{'to_email': email_destino, 'subject': subject, 'html_content': html_content}],
+            BREVO_API_KEY,
+            SMTP_EMAIL
         )
 
         if response.status_code == 201:
@@ -1954,6 +2635,54 @@ def enviar_email_alerta(email_destino, tarea_nombre, proyecto_nombre, tarea_url,
         print(f"[EMAIL] ❌ Error: {str(e)}")
         return False
 
+
+def encolar_email_alerta(task_id, email_destino, tarea_nombre, proyecto_nombre, tarea_url, tiempo_en_progreso,
+                         tipo_alerta='sin_actualizar', activada_en=None):
+    """
+    Encola el email de alerta en la bandeja de salida (email_outbox).
+    El worker de envío lo manda a Brevo y, al confirmarse el envío, desactiva la alerta.
+
+    Args:
+        activada_en: ultima_actualizacion de la alerta; evita encolar dos veces el
+                     email de la misma activación
+
+    Returns:
+        bool: True si el email quedó encolado (ahora o antes)
+    """
+    try:
+        if not BREVO_API_KEY or not SMTP_EMAIL:
+            print(f"[EMAIL] ❌ Error: Configuración incompleta (BREVO_API_KEY o SMTP_EMAIL faltante)")
+            return False
+
+        subject, html_content = construir_email_alerta(tarea_nombre, proyecto_nombre, tarea_url, tiempo_en_progreso, tipo_alerta)
+        dedup_key = f"alerta:{task_id}:{activada_en}" if activada_en else None
+        email_id, nuevo = db.enqueue_email(email_destino, subject, html_content, task_id=task_id, dedup_key=dedup_key)
+
+        if nuevo:
+            # Nuevo, o uno de esta misma activación que había fallado y vuelve a intentarse
+            print(f"[EMAIL] 📥 Email de alerta para '{tarea_nombre}' encolado (outbox id: {email_id})")
+            email_sender.notify()
+        else:
+            print(f"[EMAIL] Email de alerta para '{tarea_nombre}' ya estaba encolado (outbox id: {email_id})")
+        return True
+
+    except Exception as e:
+        print(f"[EMAIL] ❌ Error al encolar email: {str(e)}")
+        return False
+
+
+def _alertas_enviadas(filas):
+    """Tras confirmar el envío de emails: actualizar la caché en memoria y el motor de alertas"""
+    task_ids = [fila['task_id'] for fila in filas if fila.get('task_id')]
+    for task_id in task_ids:
+        if task_id in alertas_tareas:
+            alertas_tareas[task_id]['aviso_activado'] = False
+            alertas_tareas[task_id]['ultimo_envio_email'] = datetime.now().isoformat()
+    alert_engine.refresh(task_ids)
+
+
+email_sender = OutboxSender(BREVO_API_KEY, SMTP_EMAIL, on_sent=_alertas_enviadas, fencing=scheduler_lease.fencing)
+
 @app.route('/api/verificar-alertas', methods=['POST'])
 def verificar_alertas():
     """Verifica si alguna tarea en progreso necesita enviar alerta basándose en su tiempo en progreso"""
@@ -1963,11 +2692,12 @@ def verificar_alertas():
         print(f"🔍 Timestamp: {datetime.now().isoformat()}")
         print("🔍"*40)
 
-        # Obtener todas las alertas activas de la base de datos
-        alertas_activas = db.get_all_active_alerts()
-        print(f"📋 [INFO] Alertas activas encontradas: {len(alertas_activas)}")
+        # Evaluar todas las alertas en una sola consulta: solo llegan las que deben enviar email
+        total_activas = db.count_active_alerts()
+        alertas_vencidas = db.get_due_alerts(margin_seconds=30)
+        print(f"📋 [INFO] Alertas activas: {total_activas}, vencidas: {len(alertas_vencidas)}")
 
-        if len(alertas_activas) == 0:
+        if total_activas == 0:
             print("⚠️  [INFO] No hay alertas activas configuradas. Finalizando verificación.")
             print("🔍"*40 + "\n")
             return jsonify({
@@ -1977,134 +2707,65 @@ def verificar_alertas():
                 'mensaje': 'No hay alertas activas configuradas'
             })
 
-        # Mostrar información de cada alerta activa
-        for i, alerta in enumerate(alertas_activas, 1):
-            print(f"   {i}. Tarea: {alerta['task_name']} (ID: {alerta['task_id'][:8]}...) - Límite: {alerta['aviso_horas']}h {alerta['aviso_minutos']}m")
-
         alertas_enviadas = []
 
-        for alerta in alertas_activas:
+        for alerta in alertas_vencidas:
             tarea_id = alerta['task_id']
             tarea_nombre = alerta['task_name']
             tarea_url = alerta['task_url']
             email_destino = alerta['email_aviso']
-            tiempo_max_dias = alerta.get('aviso_dias', 0)
-            tiempo_max_horas = alerta['aviso_horas']
-            tiempo_max_minutos = alerta['aviso_minutos']
-            tipo_alerta = alerta.get('tipo_alerta', 'sin_actualizar')
-
-            print(f"\n[INFO] Verificando alerta para tarea: {tarea_nombre} (ID: {tarea_id})")
-
-            # Calcular el tiempo máximo configurado en segundos
-            tiempo_max_segundos = (tiempo_max_dias * 86400) + (tiempo_max_horas * 3600) + (tiempo_max_minutos * 60)
-
-            if tiempo_max_segundos <= 0:
-                print(f"[WARNING] Tarea {tarea_id} tiene tiempo máximo de 0. Saltando...")
-                continue
-
-            if not email_destino:
-                print(f"[WARNING] Tarea {tarea_id} no tiene email configurado. Saltando...")
-                continue
+            tipo_alerta = alerta['tipo_alerta']
+            proyecto_nombre = alerta['project_name']
+            tiempo_en_progreso_segundos = alerta['elapsed_seconds']
 
             try:
-                # Obtener información de la tarea desde la BD
-                tarea_bd = db.get_task(tarea_id)
-
-                if not tarea_bd:
-                    print(f"[WARNING] Tarea {tarea_id} no encontrada en BD. Saltando...")
-                    continue
-
-                # Verificar si la tarea está actualmente en progreso
-                if tarea_bd['status'] != 'en_progreso':
-                    print(f"[INFO] Tarea {tarea_id} no está en estado 'en_progreso' (estado actual: {tarea_bd['status']}). Saltando...")
-                    continue
-
-                # Calcular el tiempo total en progreso
-                tiempo_data = db.calculate_task_time_in_progress(tarea_id)
-                tiempo_en_progreso_segundos = tiempo_data['total_seconds']
-
-                # Si está actualmente en progreso, sumar el tiempo de la sesión actual
-                if tiempo_data['is_currently_in_progress'] and tiempo_data['current_session_start']:
-                    try:
-                        session_start = datetime.fromisoformat(tiempo_data['current_session_start'])
-                        # Usar datetime.now() con timezone UTC para poder restar
-                        from datetime import timezone
-                        now = datetime.now(timezone.utc)
-                        tiempo_sesion_actual = (now - session_start).total_seconds()
-                        tiempo_en_progreso_segundos += tiempo_sesion_actual
-                        print(f"[INFO] Sumando tiempo de sesión actual: {tiempo_sesion_actual/3600:.2f}h")
-                    except Exception as e:
-                        print(f"[WARNING] Error al calcular sesión actual: {str(e)}")
-                        # Fallback: intentar sin timezone
-                        try:
-                            session_start_naive = datetime.fromisoformat(tiempo_data['current_session_start'].replace('+00:00', '').replace('Z', ''))
-                            tiempo_sesion_actual = (datetime.utcnow() - session_start_naive).total_seconds()
-                            tiempo_en_progreso_segundos += tiempo_sesion_actual
-                            print(f"[INFO] Sesión actual (fallback): +{tiempo_sesion_actual/3600:.2f}h")
-                        except Exception as e2:
-                            print(f"[ERROR] No se pudo calcular tiempo de sesión actual: {str(e2)}")
-
-                print(f"[INFO] Tiempo en progreso: {tiempo_en_progreso_segundos/3600:.2f}h ({tiempo_en_progreso_segundos}s)")
-                print(f"[INFO] Tiempo máximo configurado: {tiempo_max_segundos/3600:.2f}h ({tiempo_max_segundos}s)")
-
-                # Verificar si se superó el tiempo máximo (con margen de 30 segundos de tolerancia)
-                MARGEN_TOLERANCIA = 30  # segundos
-                if tiempo_en_progreso_segundos >= (tiempo_max_segundos - MARGEN_TOLERANCIA):
-                    print("\n" + "🚨"*20)
-                    print("🚨 ¡ALERTA ACTIVADA! - TIEMPO LÍMITE SUPERADO")
-                    print("🚨"*20)
-
-                    # Formatear el tiempo en progreso para el email
-                    horas = int(tiempo_en_progreso_segundos // 3600)
-                    minutos = int((tiempo_en_progreso_segundos % 3600) // 60)
-                    tiempo_en_progreso_str = f"{horas} horas y {minutos} minutos"
-
-                    # Obtener el nombre del proyecto
-                    proyecto_nombre = db.get_task_project_name(tarea_id)
-
-                    # Enviar email de alerta
-                    print(f"\n📤 [EMAIL] Iniciando envío de email de alerta...")
-                    print(f"📤 [EMAIL] Destinatario: {email_destino}")
-                    print(f"📤 [EMAIL] Tarea: {tarea_nombre}")
-                    print(f"📤 [EMAIL] Proyecto: {proyecto_nombre}")
-
-                    if enviar_email_alerta(
-                        email_destino,
-                        tarea_nombre,
-                        proyecto_nombre,
-                        tarea_url,
-                        tiempo_en_progreso_str,
-                        tipo_alerta
-                    ):
-                        print("\n" + "✅"*20)
-                        print("✅ EMAIL ENVIADO EXITOSAMENTE (desde verificación periódica)")
-                        print("✅"*20)
-                        print(f"✅ [RESULT] Alerta enviada a: {email_destino}")
-                        print(f"✅ [RESULT] Tarea: {tarea_nombre}")
-                        print("✅"*20 + "\n")
-
-                        # Desactivar la alerta después del envío
-                        db.deactivate_task_alert(tarea_id)
-
-                        # También actualizar la caché en memoria si existe
-                        if tarea_id in alertas_tareas:
-                            alertas_tareas[tarea_id]['aviso_activado'] = False
-                            alertas_tareas[tarea_id]['ultimo_envio_email'] = datetime.now().isoformat()
-
-                        alertas_enviadas.append({
-                            'tarea_id': tarea_id,
-                            'nombre': tarea_nombre,
-                            'proyecto': proyecto_nombre,
-                            'email': email_destino,
-                            'tiempo_en_progreso': tiempo_en_progreso_str
-                        })
-                    else:
-                        print("\n" + "❌"*20)
-                        print("❌ ERROR: NO SE PUDO ENVIAR EL EMAIL")
-                        print("❌"*20 + "\n")
+                print("\n" + "🚨"*20)
+                print("🚨 ¡ALERTA ACTIVADA! - TIEMPO LÍMITE SUPERADO")
+                print("🚨"*20)
+                print(f"[INFO] Tarea: {tarea_nombre} (ID: {tarea_id}), tipo: {tipo_alerta}")
+                print(f"[INFO] Tiempo: {tiempo_en_progreso_segundos/3600:.2f}h, límite: {alerta['limit_seconds']/3600:.2f}h")
+
+                # Formatear el tiempo en progreso para el email
+                horas = int(tiempo_en_progreso_segundos // 3600)
+                minutos = int((tiempo_en_progreso_segundos % 3600) // 60)
+                tiempo_en_progreso_str = f"{horas} horas y {minutos} minutos"
+
+                # Enviar email de alerta
+                print(f"\n📤 [EMAIL] Iniciando envío de email de alerta...")
+                print(f"📤 [EMAIL] Destinatario: {email_destino}")
+                print(f"📤 [EMAIL] Tarea: {tarea_nombre}")
+                print(f"📤 [EMAIL] Proyecto: {proyecto_nombre}")
+
+                if encolar_email_alerta(
+                    tarea_id,
+                    email_destino,
+                    tarea_nombre,
+                    proyecto_nombre,
+                    tarea_url,
+                    tiempo_en_progreso_str,
+                    tipo_alerta,
+                    activada_en=alerta['ultima_actualizacion']
+                ):
+                    print("\n" + "✅"*20)
+                    print("✅ EMAIL ENCOLADO PARA ENVÍO (desde verificación periódica)")
+                    print("✅"*20)
+                    print(f"✅ [RESULT] Alerta para: {email_destino}")
+                    print(f"✅ [RESULT] Tarea: {tarea_nombre}")
+                    print("✅"*20 + "\n")
+
+                    # La alerta se desactiva cuando el worker de envío confirma el email
+                    alertas_enviadas.append({
+                        'tarea_id': tarea_id,
+                        'nombre': tarea_nombre,
+                        'proyecto': proyecto_nombre,
+                        'email': email_destino,
+                        'tiempo_en_progreso': tiempo_en_progreso_str,
+                        'estado': 'encolado'
+                    })
                 else:
-                    diferencia = tiempo_max_segundos - tiempo_en_progreso_segundos
-                    print(f"[INFO] Tarea aún no supera el límite. Faltan {diferencia/3600:.2f}h")
+                    print("\n" + "❌"*20)
+                    print("❌ ERROR: NO SE PUDO ENCOLAR EL EMAIL")
+                    print("❌"*20 + "\n")
 
             except Exception as e:
                 print(f"[ERROR] Error al procesar alerta para tarea {tarea_id}: {str(e)}")
@@ -2113,13 +2774,13 @@ def verificar_alertas():
                 continue
 
         print("🔍"*40)
-        print(f"🔍 VERIFICACIÓN COMPLETADA - {len(alertas_enviadas)} alertas enviadas")
+        print(f"🔍 VERIFICACIÓN COMPLETADA - {len(alertas_enviadas)} alertas encoladas")
         print("🔍"*40 + "\n")
 
         return jsonify({
             'success': True,
             'alertas_enviadas': alertas_enviadas,
-            'total_verificadas': len(alertas_activas)
+            'total_verificadas': total_activas
         })
 
     except Exception as e:
@@ -2218,18 +2879,19 @@ def debug_verificar_alertas_ahora():
                     proyecto_nombre = db.get_task_project_name(tarea_id)
                     tarea_url = alerta['task_url']
 
-                    # Intentar enviar email
-                    if enviar_email_alerta(alerta['email_aviso'], tarea_nombre, proyecto_nombre, tarea_url, tiempo_str, tipo_alerta):
-                        db.deactivate_task_alert(tarea_id)
+                    # Encolar el email (la alerta se desactiva al confirmarse el envío)
+                    if encolar_email_alerta(tarea_id, alerta['email_aviso'], tarea_nombre, proyecto_nombre, tarea_url,
+                                            tiempo_str, tipo_alerta, activada_en=alerta.get('ultima_actualizacion')):
                         alertas_enviadas.append({
                             'tarea': tarea_nombre,
                             'email': alerta['email_aviso'],
-                            'tiempo': tiempo_str
+                            'tiempo': tiempo_str,
+                            'estado': 'encolado'
                         })
                     else:
                         alertas_error.append({
                             'tarea': tarea_nombre,
-                            'error': 'Error al enviar email via Brevo API'
+                            'error': 'Error al encolar el email de alerta'
                         })
                 else:
                     diferencia = (tiempo_max_segundos - tiempo_en_progreso) / 3600
@@ -2384,15 +3046,25 @@ def get_tasks_time_tracking():
         return jsonify({'error': str(e)}), 500
 
 
+# Secuencia de cambios de tiempo (cursor del endpoint batch), cacheada 1 segundo por proceso
+time_change_seq = ChangeSequence()
+
+
 @app.route('/api/tasks/time-tracking/batch', methods=['POST'])
 def get_tasks_time_tracking_batch():
     """
     Obtiene información de tiempo para un conjunto de tareas específicas
     Acepta una lista de task_ids en el body y retorna el tiempo calculado para cada una
+
+    Modo delta: con `since` (el `cursor` de la respuesta anterior) solo se devuelven
+    las tareas cuyo tiempo cambió desde entonces; `full` indica si la respuesta trae
+    todas las tareas (primera llamada o cursor demasiado antiguo). La respuesta
+    lleva un ETag; si coincide con If-None-Match se responde 304 sin consultar la BD.
     """
     try:
         data = request.json
         task_ids = data.get('task_ids', [])
+        since = data.get('since')
 
         if not task_ids:
             return jsonify({
@@ -2400,31 +3072,36 @@ def get_tasks_time_tracking_batch():
                 'tasks': {}
             })
 
-        result = {}
-        for task_id in task_ids:
+        cursor = time_change_seq.current()
+        digest = hashlib.sha1(','.join(sorted(map(str, task_ids))).encode('utf-8')).hexdigest()[:16]
+        etag = f'tt-{cursor}-{digest}'
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        changed = None
+        if since is not None:
             try:
-                # Verificar que la tarea existe
-                task = db.get_task(task_id)
-                if not task:
-                    continue
+                changed = db.get_time_changes_between(int(since), cursor)
+            except (TypeError, ValueError):
+                changed = None
 
-                # Calcular tiempo para esta tarea
-                time_data = db.calculate_task_time_in_progress(task_id)
-                result[task_id] = {
-                    'task_id': task_id,
-                    'task_name': task['name'],
-                    'total_seconds': time_data['total_seconds'],
-                    'current_session_start': time_data['current_session_start'],
-                    'is_currently_in_progress': time_data['is_currently_in_progress']
-                }
-            except Exception as e:
-                print(f"[ERROR] Error al procesar tarea {task_id}: {str(e)}")
-                continue
+        if changed is None:
+            # Una consulta para todas las tareas (las inexistentes se omiten)
+            result = db.get_time_tracking_bulk(task_ids)
+        else:
+            solicitadas = set(task_ids)
+            result = db.get_time_tracking_bulk([task_id for task_id in changed if task_id in solicitadas])
 
-        return jsonify({
+        response = jsonify({
             'success': True,
-            'tasks': result
+            'tasks': result,
+            'cursor': cursor,
+            'full': changed is None
         })
+        response.set_etag(etag, weak=True)
+        return response
 
     except Exception as e:
         print(f"[ERROR] Error al obtener tiempos de tareas (batch): {str(e)}")
@@ -2433,6 +3110,36 @@ def get_tasks_time_tracking_batch():
         return jsonify({'error': str(e)}), 500
 
 
+# Un único lector de cambios por proceso reparte las actualizaciones a todas las pestañas
+live_time_tracking = TimeTrackingBroadcaster()
+
+
+@app.route('/api/tasks/time-tracking/stream', methods=['GET'])
+def stream_tasks_time_tracking():
+    """
+    Stream Server-Sent Events con el tiempo en progreso de las tareas indicadas
+    (?task_ids=id1,id2,...). Envía el estado completo al conectar ('snapshot') y
+    después solo las tareas que cambian ('time'). Si el proceso ya tiene el máximo
+    de conexiones responde 503 y el frontend vuelve al endpoint batch.
+    """
+    task_ids = [task_id for task_id in request.args.get('task_ids', '').split(',') if task_id]
+    if not task_ids:
+        return jsonify({'error': 'task_ids es requerido'}), 400
+
+    subscription = live_time_tracking.subscribe(task_ids)
+    if subscription is None:
+        return jsonify({'error': 'Demasiadas conexiones en vivo, usar polling'}), 503
+
+    return Response(
+        live_time_tracking.stream(subscription),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
 @app.route('/api/task/<task_id>/time-tracking', methods=['GET'])
 def get_task_time_tracking(task_id):
     """
@@ -2492,6 +3199,34 @@ def get_task_status_history_api(task_id):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/debug/time-totals', methods=['GET', 'POST'])
+def debug_time_totals():
+    """
+    Comprueba (GET) o recalcula (POST) los totales de tiempo en progreso
+    a partir del historial de estados y devuelve las desviaciones encontradas
+    """
+    try:
+        check_only = request.method == 'GET'
+        result = db.rebuild_task_time_totals(check_only=check_only)
+
+        print(f"[INFO] Totales de tiempo revisados: {result['checked']} tareas, "
+              f"{len(result['drift'])} desviaciones, {result['repaired']} corregidas")
+
+        return jsonify({
+            'success': True,
+            'check_only': check_only,
+            'checked': result['checked'],
+            'drift': result['drift'],
+            'repaired': result['repaired']
+        })
+
+    except Exception as e:
+        print(f"[ERROR] Error al revisar totales de tiempo: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
 # ============================================================================
 # ENDPOINTS DE GOOGLE OAUTH Y GOOGLE SHEETS
 # ============================================================================
@@ -2670,7 +3405,7 @@ def sync_spaces_internal(headers):
     """Sincroniza todos los espacios desde ClickUp API sin devolver HTTP response"""
     try:
         print("[INFO] Sincronizando espacios desde ClickUp API...")
-        teams_response = requests.get('https://api.clickup.com/api/v2/team', headers=headers, timeout=10)
+        teams_response = clickup_get('/team', headers=headers, timeout=10)
 
         if teams_response.status_code != 200:
             print(f"[ERROR] Error al obtener teams: {teams_response.status_code}")
@@ -2679,12 +3414,14 @@ def sync_spaces_internal(headers):
         teams = teams_response.json()['teams']
         all_spaces = []
 
-        for team in teams:
-            spaces_response = requests.get(
-                f'https://api.clickup.com/api/v2/team/{team["id"]}/space',
-                headers=headers,
-                timeout=10
-            )
+        def _obtener_espacios(team):
+            return clickup_get(f'/team/{team["id"]}/space', headers=headers, timeout=10)
+
+        # Los espacios de cada team se piden en paralelo
+        for team, spaces_response, error in run_parallel(_obtener_espacios, teams):
+            if error:
+                print(f"[ERROR] Error al obtener espacios del team {team['id']}: {str(error)}")
+                continue
             if spaces_response.status_code == 200:
                 spaces = spaces_response.json()['spaces']
                 for space in spaces:
@@ -2699,6 +3436,8 @@ def sync_spaces_internal(headers):
                     db.save_space(space['id'], space['name'], team['id'], metadata=space)
                     print(f"[INFO] Espacio {space['id']} sincronizado: {space['name']}")
 
+                db.mark_scope_synced(scope_jerarquia('team', team['id'], headers))
+
         print(f"[INFO] Total de espacios sincronizados: {len(all_spaces)}")
         return all_spaces
 
@@ -2708,21 +3447,39 @@ def sync_spaces_internal(headers):
 
 
 def sync_projects_internal(space_id, headers):
-    """Sincroniza proyectos (folders y lists) de un espacio desde ClickUp API"""
+    """
+    Sincroniza proyectos (folders y lists) de un espacio desde ClickUp API
+
+    Returns:
+        tuple: (proyectos, completo); completo es False si falló algún listado
+        de carpetas o listas (puede haber listas del espacio que no están)
+    """
     try:
         print(f"[INFO] Sincronizando proyectos del espacio {space_id}...")
         proyectos = []
+        completo = folders_ok = False
 
-        # Obtener folders del space desde la API
-        folders_response = requests.get(
-            f'https://api.clickup.com/api/v2/space/{space_id}/folder',
-            headers=headers,
-            timeout=10
+        # Obtener folders y listas sin folder del space en paralelo
+        (_, folders_response, folders_error), (_, lists_response, lists_error) = run_parallel(
+            lambda path: clickup_get(path, headers=headers, timeout=10),
+            [f'/space/{space_id}/folder', f'/space/{space_id}/list']
         )
+        if folders_error:
+            raise folders_error
+        if lists_error:
+            raise lists_error
 
         if folders_response.status_code == 200:
             folders = folders_response.json()['folders']
-            for folder in folders:
+            folders_ok = True
+
+            # Obtener las listas de todos los folders en paralelo
+            listas_por_folder = run_parallel(
+                lambda folder: clickup_get(f'/folder/{folder["id"]}/list', headers=headers, timeout=10),
+                folders
+            )
+
+            for folder, folder_lists_response, error in listas_por_folder:
                 # Guardar folder en BD
                 db.save_folder(folder['id'], folder['name'], space_id, folder.get('hidden', False), metadata=folder)
                 print(f"[INFO] Folder sincronizado: {folder['name']}")
@@ -2733,12 +3490,11 @@ def sync_projects_internal(space_id, headers):
                     'type': 'folder'
                 })
 
-                # Obtener las listas dentro de cada folder
-                folder_lists_response = requests.get(
-                    f'https://api.clickup.com/api/v2/folder/{folder["id"]}/list',
-                    headers=headers,
-                    timeout=10
-                )
+                if error:
+                    print(f"[ERROR] Error al obtener listas del folder {folder['id']}: {str(error)}")
+                    folders_ok = False
+                    continue
+
                 if folder_lists_response.status_code == 200:
                     for lista in folder_lists_response.json()['lists']:
                         # Guardar lista en BD
@@ -2752,13 +3508,8 @@ def sync_projects_internal(space_id, headers):
                             'type': 'list',
                             'folder_id': folder['id']
                         })
-
-        # Obtener listas sin folder (directamente en el space)
-        lists_response = requests.get(
-            f'https://api.clickup.com/api/v2/space/{space_id}/list',
-            headers=headers,
-            timeout=10
-        )
+                else:
+                    folders_ok = False
 
         if lists_response.status_code == 200:
             listas = lists_response.json()['lists']
@@ -2773,23 +3524,40 @@ def sync_projects_internal(space_id, headers):
                     'name': lista['name'],
                     'type': 'list'
                 })
+            completo = folders_ok
+
+        if completo:
+            marcar_jerarquia_sincronizada(
+                space_id,
+                [proyecto['id'] for proyecto in proyectos if proyecto['type'] == 'folder'],
+                [proyecto['id'] for proyecto in proyectos if proyecto['type'] == 'list'],
+                headers
+            )
 
         print(f"[INFO] Total de proyectos sincronizados para espacio {space_id}: {len(proyectos)}")
-        return proyectos
+        return proyectos, completo
 
     except Exception as e:
         print(f"[ERROR] Error al sincronizar proyectos del espacio {space_id}: {str(e)}")
-        return []
+        return [], False
 
 
-def sync_all_data_from_clickup():
+def sync_all_data_from_clickup(completo=False):
     """
     Sincroniza todos los datos desde ClickUp (espacios, proyectos y tareas)
     antes de generar un informe para asegurar datos actualizados.
+
+    Los proyectos de cada espacio y las tareas de cada lista se sincronizan en
+    paralelo (CLICKUP_SYNC_WORKERS hilos), compartiendo el límite global de
+    peticiones a ClickUp.
+
+    Las tareas se sincronizan de forma incremental: para cada team con marca
+    guardada solo se piden las tareas con date_updated posterior a la marca.
+    Los teams sin marca (o todos, si completo=True) se sincronizan lista a lista.
     """
     try:
         print("[INFO] ========================================")
-        print("[INFO] Iniciando sincronización completa desde ClickUp API...")
+        print(f"[INFO] Iniciando sincronización {'completa' if completo else 'incremental'} desde ClickUp API...")
         print("[INFO] ========================================")
 
         # Obtener headers de autenticación
@@ -2798,39 +3566,91 @@ def sync_all_data_from_clickup():
             print("[ERROR] No se pudieron obtener headers de autenticación")
             return False
 
+        timings = SyncTimings()
+
         # 1. Sincronizar espacios
-        espacios = sync_spaces_internal(headers)
+        with timings.stage('espacios'):
+            espacios = sync_spaces_internal(headers)
         if not espacios:
             print("[WARNING] No se encontraron espacios o hubo un error")
             return False
 
         print(f"\n[INFO] Sincronizando proyectos y tareas de {len(espacios)} espacios...")
 
-        # 2. Para cada espacio, sincronizar proyectos
+        # 2. Sincronizar los proyectos de todos los espacios en paralelo
+        def _sincronizar_proyectos(espacio):
+            with timings.stage('proyectos'):
+                return sync_projects_internal(espacio['id'], headers)
+
+        listas = []
         total_proyectos = 0
+        # Teams a los que les falta alguna lista o tarea: no reciben marca (se repite la sincronización completa)
+        teams_con_error = set()
+        for espacio, resultado, error in run_parallel(_sincronizar_proyectos, espacios):
+            if error:
+                print(f"[ERROR] Error al sincronizar proyectos de {espacio['name']}: {str(error)}")
+                teams_con_error.add(espacio['team_id'])
+                continue
+            proyectos, proyectos_completos = resultado
+            if not proyectos_completos:
+                print(f"[WARNING] Listado incompleto de carpetas y listas de {espacio['name']}")
+                teams_con_error.add(espacio['team_id'])
+            total_proyectos += len(proyectos)
+            listas.extend(
+                dict(proyecto, team_id=espacio['team_id'])
+                for proyecto in proyectos if proyecto['type'] == 'list'
+            )
+
+        # 3. Decidir por team entre sincronización incremental o completa
+        marcas = {}
+        for team_id in {espacio['team_id'] for espacio in espacios}:
+            marca = None if completo else db.get_sync_watermark(f'team:{team_id}')
+            marcas[team_id] = marca
+
+        teams_incrementales = [team_id for team_id, marca in marcas.items() if marca is not None]
+        listas_completas = [lista for lista in listas if marcas.get(lista['team_id']) is None]
+        inicio_ms = int(time.time() * 1000)
+
         total_tareas = 0
 
-        for espacio in espacios:
-            print(f"\n[INFO] --- Procesando espacio: {espacio['name']} ---")
-            proyectos = sync_projects_internal(espacio['id'], headers)
-            total_proyectos += len(proyectos)
+        # 3a. Teams con marca: solo tareas actualizadas desde la última sincronización
+        def _sincronizar_equipo(team_id):
+            with timings.stage('tareas_incrementales'):
+                return sincronizar_tareas_de_equipo(team_id, headers, marcas[team_id])
 
-            # 3. Para cada proyecto (lista), sincronizar tareas
-            for proyecto in proyectos:
-                if proyecto['type'] == 'list':
-                    print(f"[INFO] Sincronizando tareas de lista: {proyecto['name']}")
-                    try:
-                        tareas = obtener_tareas_de_lista(proyecto['id'], headers)
-                        total_tareas += len(tareas)
-                        print(f"[INFO] {len(tareas)} tareas sincronizadas de {proyecto['name']}")
-                    except Exception as e:
-                        print(f"[ERROR] Error al sincronizar tareas de {proyecto['name']}: {str(e)}")
+        for team_id, resultado, error in run_parallel(_sincronizar_equipo, teams_incrementales):
+            if error:
+                print(f"[ERROR] Error en la sincronización incremental del team {team_id}: {str(error)}")
+                continue
+            num_tareas, max_date_updated = resultado
+            total_tareas += num_tareas
+            db.set_sync_watermark(f'team:{team_id}', max_date_updated)
+
+        # 3b. Teams sin marca: todas las tareas de todas sus listas en paralelo
+        def _sincronizar_tareas(proyecto):
+            with timings.stage('tareas'):
+                return sincronizar_tareas_de_lista(proyecto['id'], headers)
+
+        for proyecto, num_tareas, error in run_parallel(_sincronizar_tareas, listas_completas):
+            if error:
+                print(f"[ERROR] Error al sincronizar tareas de {proyecto['name']}: {str(error)}")
+                teams_con_error.add(proyecto['team_id'])
+                continue
+            total_tareas += num_tareas
+            print(f"[INFO] {num_tareas} tareas sincronizadas de {proyecto['name']}")
+
+        # Tras una sincronización completa sin errores, la marca del team es el inicio de la sincronización
+        for team_id, marca in marcas.items():
+            if marca is None and team_id not in teams_con_error:
+                db.set_sync_watermark(f'team:{team_id}', inicio_ms)
 
         print("\n[INFO] ========================================")
         print(f"[INFO] Sincronización completada exitosamente!")
         print(f"[INFO] Espacios: {len(espacios)}")
         print(f"[INFO] Proyectos: {total_proyectos}")
-        print(f"[INFO] Tareas: {total_tareas}")
+        print(f"[INFO] Tareas: {total_tareas} ({len(teams_incrementales)} teams incrementales, "
+              f"{len(listas_completas)} listas completas)")
+        timings.print_report(prefix='[INFO]')
         print("[INFO] ========================================\n")
 
         return True
@@ -2896,8 +3716,9 @@ def export_to_google_sheets():
             session['google_credentials']['token'] = credentials.token
 
         # IMPORTANTE: Refrescar todos los datos desde ClickUp antes de generar el informe
+        # Con 'sincronizacion_completa': true se ignoran las marcas incrementales
         print("[INFO] Refrescando datos desde ClickUp para obtener información actualizada...")
-        sync_success = sync_all_data_from_clickup()
+        sync_success = sync_all_data_from_clickup(completo=bool(data.get('sincronizacion_completa')))
 
         if not sync_success:
             print("[WARNING] La sincronización completa no se pudo completar, pero continuaremos con los datos disponibles")
@@ -2906,6 +3727,9 @@ def export_to_google_sheets():
         espacios = db.get_all_spaces()
         proyectos_con_horas = []
 
+        # Calcular las horas de todas las listas y carpetas en una sola consulta
+        reporte_horas = db.get_in_progress_seconds_by_project(fecha_inicio_dt, fecha_fin_dt)
+
         print(f"[INFO] Procesando {len(espacios)} espacios...")
 
         for espacio in espacios:
@@ -2914,7 +3738,7 @@ def export_to_google_sheets():
             print(f"[INFO] Espacio '{espacio['name']}': {len(folders)} folders")
 
             for folder in folders:
-                horas_totales = calcular_horas_proyecto('folder', folder['id'], fecha_inicio_dt, fecha_fin_dt)
+                horas_totales = calcular_horas_proyecto('folder', folder['id'], fecha_inicio_dt, fecha_fin_dt, reporte_horas)
                 print(f"[INFO] Folder '{folder['name']}': {horas_totales:.2f} horas")
                 # Solo añadir proyectos con tiempo registrado (> 0 horas)
                 if horas_totales > 0:
@@ -2930,7 +3754,7 @@ def export_to_google_sheets():
             print(f"[INFO] Espacio '{espacio['name']}': {len(lists)} listas")
 
             for lista in lists:
-                horas_totales = calcular_horas_proyecto('list', lista['id'], fecha_inicio_dt, fecha_fin_dt)
+                horas_totales = calcular_horas_proyecto('list', lista['id'], fecha_inicio_dt, fecha_fin_dt, reporte_horas)
                 print(f"[INFO] Lista '{lista['name']}': {horas_totales:.2f} horas")
                 # Solo añadir proyectos con tiempo registrado (> 0 horas)
                 if horas_totales > 0:
@@ -3050,7 +3874,7 @@ def export_to_google_sheets():
         return jsonify({'error': str(e)}), 500
 
 
-def calcular_horas_proyecto(project_type, project_id, fecha_inicio, fecha_fin):
+def calcular_horas_proyecto(project_type, project_id, fecha_inicio, fecha_fin, reporte=None):
     """
     Calcula las horas totales de un proyecto en el rango de fechas especificado.
     Suma todo el tiempo que las tareas estuvieron en estado "en_progreso" dentro del rango.
@@ -3060,99 +3884,25 @@ def calcular_horas_proyecto(project_type, project_id, fecha_inicio, fecha_fin):
         project_id: ID del proyecto
         fecha_inicio: datetime de inicio del rango
         fecha_fin: datetime de fin del rango
+        reporte: resultado de db.get_in_progress_seconds_by_project para el mismo rango
+                 (opcional, se calcula si no se proporciona; permite reutilizarlo entre proyectos)
 
     Returns:
         float: Total de horas trabajadas en el rango de fechas
     """
     try:
-        # Obtener todas las tareas del proyecto
+        if reporte is None:
+            reporte = db.get_in_progress_seconds_by_project(fecha_inicio, fecha_fin)
+
         if project_type == 'folder':
-            # Obtener listas del folder
-            listas = db.get_lists_by_folder(project_id)
-            tareas = []
-            for lista in listas:
-                tareas.extend(db.get_tasks_by_list(lista['id']))
+            total_segundos = reporte['folders'].get(project_id, 0)
         else:  # list
-            tareas = db.get_tasks_by_list(project_id)
-
-        print(f"[DEBUG] Proyecto {project_type} {project_id}: {len(tareas)} tareas, rango: {fecha_inicio.date()} - {fecha_fin.date()}")
-
-        total_segundos = 0
-
-        for tarea in tareas:
-            # Obtener el historial de estados de la tarea
-            historial = db.get_status_history(tarea['id'])
-
-            if not historial:
-                continue
-
-            # Calcular tiempo en "en_progreso" dentro del rango de fechas
-            in_progress_start = None
-
-            for i, cambio in enumerate(historial):
-                try:
-                    # Parsear timestamp
-                    timestamp = datetime.fromisoformat(cambio['changed_at'].replace('Z', '+00:00'))
-                    # Si el timestamp no tiene timezone, añadirle UTC
-                    if timestamp.tzinfo is None:
-                        from datetime import timezone
-                        timestamp = timestamp.replace(tzinfo=timezone.utc)
-                except:
-                    # Si falla el parseo, intentar sin timezone
-                    try:
-                        timestamp = datetime.fromisoformat(cambio['changed_at'])
-                        # Añadir timezone UTC si no tiene
-                        if timestamp.tzinfo is None:
-                            from datetime import timezone
-                            timestamp = timestamp.replace(tzinfo=timezone.utc)
-                    except:
-                        print(f"[WARNING] No se pudo parsear fecha '{cambio['changed_at']}' para tarea {tarea['name']}")
-                        continue
-
-                # Cuando cambia a "en_progreso", marcar inicio
-                if cambio['new_status'] == 'en_progreso':
-                    in_progress_start = timestamp
-
-                # Cuando cambia a otro estado, calcular duración del período en progreso
-                elif in_progress_start is not None:
-                    fin_progreso = timestamp
-
-                    # Calcular intersección con el rango de fechas
-                    inicio_efectivo = max(in_progress_start, fecha_inicio)
-                    fin_efectivo = min(fin_progreso, fecha_fin)
-
-                    # Solo sumar si hay intersección
-                    if inicio_efectivo < fin_efectivo:
-                        segundos = (fin_efectivo - inicio_efectivo).total_seconds()
-                        if segundos > 0:
-                            total_segundos += segundos
-                            print(f"[DEBUG]   Tarea '{tarea['name']}': +{segundos/3600:.2f}h ({inicio_efectivo.date()} - {fin_efectivo.date()})")
-
-                    in_progress_start = None
-
-            # Si la tarea sigue en progreso (no hubo cambio de estado después)
-            if in_progress_start is not None and tarea['status'] == 'en_progreso':
-                # Usar la fecha actual como fin, pero limitado a fecha_fin
-                from datetime import timezone
-                ahora = datetime.now(timezone.utc)
-
-                fin_progreso = min(ahora, fecha_fin)
-
-                # Calcular intersección con el rango de fechas
-                inicio_efectivo = max(in_progress_start, fecha_inicio)
-                fin_efectivo = min(fin_progreso, fecha_fin)
-
-                # Solo sumar si hay intersección
-                if inicio_efectivo < fin_efectivo:
-                    segundos = (fin_efectivo - inicio_efectivo).total_seconds()
-                    if segundos > 0:
-                        total_segundos += segundos
-                        print(f"[DEBUG]   Tarea '{tarea['name']}' (en progreso): +{segundos/3600:.2f}h ({inicio_efectivo.date()} - {fin_efectivo.date()})")
+            total_segundos = reporte['lists'].get(project_id, 0)
 
         # Convertir segundos a horas
         total_horas = total_segundos / 3600
 
-        print(f"[DEBUG] Total proyecto: {total_horas:.2f} horas en rango de fechas")
+        print(f"[DEBUG] Proyecto {project_type} {project_id}: {total_horas:.2f} horas en rango {fecha_inicio.date()} - {fecha_fin.date()}")
 
         return total_horas
 
@@ -3163,5 +3913,117 @@ def calcular_horas_proyecto(project_type, project_id, fecha_inicio, fecha_fin):
         return 0.0
 
 
+def agrupar_eventos_por_ventana(filas, ventana_segundos):
+    """
+    Agrupa filas de webhooks_log (en orden de id) como lo haría la cola con
+    coalescencia: eventos seguidos de una tarea recibidos dentro de la ventana
+    del primero, sin pasar de un taskDeleted ni de WEBHOOK_COALESCE_MAX_EVENTS.
+    """
+    grupos = []
+    abiertos = {}  # task_id -> (grupo, recibido del primero en segundos epoch)
+    for fila in filas:
+        if fila.get('received_ms') is not None:
+            recibido = fila['received_ms'] / 1000
+        else:
+            recibido = datetime.fromisoformat(str(fila['received_at'])).replace(tzinfo=timezone.utc).timestamp()
+        abierto = abiertos.get(fila['task_id'])
+        if (abierto and fila['event_type'] != 'taskDeleted'
+                and recibido - abierto[1] <= ventana_segundos
+                and len(abierto[0]) < WEBHOOK_COALESCE_MAX_EVENTS):
+            abierto[0].append(fila)
+            continue
+        grupo = [fila]
+        grupos.append(grupo)
+        abiertos[fila['task_id']] = (grupo, recibido) if fila['event_type'] != 'taskDeleted' else None
+    return grupos
+
+
+@app.cli.command('bench-webhook-replay')
+@click.option('--limit', default=2000, show_default=True, help='Webhooks de tarea más recientes a reproducir')
+@click.option('--window-ms', default=WEBHOOK_COALESCE_WINDOW_MS, show_default=True, help='Ventana de coalescencia')
+@click.option('--on-copy', is_flag=True, help='Confirma que DATABASE_PATH apunta a una copia de la BD')
+def bench_webhook_replay(limit, window_ms, on_copy):
+    """
+    Reproduce webhooks de tarea guardados en webhooks_log, uno a uno y coalescidos.
+
+    Reescribe tareas e historial con los payloads antiguos: ejecutar solo sobre
+    una copia y sin tareas en segundo plano (sin líder no se envían emails), ej.
+    BACKGROUND_JOBS_ENABLED=false DATABASE_PATH=copia.db flask --app app bench-webhook-replay --on-copy
+
+    Las dos pasadas parten del mismo estado: la BD se restaura desde una
+    instantánea antes de cada una.
+    """
+    if not on_copy:
+        raise click.UsageError('La reproducción modifica la BD: use una copia y pase --on-copy')
+    if BACKGROUND_JOBS_ENABLED:
+        raise click.UsageError('Ejecute con BACKGROUND_JOBS_ENABLED=false para que no arranquen el motor '
+                               'de alertas, el envío de emails ni los workers de la cola')
+
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM (
+                SELECT id, event_type, task_id, payload, received_at, received_ms FROM webhooks_log
+                WHERE task_id IS NOT NULL AND event_type LIKE 'task%'
+                ORDER BY id DESC LIMIT ?
+            ) ORDER BY id
+        """, (limit,))
+        filas = [dict(fila) for fila in cursor.fetchall()]
+    if not filas:
+        print("[ERROR] No hay webhooks de tarea en webhooks_log")
+        return
+
+    # Sin llamadas a ClickUp durante la medida: solo payloads completos (no necesitan enriquecerse)
+    completas = []
+    for fila in filas:
+        payload = json.loads(fila['payload'])
+        if payload.get('task_name') or payload.get('name'):
+            completas.append(fila)
+    filas = completas
+    grupos = agrupar_eventos_por_ventana(filas, window_ms / 1000)
+
+    def contar_historial():
+        with db.get_db() as conn:
+            return conn.execute("SELECT COUNT(*) FROM task_status_history").fetchone()[0]
+
+    # Instantánea de la copia junto a ella (misma unidad), restaurada antes de cada pasada
+    snapshot_path = f"{db.DATABASE_PATH}.bench-snapshot"
+    snapshot = sqlite3.connect(snapshot_path)
+    try:
+        with db.get_db() as conn:
+            conn.backup(snapshot)
+
+        for etiqueta, planes in (('uno a uno', [[fila] for fila in filas]), (f'coalescidos ({window_ms} ms)', grupos)):
+            with db.get_db() as conn:
+                snapshot.backup(conn)
+            db.clear_task_cache()
+
+            historial_inicial = contar_historial()
+            inicio = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), app.app_context():
+                for plan in planes:
+                    # Sin webhook_log_id: las filas ya procesadas en producción no deben saltarse
+                    eventos = [(fila['event_type'], json.loads(fila['payload']), fecha_recepcion_utc(fila), None)
+                               for fila in plan]
+                    if len(eventos) > 1:
+                        aplicar_eventos_tarea(eventos)
+                    else:
+                        despachar_evento_webhook(eventos[0][0], eventos[0][1], recibido_en=eventos[0][2])
+            duracion = time.perf_counter() - inicio
+            print(f"[BENCH] {etiqueta}: {len(filas)} eventos en {len(planes)} aplicaciones, "
+                  f"{duracion:.2f}s ({len(filas) / duracion:,.0f} eventos/s), "
+                  f"{contar_historial() - historial_inicial} cambios de estado registrados")
+    finally:
+        snapshot.close()
+        os.remove(snapshot_path)
+
+
+# Arrancar la elección de líder del scheduler (al final, con todas las funciones ya definidas)
+init_scheduler()
+
+# Arrancar los workers de la cola de webhooks (solo con WEBHOOK_ASYNC_MODE)
+start_webhook_workers()
+
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,256 @@
+"""
+Caché con límite de tamaño (LRU) y caducidad (TTL)
+Dos backends intercambiables:
+- sqlite: tabla cache_entries de la BD, compartida por todos los workers de gunicorn
+- memory: diccionario ordenado en memoria, privado de cada proceso
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '5000'))
+CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', '86400'))
+
+# Backend sqlite: una lectura solo actualiza accessed_at (una escritura en la BD) si la
+# marca tiene más de CACHE_TOUCH_SECONDS, y el límite de tamaño se aplica cada
+# CACHE_TRIM_SECONDS en lugar de contar las entradas en cada set()
+CACHE_TOUCH_SECONDS = float(os.getenv('CACHE_TOUCH_SECONDS', '60'))
+CACHE_TRIM_SECONDS = float(os.getenv('CACHE_TRIM_SECONDS', '30'))
+
+
+class MemoryCache:
+    """
+    Caché LRU con TTL en memoria del proceso.
+
+    Args:
+        namespace: nombre de la caché (solo informativo)
+        max_entries: número máximo de entradas; al superarlo se expulsa la menos usada
+        ttl_seconds: segundos de vida de cada entrada
+    """
+
+    backend = 'memory'
+
+    def __init__(self, namespace, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.namespace = namespace
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return default
+            if entry[0] <= time.time():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            self._stats['sets'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def _purge_expired_locked(self):
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        self._stats['expirations'] += len(expired)
+
+    def values(self):
+        """Entradas vigentes, de la más reciente a la más antigua (no cuenta como acceso)"""
+        with self._lock:
+            self._purge_expired_locked()
+            return [value for _, value in reversed(self._entries.values())]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            self._purge_expired_locked()
+            return len(self._entries)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, backend=self.backend, namespace=self.namespace,
+                        entries=len(self._entries), max_entries=self.max_entries,
+                        ttl_seconds=self.ttl_seconds)
+
+
+class SQLiteCache(MemoryCache):
+    """
+    Caché LRU con TTL guardada en la tabla cache_entries.
+
+    Todos los workers leen y escriben la misma tabla, así que ven el mismo
+    contenido. Los valores se guardan como JSON. Los contadores de aciertos,
+    fallos y expulsiones son del proceso actual.
+
+    Para no competir por el bloqueo de escritura de SQLite en cada acceso, el
+    orden LRU es aproximado (resolución de CACHE_TOUCH_SECONDS) y la tabla puede
+    superar max_entries entre dos recortes (CACHE_TRIM_SECONDS).
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, namespace, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS,
+                 touch_seconds=CACHE_TOUCH_SECONDS, trim_seconds=CACHE_TRIM_SECONDS):
+        super().__init__(namespace, max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.touch_seconds = touch_seconds
+        self.trim_seconds = trim_seconds
+        self._next_trim = 0.0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT value, expires_at, accessed_at FROM cache_entries
+                WHERE namespace = ? AND key = ?
+            """, (self.namespace, key))
+            row = cursor.fetchone()
+
+            if row is None or row['expires_at'] <= now:
+                # Las entradas caducadas se borran (y se cuentan) en el siguiente recorte
+                with self._lock:
+                    self._stats['misses'] += 1
+                return default
+
+            # Marcar el acceso para el orden LRU (solo si la marca es antigua)
+            if row['accessed_at'] < now - self.touch_seconds:
+                cursor.execute("""
+                    UPDATE cache_entries SET accessed_at = ?
+                    WHERE namespace = ? AND key = ?
+                """, (now, self.namespace, key))
+                conn.commit()
+
+        with self._lock:
+            self._stats['hits'] += 1
+        return json.loads(row['value'])
+
+    def set(self, key, value):
+        now = time.time()
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO cache_entries (namespace, key, value, expires_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(namespace, key) DO UPDATE SET
+                    value = excluded.value,
+                    expires_at = excluded.expires_at,
+                    accessed_at = excluded.accessed_at
+            """, (self.namespace, key, json.dumps(value), now + self.ttl_seconds, now))
+            conn.commit()
+
+        with self._lock:
+            self._stats['sets'] += 1
+            recortar = time.monotonic() >= self._next_trim
+            if recortar:
+                self._next_trim = time.monotonic() + self.trim_seconds
+        if recortar:
+            self.trim()
+
+    def trim(self):
+        """Borra las entradas caducadas y, si sobran, las menos usadas. Devuelve cuántas expulsó"""
+        now = time.time()
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?",
+                           (self.namespace, now))
+            caducadas = cursor.rowcount
+
+            cursor.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,))
+            exceso = cursor.fetchone()[0] - self.max_entries
+            expulsadas = 0
+            if exceso > 0:
+                cursor.execute("""
+                    DELETE FROM cache_entries
+                    WHERE namespace = ? AND key IN (
+                        SELECT key FROM cache_entries
+                        WHERE namespace = ?
+                        ORDER BY accessed_at ASC
+                        LIMIT ?
+                    )
+                """, (self.namespace, self.namespace, exceso))
+                expulsadas = cursor.rowcount
+            conn.commit()
+
+        with self._lock:
+            self._stats['expirations'] += caducadas
+            self._stats['evictions'] += expulsadas
+        return expulsadas
+
+    def delete(self, key):
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def values(self):
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT value FROM cache_entries
+                WHERE namespace = ? AND expires_at > ?
+                ORDER BY accessed_at DESC
+            """, (self.namespace, time.time()))
+            return [json.loads(row['value']) for row in cursor.fetchall()]
+
+    def clear(self):
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+            conn.commit()
+
+    def __len__(self):
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ? AND expires_at > ?",
+                           (self.namespace, time.time()))
+            return cursor.fetchone()[0]
+
+    def get_stats(self):
+        entries = len(self)
+        with self._lock:
+            return dict(self._stats, backend=self.backend, namespace=self.namespace,
+                        entries=entries, max_entries=self.max_entries,
+                        ttl_seconds=self.ttl_seconds, pid=os.getpid())
+
+
+_BACKENDS = {
+    'memory': MemoryCache,
+    'sqlite': SQLiteCache,
+}
+
+
+def create_cache(namespace, backend=None, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+    """Crea una caché del backend indicado (por defecto CACHE_BACKEND)"""
+    backend = backend or CACHE_BACKEND
+    if backend not in _BACKENDS:
+        print(f"[CACHE] Backend '{backend}' desconocido, usando 'sqlite'")
+        backend = 'sqlite'
+    return _BACKENDS[backend](namespace, max_entries=max_entries, ttl_seconds=ttl_seconds)
@@ -0,0 +1,294 @@
+"""
+Cliente HTTP compartido para la API de ClickUp
+Sesión con keep-alive, límite de peticiones por token compartido por todos los
+procesos y ejecución concurrente acotada
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import db
+
+CLICKUP_API_BASE = 'https://api.clickup.com/api/v2'
+
+# ClickUp permite 100 peticiones por minuto y token en el plan gratuito
+CLICKUP_RATE_LIMIT_PER_MINUTE = int(os.getenv('CLICKUP_RATE_LIMIT_PER_MINUTE', '100'))
+
+# Dónde se lleva la cuenta del límite:
+# - sqlite: tabla clickup_rate_limits, un único cupo por token para todos los workers
+# - memory: cupo por token en memoria de cada proceso
+CLICKUP_RATE_LIMIT_BACKEND = os.getenv('CLICKUP_RATE_LIMIT_BACKEND', 'sqlite')
+
+# Número máximo de peticiones/sincronizaciones simultáneas por proceso
+CLICKUP_SYNC_WORKERS = int(os.getenv('CLICKUP_SYNC_WORKERS', '6'))
+
+CLICKUP_HTTP_TIMEOUT = 10
+# ClickUp devuelve como máximo 100 tareas por página
+CLICKUP_PAGE_SIZE = 100
+CLICKUP_MAX_RETRIES_429 = 3
+
+
+class RateLimiter:
+    """
+    Token bucket por token de ClickUp en memoria del proceso.
+    Cada petición consume un token del cupo de su token de acceso; los tokens se
+    reponen de forma continua hasta llenar el cupo por minuto.
+    """
+
+    backend = 'memory'
+
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.rate = self.capacity / 60.0
+        self._buckets = {}  # bucket_key -> [tokens, updated, paused_until]
+        self._lock = threading.Lock()
+
+    def _take(self, key):
+        """Consume un token de key; devuelve 0 o los segundos a esperar"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(key, [float(self.capacity), now, 0.0])
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            if now < bucket[2]:
+                return bucket[2] - now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def acquire(self, key):
+        """Bloquea hasta que haya un token disponible en el cupo de key"""
+        while True:
+            wait = self._take(key)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, key, seconds):
+        """Detiene las peticiones de key durante unos segundos (tras un 429 de ClickUp)"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(key, [0.0, now, 0.0])
+            bucket[0] = 0.0
+            bucket[1] = now
+            bucket[2] = max(bucket[2], now + seconds)
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    Token bucket por token de ClickUp guardado en la tabla clickup_rate_limits
+    de db.RATE_LIMIT_DATABASE_PATH (un fichero aparte de la BD principal).
+    Todos los workers de gunicorn consumen del mismo cupo, así que el límite
+    por minuto es el de la cuenta y no el de cada proceso.
+    """
+
+    backend = 'sqlite'
+
+    def _take(self, key):
+        return db.take_rate_limit_token(key, self.capacity, self.rate)
+
+    def pause(self, key, seconds):
+        db.pause_rate_limit(key, seconds)
+
+
+def rate_limit_key(headers):
+    """Clave del cupo de unas cabeceras: hash del token (no se guarda el token en la BD)"""
+    token = (headers or {}).get('Authorization') or ''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]
+
+
+def create_rate_limiter(per_minute=CLICKUP_RATE_LIMIT_PER_MINUTE, backend=None):
+    """Crea el limitador del backend indicado (por defecto CLICKUP_RATE_LIMIT_BACKEND)"""
+    backend = backend or CLICKUP_RATE_LIMIT_BACKEND
+    if backend == 'memory':
+        return RateLimiter(per_minute)
+    if backend != 'sqlite':
+        print(f"[CLICKUP] Backend de límite '{backend}' desconocido, usando 'sqlite'")
+    return SQLiteRateLimiter(per_minute)
+
+
+_rate_limiter = create_rate_limiter()
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Devuelve la sesión HTTP compartida (con keep-alive) para la API de ClickUp"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, CLICKUP_SYNC_WORKERS * 2))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def _seconds_until_reset(response):
+    """Segundos a esperar según las cabeceras de rate limit de ClickUp"""
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset:
+        try:
+            return max(1.0, float(reset) - time.time())
+        except ValueError:
+            pass
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(1.0, float(retry_after))
+        except ValueError:
+            pass
+    return 60.0 / _rate_limiter.capacity * 10
+
+
+def clickup_get(path, headers, params=None, timeout=CLICKUP_HTTP_TIMEOUT):
+    """
+    GET a la API de ClickUp respetando el límite de peticiones del token.
+
+    Args:
+        path: ruta relativa a /api/v2 (ej: '/team') o URL completa
+        headers: cabeceras con el token de autorización
+        params: parámetros de query (opcional)
+
+    Returns:
+        requests.Response (si ClickUp sigue devolviendo 429 tras los reintentos, la última respuesta)
+    """
+    url = path if path.startswith('http') else f'{CLICKUP_API_BASE}{path}'
+    key = rate_limit_key(headers)
+
+    response = None
+    for attempt in range(CLICKUP_MAX_RETRIES_429 + 1):
+        _rate_limiter.acquire(key)
+        response = get_session().get(url, headers=headers, params=params, timeout=timeout)
+
+        if response.status_code != 429:
+            return response
+
+        wait = _seconds_until_reset(response)
+        print(f"[CLICKUP] Límite de peticiones alcanzado (429) en {path}, esperando {wait:.1f}s "
+              f"(intento {attempt + 1}/{CLICKUP_MAX_RETRIES_429 + 1})")
+        _rate_limiter.pause(key, wait)
+
+    return response
+
+
+def clickup_get_pages(path, headers, items_key, params=None, timeout=CLICKUP_HTTP_TIMEOUT):
+    """
+    Generador que recorre un endpoint paginado de ClickUp (parámetro `page`).
+
+    Produce la lista de elementos de cada página según llega. Mientras el
+    consumidor procesa la página N, la página N+1 ya se está pidiendo en
+    segundo plano, así que solo hay dos páginas en memoria a la vez.
+
+    Args:
+        path: ruta relativa a /api/v2 (ej: '/list/123/task')
+        headers: cabeceras con el token de autorización
+        items_key: clave de la respuesta con los elementos (ej: 'tasks')
+        params: parámetros de query adicionales (opcional)
+
+    Raises:
+        requests.HTTPError: si ClickUp responde con un error en alguna página
+    """
+    params = dict(params or {})
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clickup-page')
+
+    def _fetch(page):
+        return clickup_get(path, headers=headers, params={**params, 'page': page}, timeout=timeout)
+
+    try:
+        page = 0
+        future = executor.submit(_fetch, page)
+        while future is not None:
+            response = future.result()
+            if response.status_code != 200:
+                print(f"[CLICKUP] Error {response.status_code} al obtener la página {page} de {path}")
+                response.raise_for_status()
+                return
+
+            data = response.json()
+            items = data.get(items_key, [])
+            last_page = data.get('last_page', len(items) < CLICKUP_PAGE_SIZE) or not items
+
+            # Pedir la siguiente página antes de entregar la actual
+            page += 1
+            future = None if last_page else executor.submit(_fetch, page)
+
+            if items:
+                yield items
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_parallel(func, items, max_workers=None):
+    """
+    Ejecuta func(item) para cada elemento con un pool de hilos acotado.
+
+    Returns:
+        lista de tuplas (item, resultado, excepción) en el mismo orden que items
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    workers = max(1, min(max_workers or CLICKUP_SYNC_WORKERS, len(items)))
+
+    def _call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    if workers == 1:
+        return [_call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='clickup-sync') as executor:
+        return list(executor.map(_call, items))
+
+
+class SyncTimings:
+    """Acumula el tiempo por etapa de una sincronización (también desde varios hilos)"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] += elapsed
+                stage['calls'] += 1
+
+    def report(self):
+        """Devuelve un resumen con el tiempo total y el de cada etapa"""
+        with self._lock:
+            return {
+                'total_seconds': round(time.monotonic() - self.started, 3),
+                'stages': {
+                    name: {'seconds': round(data['seconds'], 3), 'calls': data['calls']}
+                    for name, data in self.stages.items()
+                }
+            }
+
+    def print_report(self, prefix='[SYNC]'):
+        report = self.report()
+        print(f"{prefix} Tiempo total: {report['total_seconds']:.2f}s")
+        for name, data in report['stages'].items():
+            print(f"{prefix}   {name}: {data['seconds']:.2f}s en {data['calls']} llamadas")
@@ -6,21 +6,277 @@ Base de datos SQLite con tablas para espacios, proyectos, tareas y webhooks
 import sqlite3
 import json
 from datetime import datetime
+from collections import OrderedDict
 from contextlib import contextmanager
 import os
+import threading
+import time
 
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'virtualcontroller.db')
 
+# Tamaño máximo del pool de conexiones por proceso y tiempo máximo de espera
+# (en segundos) cuando todas las conexiones están en uso
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+
+# Cupos de peticiones a ClickUp (ver clickup_api.py) en un fichero SQLite aparte: se escribe
+# en cada GET a ClickUp y no debe competir por el bloqueo de escritura de la BD principal
+RATE_LIMIT_DATABASE_PATH = os.getenv('RATE_LIMIT_DATABASE_PATH', f'{DATABASE_PATH}-ratelimit')
+
+# Perfiles de almacenamiento: PRAGMAs que se aplican a cada conexión nueva.
+# - default: WAL para que lectores y escritores (workers, scheduler y webhooks) no se bloqueen
+# - durable: igual que default pero con fsync en cada commit
+# - legacy: journal clásico de SQLite (rollback), útil en sistemas de ficheros sin soporte WAL
+STORAGE_PROFILES = {
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,  # 256 MB
+        'cache_size': -65536,    # 64 MB (valores negativos = KiB)
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,    # ms
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 10000,
+    },
+    'legacy': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 5000,
+    },
+}
+
+DB_STORAGE_PROFILE = os.getenv('DB_STORAGE_PROFILE', 'default')
+
+# Valores permitidos para los PRAGMAs no numéricos (evita inyectar SQL desde el entorno)
+_PRAGMA_CHOICES = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY'},
+}
+
+
+def get_storage_profile():
+    """
+    Devuelve los PRAGMAs del perfil configurado en DB_STORAGE_PROFILE.
+    Cada valor se puede sobrescribir con su variable de entorno
+    (DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_MMAP_SIZE, DB_CACHE_SIZE, DB_TEMP_STORE, DB_BUSY_TIMEOUT).
+    """
+    if DB_STORAGE_PROFILE not in STORAGE_PROFILES:
+        print(f"[DB WARNING] Perfil de almacenamiento desconocido '{DB_STORAGE_PROFILE}', usando 'default'")
+    profile = dict(STORAGE_PROFILES.get(DB_STORAGE_PROFILE, STORAGE_PROFILES['default']))
+
+    for name in profile:
+        override = os.getenv(f'DB_{name.upper()}')
+        if not override:
+            continue
+        if name in _PRAGMA_CHOICES:
+            if override.upper() in _PRAGMA_CHOICES[name]:
+                profile[name] = override.upper()
+            else:
+                print(f"[DB WARNING] Valor inválido para DB_{name.upper()}: {override}")
+        else:
+            try:
+                profile[name] = int(override)
+            except ValueError:
+                print(f"[DB WARNING] Valor inválido para DB_{name.upper()}: {override}")
+
+    return profile
+
+
+def apply_storage_profile(conn, profile=None):
+    """Aplica los PRAGMAs del perfil de almacenamiento a una conexión"""
+    profile = profile or get_storage_profile()
+    # busy_timeout primero para que el cambio a WAL también espere si la BD está ocupada
+    conn.execute(f"PRAGMA busy_timeout = {int(profile['busy_timeout'])}")
+    conn.execute(f"PRAGMA journal_mode = {profile['journal_mode']}")
+    conn.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+    conn.execute(f"PRAGMA mmap_size = {int(profile['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(profile['cache_size'])}")
+    conn.execute(f"PRAGMA temp_store = {profile['temp_store']}")
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones SQLite reutilizables entre requests.
+
+    Cada hilo (o greenlet, si gevent parchea threading) toma una conexión del pool
+    la primera vez que entra en get_db() y la devuelve al salir. Las llamadas
+    anidadas dentro del mismo hilo reutilizan la conexión que ya tiene abierta.
+    Antes de reutilizar una conexión ociosa se comprueba que siga respondiendo.
+    """
+
+    def __init__(self, database_path, max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT, profile=None):
+        self.database_path = database_path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self.profile = profile or get_storage_profile()
+        self._reset()
+
+    def _reset(self):
+        """Reinicia el estado del pool (también tras un fork del proceso)"""
+        self._idle = []
+        self._size = 0
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0, 'waits': 0, 'checkouts': 0}
+
+    def _create_connection(self):
+        conn = sqlite3.connect(
+            self.database_path,
+            timeout=self.profile['busy_timeout'] / 1000,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        try:
+            apply_storage_profile(conn, self.profile)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._available:
+            self._size -= 1
+            self.stats['discarded'] += 1
+            self._available.notify()
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            conn = None
+            with self._available:
+                if os.getpid() != self._pid:
+                    # Conexiones heredadas de otro proceso: no se pueden compartir
+                    self._reset()
+
+                if self._idle:
+                    conn = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError(
+                            f"Pool de conexiones agotado ({self.max_size} conexiones en uso)"
+                        )
+                    self.stats['waits'] += 1
+                    self._available.wait(remaining)
+                    continue
+
+            if conn is not None:
+                if self._is_healthy(conn):
+                    with self._available:
+                        self.stats['reused'] += 1
+                        self.stats['checkouts'] += 1
+                    return conn
+                self._discard(conn)
+                continue
+
+            try:
+                conn = self._create_connection()
+            except Exception:
+                with self._available:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+
+            with self._available:
+                self.stats['created'] += 1
+                self.stats['checkouts'] += 1
+            return conn
+
+    def _checkin(self, conn):
+        try:
+            if conn.in_transaction:
+                # No dejar transacciones a medias en una conexión reutilizable
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._available:
+            if os.getpid() != self._pid:
+                return
+            self._idle.append(conn)
+            self._available.notify()
+
+    def acquire(self):
+        """Obtiene la conexión del hilo actual (o una del pool si no tiene)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            self._local.depth += 1
+            return conn
+
+        conn = self._checkout()
+        self._local.conn = conn
+        self._local.depth = 1
+        self._local.pid = os.getpid()
+        return conn
+
+    def release(self, conn):
+        """Libera la conexión; vuelve al pool cuando termina el get_db() más externo"""
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        self._local.conn = None
+        self._checkin(conn)
+
+    def close_all(self):
+        """Cierra todas las conexiones ociosas del pool"""
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def get_stats(self):
+        with self._available:
+            return dict(self.stats, size=self._size, idle=len(self._idle), max_size=self.max_size,
+                        storage_profile=DB_STORAGE_PROFILE)
+
+
+_pool = ConnectionPool(DATABASE_PATH)
+
 
 @contextmanager
 def get_db():
-    """Context manager para conexiones de base de datos"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """Context manager para conexiones de base de datos (reutilizadas desde el pool)"""
+    conn = _pool.acquire()
     try:
         yield conn
     finally:
-        conn.close()
+        _pool.release(conn)
+
+
+def get_pool_stats():
+    """Devuelve contadores del pool de conexiones (creadas, reutilizadas, esperas...)"""
+    return _pool.get_stats()
 
 
 def init_db():
@@ -28,6 +284,12 @@ def init_db():
     with get_db() as conn:
         cursor = conn.cursor()
 
+        # BD nueva: vacuum incremental desde el principio (el VACUUM de un fichero vacío es
+        # inmediato). Las existentes se convierten a mano: python webhook_archive.py enable-incremental-vacuum
+        if cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+
         # Tabla de espacios (Spaces)
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS spaces (
@@ -98,6 +360,7 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 metadata TEXT,
+                row_version INTEGER DEFAULT 0,
                 FOREIGN KEY (list_id) REFERENCES lists(id) ON DELETE CASCADE
             )
         """)
@@ -135,7 +398,10 @@ def init_db():
                 processed BOOLEAN DEFAULT 0,
                 error TEXT,
                 received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                processed_at TIMESTAMP
+                processed_at TIMESTAMP,
+                dedup_key TEXT,
+                duplicates INTEGER DEFAULT 0,
+                received_ms INTEGER
             )
         """)
 
@@ -149,10 +415,121 @@ def init_db():
                 old_status_text TEXT,
                 new_status_text TEXT,
                 changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                webhook_log_id INTEGER,
                 FOREIGN KEY (task_id) REFERENCES tasks(id) ON DELETE CASCADE
             )
         """)
 
+        # Tabla de tiempo acumulado en progreso por tarea (mantenida por save_status_change)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS task_time_totals (
+                task_id TEXT PRIMARY KEY,
+                accumulated_seconds REAL DEFAULT 0,
+                open_session_start TEXT,
+                last_changed_at TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Tabla de marcas de sincronización incremental (máximo date_updated visto por ámbito)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_watermarks (
+                scope TEXT PRIMARY KEY,
+                date_updated_ms INTEGER NOT NULL,
+                last_synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Bandeja de salida de emails (la envía un worker por lotes)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dedup_key TEXT,
+                task_id TEXT,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                html_content TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                claimed_at TIMESTAMP,
+                last_error TEXT,
+                message_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        """)
+
+        # Registro de cambios de tiempo en progreso (lo leen los streams en vivo de cada proceso)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS task_time_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Secuencia global de row_version de las tareas (una sola fila, id = 1)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS task_row_version_seq (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                value INTEGER NOT NULL
+            )
+        """)
+
+        # Caché compartida por todos los workers (ver cache.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+
+        # Concesiones (leases) de liderazgo: qué proceso ejecuta el scheduler de alertas
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scheduler_leases (
+                name TEXT PRIMARY KEY,
+                holder_id TEXT NOT NULL,
+                fencing_token INTEGER NOT NULL DEFAULT 1,
+                acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                renewed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL
+            )
+        """)
+
+        # Contadores de webhooks por tipo de evento y periodo (granularity: minute, hour, day o
+        # total con bucket ''), mantenidos por log_webhook y mark_webhook_processed
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_stats (
+                granularity TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                total INTEGER DEFAULT 0,
+                processed INTEGER DEFAULT 0,
+                errors INTEGER DEFAULT 0,
+                duplicates INTEGER DEFAULT 0,
+                latency_count INTEGER DEFAULT 0,
+                latency_sum_ms INTEGER DEFAULT 0,
+                PRIMARY KEY (granularity, bucket, event_type)
+            )
+        """)
+
+        # Histograma de latencia (recepción -> procesado): webhooks por límite superior del tramo (ms)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_latency_hist (
+                granularity TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                le_ms INTEGER NOT NULL,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (granularity, bucket, event_type, le_ms)
+            )
+        """)
+
         # Índices para mejorar rendimiento
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_list_id ON tasks(list_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status)")
@@ -162,8 +539,20 @@ def init_db():
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_folders_space_id ON folders(space_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhooks_event_type ON webhooks_log(event_type)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhooks_processed ON webhooks_log(processed)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhooks_task_pending ON webhooks_log(task_id, processed, id)")
+
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_history_task_id ON task_status_history(task_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_history_changed_at ON task_status_history(changed_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_history_task_changed ON task_status_history(task_id, changed_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_alerts_activado ON task_alerts(aviso_activado, task_id)")
+        # Lectura de cambios del motor de alertas (get_alert_timings con changed_since)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_alerts_updated ON task_alerts(updated_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_updated_at ON tasks(updated_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_time_totals_updated ON task_time_totals(updated_at)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_email_outbox_dedup ON email_outbox(dedup_key)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox(status, next_attempt_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_time_changes_created ON task_time_changes(created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries(namespace, accessed_at)")
 
         conn.commit()
         print("[INFO] Base de datos inicializada correctamente")
@@ -200,6 +589,102 @@ def migrate_db():
             conn.commit()
             print("[INFO] Columna 'aviso_dias' agregada exitosamente")
 
+        # Columnas de la cola asíncrona de webhooks (reclamación por workers y reintentos)
+        cursor.execute("PRAGMA table_info(webhooks_log)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'claimed_at' not in columns:
+            print("[INFO] Agregando columnas 'claimed_at' y 'attempts' a webhooks_log...")
+            cursor.execute("ALTER TABLE webhooks_log ADD COLUMN claimed_at TIMESTAMP")
+            cursor.execute("ALTER TABLE webhooks_log ADD COLUMN attempts INTEGER DEFAULT 0")
+            # Los webhooks antiguos que quedaron sin procesar no deben reproducirse ahora
+            cursor.execute("""
+                UPDATE webhooks_log
+                SET processed = 1, processed_at = CURRENT_TIMESTAMP,
+                    error = COALESCE(error, 'Sin procesar antes de la cola asíncrona')
+                WHERE processed = 0
+            """)
+            conn.commit()
+            print("[INFO] Columnas de la cola de webhooks agregadas exitosamente")
+
+        # Clave de idempotencia de los webhooks (reintentos de ClickUp y Make.com)
+        if 'dedup_key' not in columns:
+            print("[INFO] Agregando columnas 'dedup_key' y 'duplicates' a webhooks_log...")
+            cursor.execute("ALTER TABLE webhooks_log ADD COLUMN dedup_key TEXT")
+            cursor.execute("ALTER TABLE webhooks_log ADD COLUMN duplicates INTEGER DEFAULT 0")
+            conn.commit()
+            print("[INFO] Columnas de idempotencia agregadas exitosamente")
+
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_webhooks_dedup_key
+            ON webhooks_log(dedup_key) WHERE dedup_key IS NOT NULL
+        """)
+        conn.commit()
+
+        # Recepción en milisegundos (ventana de coalescencia de la cola y latencia de procesado)
+        if 'received_ms' not in columns:
+            print("[INFO] Agregando columna 'received_ms' a webhooks_log...")
+            cursor.execute("ALTER TABLE webhooks_log ADD COLUMN received_ms INTEGER")
+            conn.commit()
+            print("[INFO] Columna 'received_ms' agregada exitosamente")
+
+        # Webhook que originó cada cambio de estado (evita repetirlo al reintentar un lote coalescido)
+        cursor.execute("PRAGMA table_info(task_status_history)")
+        if 'webhook_log_id' not in [column[1] for column in cursor.fetchall()]:
+            print("[INFO] Agregando columna 'webhook_log_id' a task_status_history...")
+            cursor.execute("ALTER TABLE task_status_history ADD COLUMN webhook_log_id INTEGER")
+            conn.commit()
+            print("[INFO] Columna 'webhook_log_id' agregada exitosamente")
+
+        # Contadores de webhooks: si la tabla es nueva, partir de lo que ya hay en webhooks_log
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM webhook_stats)")
+        if not cursor.fetchone()[0]:
+            print("[INFO] Calculando contadores de webhooks desde webhooks_log...")
+            cursor.execute("""
+                INSERT INTO webhook_stats (granularity, bucket, event_type, total, processed, errors, duplicates)
+                SELECT 'day', date(received_at), event_type, COUNT(*),
+                       SUM(CASE WHEN processed = 1 THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN error IS NOT NULL THEN 1 ELSE 0 END),
+                       SUM(COALESCE(duplicates, 0))
+                FROM webhooks_log
+                GROUP BY date(received_at), event_type
+            """)
+            cursor.execute("""
+                INSERT INTO webhook_stats (granularity, bucket, event_type, total, processed, errors, duplicates)
+                SELECT 'total', '', event_type, SUM(total), SUM(processed), SUM(errors), SUM(duplicates)
+                FROM webhook_stats WHERE granularity = 'day'
+                GROUP BY event_type
+            """)
+            conn.commit()
+
+        # Versión de fila de las tareas (invalida la caché de get_task en todos los procesos)
+        cursor.execute("PRAGMA table_info(tasks)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'row_version' not in columns:
+            print("[INFO] Agregando columna 'row_version' a tasks...")
+            cursor.execute("ALTER TABLE tasks ADD COLUMN row_version INTEGER DEFAULT 0")
+            conn.commit()
+            print("[INFO] Columna 'row_version' agregada exitosamente")
+
+        # La secuencia de versiones empieza por encima de las versiones ya guardadas
+        cursor.execute("""
+            INSERT OR IGNORE INTO task_row_version_seq (id, value)
+            SELECT 1, COALESCE(MAX(row_version), 0) FROM tasks
+        """)
+        conn.commit()
+
+        # Calcular los totales de tiempo en progreso si la tabla es nueva y ya hay historial
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM task_time_totals)")
+        has_totals = cursor.fetchone()[0]
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM task_status_history)")
+        has_history = cursor.fetchone()[0]
+
+        if has_history and not has_totals:
+            print("[INFO] Calculando totales de tiempo en progreso desde el historial...")
+            result = rebuild_task_time_totals()
+            print(f"[INFO] Totales calculados para {result['checked']} tareas")
+
 
 # === FUNCIONES PARA SPACES ===
 
@@ -255,6 +740,15 @@ def save_folder(folder_id, name, space_id, hidden=False, metadata=None):
         conn.commit()
 
 
+def get_folder(folder_id):
+    """Obtiene una carpeta por ID"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM folders WHERE id = ?", (folder_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
 def get_folders_by_space(space_id):
     """Obtiene todas las carpetas de un espacio"""
     with get_db() as conn:
@@ -283,6 +777,15 @@ def save_list(list_id, name, space_id=None, folder_id=None, archived=False, meta
         conn.commit()
 
 
+def get_list(list_id):
+    """Obtiene una lista por ID"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM lists WHERE id = ?", (list_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
 def get_lists_by_space(space_id):
     """Obtiene todas las listas de un espacio"""
     with get_db() as conn:
@@ -299,226 +802,713 @@ def get_lists_by_folder(folder_id):
         return [dict(row) for row in cursor.fetchall()]
 
 
-# === FUNCIONES PARA TASKS ===
-
-def save_task(task_data):
+def archive_lists(list_ids):
     """
-    Guarda o actualiza una tarea
-    task_data debe ser un diccionario con los campos de la tarea
+    Marca listas como archivadas. Las listas borradas en ClickUp se archivan en
+    lugar de eliminarse para que los informes de sus tareas conserven el nombre.
     """
     with get_db() as conn:
         cursor = conn.cursor()
-
-        # Preparar datos
-        task_id = task_data.get('id')
-        name = task_data.get('name', 'Sin nombre')
-        list_id = task_data.get('list_id')
-        status = task_data.get('status', 'pendiente')
-        status_text = task_data.get('status_text')
-        url = task_data.get('url')
-        description = task_data.get('description')
-        priority = task_data.get('priority')
-
-        # Convertir assignees a JSON si es una lista (incluso si está vacía)
-        assignees = task_data.get('assignees')
-        if isinstance(assignees, list):
-            assignees = json.dumps(assignees)
-        elif assignees is not None and not isinstance(assignees, str):
-            assignees = json.dumps(assignees)
-
-        date_updated = task_data.get('date_updated')
-        date_created = task_data.get('date_created')
-        date_closed = task_data.get('date_closed')
-        due_date = task_data.get('due_date')
-        start_date = task_data.get('start_date')
-        time_estimate = task_data.get('time_estimate')
-        time_spent = task_data.get('time_spent')
-        horas_trabajadas = task_data.get('horas_trabajadas', 0)
-        minutos_trabajados = task_data.get('minutos_trabajados', 0)
-        parent_task_id = task_data.get('parent_task_id')
-
-        # Convertir custom_fields a JSON si es lista/dict (incluso si está vacío)
-        custom_fields = task_data.get('custom_fields')
-        if custom_fields is not None and not isinstance(custom_fields, str):
-            custom_fields = json.dumps(custom_fields)
-
-        # Convertir tags a JSON si es una lista (incluso si está vacía)
-        tags = task_data.get('tags')
-        if isinstance(tags, list):
-            tags = json.dumps(tags)
-        elif tags is not None and not isinstance(tags, str):
-            tags = json.dumps(tags)
-
-        # Convertir metadata a JSON si es dict/list (incluso si está vacío)
-        metadata = task_data.get('metadata')
-        if metadata is not None and not isinstance(metadata, str):
-            metadata = json.dumps(metadata)
-
-        cursor.execute("""
-            INSERT INTO tasks (
-                id, name, list_id, status, status_text, url, description, priority,
-                assignees, date_created, date_updated, date_closed, due_date, start_date,
-                time_estimate, time_spent, horas_trabajadas, minutos_trabajados,
-                parent_task_id, custom_fields, tags, metadata, updated_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(id) DO UPDATE SET
-                name = excluded.name,
-                list_id = excluded.list_id,
-                status = excluded.status,
-                status_text = excluded.status_text,
-                url = excluded.url,
-                description = excluded.description,
-                priority = excluded.priority,
-                assignees = excluded.assignees,
-                date_created = excluded.date_created,
-                date_updated = excluded.date_updated,
-                date_closed = excluded.date_closed,
-                due_date = excluded.due_date,
-                start_date = excluded.start_date,
-                time_estimate = excluded.time_estimate,
-                time_spent = excluded.time_spent,
-                horas_trabajadas = excluded.horas_trabajadas,
-                minutos_trabajados = excluded.minutos_trabajados,
-                parent_task_id = excluded.parent_task_id,
-                custom_fields = excluded.custom_fields,
-                tags = excluded.tags,
-                metadata = excluded.metadata,
-                updated_at = CURRENT_TIMESTAMP
-        """, (
-            task_id, name, list_id, status, status_text, url, description, priority,
-            assignees, date_created, date_updated, date_closed, due_date, start_date,
-            time_estimate, time_spent, horas_trabajadas, minutos_trabajados,
-            parent_task_id, custom_fields, tags, metadata
-        ))
+        cursor.executemany("""
+            UPDATE lists SET archived = 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND COALESCE(archived, 0) = 0
+        """, [(list_id,) for list_id in list_ids])
         conn.commit()
+        return cursor.rowcount
 
 
-def get_task(task_id):
-    """Obtiene una tarea por ID"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
-        row = cursor.fetchone()
-        if row:
-            task = dict(row)
-            # Parsear JSON fields
-            if task.get('assignees'):
-                try:
-                    task['assignees'] = json.loads(task['assignees'])
-                except:
-                    pass
-            if task.get('custom_fields'):
-                try:
-                    task['custom_fields'] = json.loads(task['custom_fields'])
-                except:
-                    pass
-            if task.get('tags'):
-                try:
-                    task['tags'] = json.loads(task['tags'])
-                except:
-                    pass
-            if task.get('metadata'):
-                try:
-                    task['metadata'] = json.loads(task['metadata'])
-                except:
-                    pass
-            return task
-        return None
-
-
-def get_tasks_by_list(list_id):
-    """Obtiene todas las tareas de una lista"""
+def delete_folder(folder_id):
+    """Elimina una carpeta y archiva sus listas"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM tasks
-            WHERE list_id = ?
-            ORDER BY date_updated DESC
-        """, (list_id,))
-        tasks = []
-        for row in cursor.fetchall():
-            task = dict(row)
-            # Parsear JSON fields
-            if task.get('assignees'):
-                try:
-                    task['assignees'] = json.loads(task['assignees'])
-                except:
-                    pass
-            if task.get('tags'):
-                try:
-                    task['tags'] = json.loads(task['tags'])
-                except:
-                    pass
-            tasks.append(task)
-        return tasks
+        cursor.execute("UPDATE lists SET archived = 1, updated_at = CURRENT_TIMESTAMP WHERE folder_id = ?", (folder_id,))
+        cursor.execute("DELETE FROM folders WHERE id = ?", (folder_id,))
+        conn.commit()
 
 
-def delete_task(task_id):
-    """Elimina una tarea"""
+def delete_space(space_id):
+    """Elimina un espacio y sus carpetas, y archiva sus listas"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+        cursor.execute("UPDATE lists SET archived = 1, updated_at = CURRENT_TIMESTAMP WHERE space_id = ?", (space_id,))
+        cursor.execute("DELETE FROM folders WHERE space_id = ?", (space_id,))
+        cursor.execute("DELETE FROM spaces WHERE id = ?", (space_id,))
         conn.commit()
 
 
-# === FUNCIONES PARA TASK ALERTS ===
+def get_space_hierarchy(space_id):
+    """
+    Carpetas y listas guardadas de un espacio (las listas archivadas se omiten).
 
-def save_task_alert(task_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta='sin_actualizar'):
-    """Guarda o actualiza la configuración de alerta de una tarea"""
+    Returns:
+        tuple: (carpetas, listas) como listas de dicts ordenadas por nombre
+    """
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM folders WHERE space_id = ? ORDER BY name", (space_id,))
+        folders = [dict(row) for row in cursor.fetchall()]
         cursor.execute("""
-            INSERT INTO task_alerts (
-                task_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta,
-                ultima_actualizacion, updated_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ON CONFLICT(task_id) DO UPDATE SET
-                aviso_activado = excluded.aviso_activado,
-                email_aviso = excluded.email_aviso,
-                aviso_dias = excluded.aviso_dias,
-                aviso_horas = excluded.aviso_horas,
-                aviso_minutos = excluded.aviso_minutos,
-                tipo_alerta = excluded.tipo_alerta,
-                ultima_actualizacion = CURRENT_TIMESTAMP,
-                updated_at = CURRENT_TIMESTAMP
-        """, (task_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta))
-        conn.commit()
+            SELECT id, name, folder_id FROM lists
+            WHERE space_id = ? AND COALESCE(archived, 0) = 0
+            ORDER BY name
+        """, (space_id,))
+        lists = [dict(row) for row in cursor.fetchall()]
+        return folders, lists
 
 
-def get_task_alert(task_id):
-    """Obtiene la configuración de alerta de una tarea"""
+# === FUNCIONES PARA TASKS ===
+
+_UPSERT_TASK_SQL = """
+    INSERT INTO tasks (
+        id, name, list_id, status, status_text, url, description, priority,
+        assignees, date_created, date_updated, date_closed, due_date, start_date,
+        time_estimate, time_spent, horas_trabajadas, minutos_trabajados,
+        parent_task_id, custom_fields, tags, metadata, row_version, updated_at
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(id) DO UPDATE SET
+        name = excluded.name,
+        list_id = excluded.list_id,
+        status = excluded.status,
+        status_text = excluded.status_text,
+        url = excluded.url,
+        description = excluded.description,
+        priority = excluded.priority,
+        assignees = excluded.assignees,
+        date_created = excluded.date_created,
+        date_updated = excluded.date_updated,
+        date_closed = excluded.date_closed,
+        due_date = excluded.due_date,
+        start_date = excluded.start_date,
+        time_estimate = excluded.time_estimate,
+        time_spent = excluded.time_spent,
+        horas_trabajadas = excluded.horas_trabajadas,
+        minutos_trabajados = excluded.minutos_trabajados,
+        parent_task_id = excluded.parent_task_id,
+        custom_fields = excluded.custom_fields,
+        tags = excluded.tags,
+        metadata = excluded.metadata,
+        updated_at = CURRENT_TIMESTAMP,
+        row_version = excluded.row_version
+"""
+
+
+def _with_row_versions(cursor, task_rows):
+    """
+    Añade a cada fila de _task_row su row_version, tomada de la secuencia global
+    task_row_version_seq (dentro de la transacción del guardado). La secuencia no
+    retrocede nunca, así que una tarea borrada y creada de nuevo no puede repetir
+    una versión que otro proceso tenga en su caché.
+    """
+    cursor.execute("UPDATE task_row_version_seq SET value = value + ? WHERE id = 1", (len(task_rows),))
+    cursor.execute("SELECT value FROM task_row_version_seq WHERE id = 1")
+    first = cursor.fetchone()['value'] - len(task_rows) + 1
+    return [row + (first + i,) for i, row in enumerate(task_rows)]
+
+
+def _task_row(task_data):
+    """Convierte un diccionario de tarea en la tupla de parámetros de _UPSERT_TASK_SQL"""
+    task_id = task_data.get('id')
+    name = task_data.get('name', 'Sin nombre')
+    list_id = task_data.get('list_id')
+    status = task_data.get('status', 'pendiente')
+    status_text = task_data.get('status_text')
+    url = task_data.get('url')
+    description = task_data.get('description')
+    priority = task_data.get('priority')
+
+    # Convertir assignees a JSON si es una lista (incluso si está vacía)
+    assignees = task_data.get('assignees')
+    if isinstance(assignees, list):
+        assignees = json.dumps(assignees)
+    elif assignees is not None and not isinstance(assignees, str):
+        assignees = json.dumps(assignees)
+
+    date_updated = task_data.get('date_updated')
+    date_created = task_data.get('date_created')
+    date_closed = task_data.get('date_closed')
+    due_date = task_data.get('due_date')
+    start_date = task_data.get('start_date')
+    time_estimate = task_data.get('time_estimate')
+    time_spent = task_data.get('time_spent')
+    horas_trabajadas = task_data.get('horas_trabajadas', 0)
+    minutos_trabajados = task_data.get('minutos_trabajados', 0)
+    parent_task_id = task_data.get('parent_task_id')
+
+    # Convertir custom_fields a JSON si es lista/dict (incluso si está vacío)
+    custom_fields = task_data.get('custom_fields')
+    if custom_fields is not None and not isinstance(custom_fields, str):
+        custom_fields = json.dumps(custom_fields)
+
+    # Convertir tags a JSON si es una lista (incluso si está vacía)
+    tags = task_data.get('tags')
+    if isinstance(tags, list):
+        tags = json.dumps(tags)
+    elif tags is not None and not isinstance(tags, str):
+        tags = json.dumps(tags)
+
+    # Convertir metadata a JSON si es dict/list (incluso si está vacío)
+    metadata = task_data.get('metadata')
+    if metadata is not None and not isinstance(metadata, str):
+        metadata = json.dumps(metadata)
+
+    return (
+        task_id, name, list_id, status, status_text, url, description, priority,
+        assignees, date_created, date_updated, date_closed, due_date, start_date,
+        time_estimate, time_spent, horas_trabajadas, minutos_trabajados,
+        parent_task_id, custom_fields, tags, metadata
+    )
+
+
+def save_task(task_data):
+    """
+    Guarda o actualiza una tarea
+    task_data debe ser un diccionario con los campos de la tarea
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM task_alerts WHERE task_id = ?", (task_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        try:
+            cursor.execute(_UPSERT_TASK_SQL, _with_row_versions(cursor, [_task_row(task_data)])[0])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    _task_cache.discard([task_data.get('id')])
 
 
-def get_all_active_alerts():
-    """Obtiene todas las alertas activas"""
+def save_tasks_bulk(tasks, status_changes=None):
+    """
+    Guarda o actualiza varias tareas (y opcionalmente sus cambios de estado)
+    en una única transacción.
+
+    Args:
+        tasks: iterable de diccionarios de tarea (mismo formato que save_task)
+        status_changes: iterable de diccionarios con task_id, old_status, new_status,
+                        old_status_text, new_status_text y changed_at (opcional)
+
+    Returns:
+        tuple: (tareas guardadas, cambios de estado registrados)
+    """
+    task_rows = [_task_row(task) for task in tasks]
+    change_rows = [_status_change_row(change) for change in (status_changes or [])]
+
+    if not task_rows and not change_rows:
+        return 0, 0
+
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT ta.*, t.name as task_name, t.url as task_url, t.date_updated
-            FROM task_alerts ta
-            JOIN tasks t ON ta.task_id = t.id
-            WHERE ta.aviso_activado = 1
-        """)
-        return [dict(row) for row in cursor.fetchall()]
+        try:
+            if task_rows:
+                cursor.executemany(_UPSERT_TASK_SQL, _with_row_versions(cursor, task_rows))
+            if change_rows:
+                cursor.executemany(_INSERT_STATUS_CHANGE_SQL, change_rows)
+                _update_time_totals_for_changes(cursor, change_rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
+    _task_cache.discard([row[0] for row in task_rows])
+    return len(task_rows), len(change_rows)
 
-def update_alert_last_sent(task_id):
-    """Actualiza la fecha del último envío de email de alerta"""
+
+def _chunks(values, size=500):
+    """Divide una lista en bloques para no superar el límite de parámetros de SQLite"""
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def get_tasks_status_map(task_ids):
+    """
+    Obtiene el estado actual de varias tareas en una sola consulta por bloque
+    Retorna un diccionario {task_id: {'status': ..., 'status_text': ...}}
+    """
+    result = {}
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE task_alerts
-            SET ultimo_envio_email = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
-            WHERE task_id = ?
-        """, (task_id,))
-        conn.commit()
+        for chunk in _chunks(task_ids):
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"""
+                SELECT id, status, status_text FROM tasks
+                WHERE id IN ({placeholders})
+            """, chunk)
+            for row in cursor.fetchall():
+                result[row['id']] = {'status': row['status'], 'status_text': row['status_text']}
+    return result
+
+
+# === CACHÉ DE LECTURA DE TAREAS ===
+# get_task guarda en memoria la última fila leída de cada tarea junto con su
+# row_version. En cada lectura solo se consulta la versión (búsqueda por clave);
+# si coincide se devuelve la copia en memoria sin volver a leer la fila. Como
+# save_task asigna a la fila una versión nueva de una secuencia global (también al
+# crearla), la invalidación vale para todos los procesos. Las columnas JSON se decodifican solo al acceder a ellas.
+
+TASK_CACHE_MAX_ENTRIES = int(os.getenv('TASK_CACHE_MAX_ENTRIES', '2000'))
+
+_TASK_JSON_COLUMNS = ('assignees', 'custom_fields', 'tags', 'metadata')
+
+
+class LazyTask(dict):
+    """
+    Diccionario de tarea cuyas columnas JSON (assignees, custom_fields, tags,
+    metadata) se decodifican la primera vez que se accede a ellas. Cualquier
+    recorrido completo (items, keys, iteración, json.dumps, dict(...)) las
+    decodifica todas antes, así que se comporta como un dict normal.
+    """
+
+    __slots__ = ('_raw',)
+
+    def __init__(self, columns, raw_json):
+        super().__init__(columns)
+        self._raw = dict(raw_json)
+
+    def _decode(self, key):
+        value = self._raw.pop(key)
+        if value:
+            try:
+                value = json.loads(value)
+            except (ValueError, TypeError):
+                pass
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _decode_all(self):
+        for key in list(self._raw):
+            self._decode(key)
+
+    def __missing__(self, key):
+        if key in self._raw:
+            return self._decode(key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._raw:
+            return self._decode(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        return key in self._raw or dict.__contains__(self, key)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._raw)
+
+    def __iter__(self):
+        self._decode_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._decode_all()
+        return dict.keys(self)
+
+    def items(self):
+        self._decode_all()
+        return dict.items(self)
+
+    def values(self):
+        self._decode_all()
+        return dict.values(self)
+
+    def __setitem__(self, key, value):
+        self._raw.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._raw.pop(key, _MISSING) is _MISSING:
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self._raw:
+            self._decode(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self._raw:
+            return self._decode(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        for key in dict(*args, **kwargs):
+            self._raw.pop(key, None)
+        dict.update(self, *args, **kwargs)
+
+    def copy(self):
+        self._decode_all()
+        return dict(self)
+
+    def __eq__(self, other):
+        self._decode_all()
+        if isinstance(other, LazyTask):
+            other._decode_all()
+        return dict.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        self._decode_all()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
+
+_MISSING = object()
+
+
+class _TaskReadCache:
+    """LRU en memoria de filas de tareas: task_id -> (row_version, columnas, JSON sin decodificar)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def get(self, task_id):
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is not None:
+                self._entries.move_to_end(task_id)
+            return entry
+
+    def put(self, task_id, version, columns, raw_json):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[task_id] = (version, columns, raw_json)
+            self._entries.move_to_end(task_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def discard(self, task_ids):
+        with self._lock:
+            for task_id in task_ids:
+                self._entries.pop(task_id, None)
+
+    def count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), max_entries=self.max_entries)
+
+
+_task_cache = _TaskReadCache(TASK_CACHE_MAX_ENTRIES)
+
+
+def get_task_cache_stats():
+    """Contadores de la caché de lectura de get_task (del proceso actual)"""
+    return _task_cache.get_stats()
+
+
+def clear_task_cache():
+    """Vacía la caché de lectura de get_task del proceso actual (ej: tras restaurar la BD)"""
+    _task_cache.clear()
+
+
+def get_task(task_id, use_cache=True):
+    """
+    Obtiene una tarea por ID
+
+    Con use_cache (por defecto) solo se lee row_version si la tarea ya está en
+    la caché del proceso y la versión no cambió.
+
+    Returns:
+        LazyTask (dict) o None si no existe
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+
+        entry = _task_cache.get(task_id) if use_cache else None
+        if entry is not None:
+            cursor.execute("SELECT row_version FROM tasks WHERE id = ?", (task_id,))
+            row = cursor.fetchone()
+            if row is None:
+                _task_cache.discard([task_id])
+                _task_cache.count('stale')
+                return None
+            if row['row_version'] == entry[0]:
+                _task_cache.count('hits')
+                return LazyTask(entry[1], entry[2])
+            _task_cache.count('stale')
+        else:
+            _task_cache.count('misses')
+
+        cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
+        row = cursor.fetchone()
+        if not row:
+            _task_cache.discard([task_id])
+            return None
+
+        columns = dict(row)
+        # Las columnas JSON se guardan sin parsear; LazyTask las decodifica al acceder
+        raw_json = {column: columns.pop(column) for column in _TASK_JSON_COLUMNS if column in columns}
+        _task_cache.put(task_id, columns.get('row_version'), columns, raw_json)
+        return LazyTask(columns, raw_json)
+
+
+def get_tasks_by_lists(list_ids):
+    """
+    Columnas básicas (sin JSON) de las tareas de varias listas, de la más a la
+    menos recientemente actualizada dentro de cada lista.
+    """
+    tasks = []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for chunk in _chunks(list_ids):
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"""
+                SELECT id, name, list_id, status, status_text, url, date_updated
+                FROM tasks
+                WHERE list_id IN ({placeholders})
+                ORDER BY list_id, date_updated DESC
+            """, chunk)
+            tasks.extend(dict(row) for row in cursor.fetchall())
+    orden = {list_id: i for i, list_id in enumerate(list_ids)}
+    tasks.sort(key=lambda task: orden.get(task['list_id'], len(orden)))
+    return tasks
+
+
+def get_tasks_by_list(list_id):
+    """Obtiene todas las tareas de una lista"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM tasks
+            WHERE list_id = ?
+            ORDER BY date_updated DESC
+        """, (list_id,))
+        tasks = []
+        for row in cursor.fetchall():
+            task = dict(row)
+            # Parsear JSON fields
+            if task.get('assignees'):
+                try:
+                    task['assignees'] = json.loads(task['assignees'])
+                except:
+                    pass
+            if task.get('tags'):
+                try:
+                    task['tags'] = json.loads(task['tags'])
+                except:
+                    pass
+            tasks.append(task)
+        return tasks
+
+
+def delete_task(task_id):
+    """Elimina una tarea"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+        conn.commit()
+    _task_cache.discard([task_id])
+
+
+# === FUNCIONES PARA TASK ALERTS ===
+
+def save_task_alert(task_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta='sin_actualizar'):
+    """Guarda o actualiza la configuración de alerta de una tarea"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO task_alerts (
+                task_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta,
+                ultima_actualizacion, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ON CONFLICT(task_id) DO UPDATE SET
+                aviso_activado = excluded.aviso_activado,
+                email_aviso = excluded.email_aviso,
+                aviso_dias = excluded.aviso_dias,
+                aviso_horas = excluded.aviso_horas,
+                aviso_minutos = excluded.aviso_minutos,
+                tipo_alerta = excluded.tipo_alerta,
+                ultima_actualizacion = CURRENT_TIMESTAMP,
+                updated_at = CURRENT_TIMESTAMP
+        """, (task_id, aviso_activado, email_aviso, aviso_dias, aviso_horas, aviso_minutos, tipo_alerta))
+        conn.commit()
+
+
+def get_task_alert(task_id):
+    """Obtiene la configuración de alerta de una tarea"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM task_alerts WHERE task_id = ?", (task_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+def get_all_active_alerts():
+    """Obtiene todas las alertas activas"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT ta.*, t.name as task_name, t.url as task_url, t.date_updated
+            FROM task_alerts ta
+            JOIN tasks t ON ta.task_id = t.id
+            WHERE ta.aviso_activado = 1
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_alert_timings(task_ids=None, changed_since=None):
+    """
+    Obtiene en una sola consulta las alertas con los datos de tiempo de su tarea
+    (estado, última actualización y totales en progreso) para el motor de alertas.
+
+    Args:
+        task_ids: limitar a estas tareas (incluye alertas desactivadas)
+        changed_since: solo alertas cuya alerta, tarea o totales cambiaron desde
+                       este timestamp UTC ('YYYY-MM-DD HH:MM:SS'; incluye desactivadas)
+        Sin argumentos devuelve todas las alertas activas.
+    """
+    query = """
+        SELECT
+            ta.task_id, ta.aviso_activado, ta.email_aviso, ta.aviso_dias, ta.aviso_horas,
+            ta.aviso_minutos, ta.tipo_alerta, ta.ultima_actualizacion,
+            t.name as task_name, t.url as task_url, t.status,
+            COALESCE(
+                (SELECT MAX(h.changed_at) FROM task_status_history h WHERE h.task_id = ta.task_id),
+                t.date_updated
+            ) as last_update,
+            tt.accumulated_seconds, tt.open_session_start,
+            tt.task_id IS NOT NULL as has_totals
+        FROM task_alerts ta
+        JOIN tasks t ON ta.task_id = t.id
+        LEFT JOIN task_time_totals tt ON tt.task_id = ta.task_id
+    """
+
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if task_ids is not None:
+            rows = []
+            for chunk in _chunks(list(task_ids)):
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(query + f" WHERE ta.task_id IN ({placeholders})", chunk)
+                rows.extend(dict(row) for row in cursor.fetchall())
+        elif changed_since is not None:
+            # Una subconsulta por tabla para que cada una use su índice de updated_at
+            cursor.execute(query + """
+                WHERE ta.task_id IN (
+                    SELECT task_id FROM task_alerts WHERE updated_at >= ?
+                    UNION SELECT id FROM tasks WHERE updated_at >= ?
+                    UNION SELECT task_id FROM task_time_totals WHERE updated_at >= ?
+                )
+            """, (changed_since, changed_since, changed_since))
+            rows = [dict(row) for row in cursor.fetchall()]
+        else:
+            cursor.execute(query + " WHERE ta.aviso_activado = 1")
+            rows = [dict(row) for row in cursor.fetchall()]
+
+    # Tareas en progreso sin fila de totales: calcularla (se guarda para la próxima vez)
+    for row in rows:
+        if row['aviso_activado'] and row['status'] == 'en_progreso' and not row['has_totals']:
+            time_data = calculate_task_time_in_progress(row['task_id'])
+            row['accumulated_seconds'] = time_data['total_seconds']
+            row['open_session_start'] = time_data['current_session_start']
+
+    return rows
+
+
+def count_active_alerts():
+    """Cuenta las alertas activas"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM task_alerts WHERE aviso_activado = 1")
+        return cursor.fetchone()[0]
+
+
+def get_due_alerts(margin_seconds=30):
+    """
+    Obtiene solo las alertas activas que han vencido y deben enviar email.
+
+    La evaluación se hace entera en SQLite: une task_alerts, tasks, lists, el
+    último registro del historial de estados y los totales de tiempo en progreso,
+    y compara el tiempo transcurrido con el límite (aviso_dias/horas/minutos).
+    - sin_actualizar: segundos desde el último cambio de estado (o date_updated)
+    - tiempo_total: segundos acumulados en progreso más la sesión abierta
+    Las fechas sin zona horaria (parse_date_flexible) son hora local del servidor:
+    el modificador 'utc' las pasa a UTC antes de compararlas con 'now' (a las que
+    llevan 'Z' o un desfase no les afecta).
+
+    Args:
+        margin_seconds: margen de tolerancia; la alerta vence este tiempo antes del límite
+
+    Returns:
+        lista de dicts con los datos de la alerta, project_name, elapsed_seconds y limit_seconds
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+
+        # Las tareas en progreso sin fila de totales se calculan antes (normalmente ninguna)
+        cursor.execute("""
+            SELECT ta.task_id
+            FROM task_alerts ta
+            JOIN tasks t ON ta.task_id = t.id
+            LEFT JOIN task_time_totals tt ON tt.task_id = ta.task_id
+            WHERE ta.aviso_activado = 1 AND t.status = 'en_progreso' AND tt.task_id IS NULL
+        """)
+        missing = [row['task_id'] for row in cursor.fetchall()]
+        for task_id in missing:
+            _rebuild_task_totals(cursor, task_id)
+        if missing:
+            conn.commit()
+
+        cursor.execute("""
+            WITH evaluated AS (
+                SELECT
+                    ta.task_id, ta.email_aviso, ta.aviso_dias, ta.aviso_horas, ta.aviso_minutos,
+                    ta.ultima_actualizacion, COALESCE(ta.tipo_alerta, 'sin_actualizar') as tipo_alerta,
+                    t.name as task_name, t.url as task_url,
+                    COALESCE(l.name, 'Proyecto desconocido') as project_name,
+                    COALESCE(ta.aviso_dias, 0) * 86400
+                        + COALESCE(ta.aviso_horas, 0) * 3600
+                        + COALESCE(ta.aviso_minutos, 0) * 60 as limit_seconds,
+                    CASE
+                        WHEN COALESCE(ta.tipo_alerta, 'sin_actualizar') = 'sin_actualizar' THEN
+                            (julianday('now') - julianday(COALESCE(
+                                (SELECT MAX(h.changed_at) FROM task_status_history h WHERE h.task_id = ta.task_id),
+                                t.date_updated
+                            ), 'utc')) * 86400
+                        ELSE
+                            COALESCE(tt.accumulated_seconds, 0)
+                            + COALESCE((julianday('now') - julianday(tt.open_session_start, 'utc')) * 86400, 0)
+                    END as elapsed_seconds
+                FROM task_alerts ta
+                JOIN tasks t ON ta.task_id = t.id
+                LEFT JOIN lists l ON l.id = t.list_id
+                LEFT JOIN task_time_totals tt ON tt.task_id = ta.task_id
+                WHERE ta.aviso_activado = 1
+                  AND t.status = 'en_progreso'
+                  AND ta.email_aviso IS NOT NULL AND ta.email_aviso != ''
+            )
+            SELECT * FROM evaluated
+            WHERE limit_seconds > 0
+              AND elapsed_seconds IS NOT NULL
+              AND elapsed_seconds >= limit_seconds - ?
+            ORDER BY task_id
+        """, (margin_seconds,))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def update_alert_last_sent(task_id):
+    """Actualiza la fecha del último envío de email de alerta"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE task_alerts
+            SET ultimo_envio_email = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE task_id = ?
+        """, (task_id,))
+        conn.commit()
 
 
 def deactivate_task_alert(task_id):
@@ -550,53 +1540,656 @@ def get_task_project_name(task_id):
         return dict(row)['project_name'] if row else "Proyecto desconocido"
 
 
-# === FUNCIONES PARA WEBHOOKS LOG ===
+# === FUNCIONES PARA LA BANDEJA DE SALIDA DE EMAILS ===
+
+def enqueue_email(to_email, subject, html_content, task_id=None, dedup_key=None):
+    """
+    Encola un email en email_outbox.
+
+    Si ya existe un email con el mismo dedup_key no se duplica; si ese email
+    había fallado definitivamente (status 'failed') vuelve a quedar pendiente,
+    con los intentos a cero.
+
+    Returns:
+        tuple: (id del email, True si quedó pendiente ahora (nuevo o reintentado) /
+                False si ya estaba encolado o enviado)
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO email_outbox (dedup_key, task_id, to_email, subject, html_content)
+            VALUES (?, ?, ?, ?, ?)
+        """, (dedup_key, task_id, to_email, subject, html_content))
+        if cursor.rowcount:
+            conn.commit()
+            return cursor.lastrowid, True
+
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = CURRENT_TIMESTAMP, claimed_at = NULL
+            WHERE dedup_key = ? AND status = 'failed'
+        """, (dedup_key,))
+        reintentado = cursor.rowcount > 0
+        conn.commit()
+        cursor.execute("SELECT id FROM email_outbox WHERE dedup_key = ?", (dedup_key,))
+        return cursor.fetchone()['id'], reintentado
+
+
+def claim_outbox_batch(limit, claim_timeout_seconds=300, lease=None):
+    """
+    Reclama un lote de emails listos para enviar (pendientes cuyo reintento ya
+    toca, o en envío cuya reclamación caducó porque el worker murió).
+
+    Args:
+        lease: tupla opcional (name, holder_id, fencing_token); si ya no es la
+               concesión vigente no se reclama nada
+
+    Returns:
+        lista de dicts (attempts ya incrementado)
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        if lease is not None and not _lease_is_held(cursor, *lease):
+            conn.commit()
+            return []
+        cursor.execute("""
+            SELECT * FROM email_outbox
+            WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+               OR (status = 'sending' AND claimed_at < datetime('now', ?))
+            ORDER BY id
+            LIMIT ?
+        """, (f'-{int(claim_timeout_seconds)} seconds', limit))
+        rows = [dict(row) for row in cursor.fetchall()]
+
+        if rows:
+            cursor.executemany("""
+                UPDATE email_outbox
+                SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+                WHERE id = ?
+            """, [(row['id'],) for row in rows])
+        conn.commit()
+
+        for row in rows:
+            row['attempts'] += 1
+        return rows
+
+
+def mark_outbox_sent(email_ids, message_ids=None):
+    """
+    Marca emails como enviados y desactiva las alertas de sus tareas en la
+    misma transacción. Es idempotente: un email ya enviado no se vuelve a tocar.
+    """
+    if not email_ids:
+        return
+    message_ids = list(message_ids or [])
+    with get_db() as conn:
+        cursor = conn.cursor()
+        task_ids = set()
+        for i, email_id in enumerate(email_ids):
+            cursor.execute("""
+                UPDATE email_outbox
+                SET status = 'sent', sent_at = CURRENT_TIMESTAMP, claimed_at = NULL,
+                    last_error = NULL, message_id = ?
+                WHERE id = ? AND status != 'sent'
+            """, (message_ids[i] if i < len(message_ids) else None, email_id))
+            if cursor.rowcount:
+                cursor.execute("SELECT task_id FROM email_outbox WHERE id = ?", (email_id,))
+                task_id = cursor.fetchone()['task_id']
+                if task_id:
+                    task_ids.add(task_id)
+
+        # La alerta solo se desactiva cuando Brevo confirma el envío
+        cursor.executemany("""
+            UPDATE task_alerts
+            SET aviso_activado = 0,
+                ultimo_envio_email = CURRENT_TIMESTAMP,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE task_id = ?
+        """, [(task_id,) for task_id in task_ids])
+        conn.commit()
+
+    for task_id in task_ids:
+        print(f"[INFO] Alerta desactivada para tarea {task_id}")
+
+
+def mark_outbox_retry(email_id, error, delay_seconds):
+    """Devuelve un email a pendiente para reintentarlo dentro de delay_seconds"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'pending', claimed_at = NULL, last_error = ?,
+                next_attempt_at = datetime('now', ?)
+            WHERE id = ? AND status != 'sent'
+        """, (error, f'+{int(delay_seconds)} seconds', email_id))
+        conn.commit()
+
+
+def mark_outbox_failed(email_id, error):
+    """Marca un email como fallido definitivamente (no se reintenta)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'failed', claimed_at = NULL, last_error = ?
+            WHERE id = ? AND status != 'sent'
+        """, (error, email_id))
+        conn.commit()
+
+
+def get_outbox_stats():
+    """Cuenta los emails de la bandeja por estado"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, COUNT(*) as total FROM email_outbox GROUP BY status")
+        counts = {row['status']: row['total'] for row in cursor.fetchall()}
+        return {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'failed')}
+
+
+# === FUNCIONES PARA WEBHOOKS LOG ===
+
+# Periodos de los contadores de webhooks (formato del bucket en UTC) y días que se conservan
+WEBHOOK_STATS_GRANULARITIES = {
+    'minute': '%Y-%m-%d %H:%M',
+    'hour': '%Y-%m-%d %H',
+    'day': '%Y-%m-%d',
+}
+WEBHOOK_STATS_KEEP_DAYS = {'minute': 2, 'hour': 90}
+
+# Límites superiores (ms) de los tramos del histograma de latencia; el último recoge el resto
+WEBHOOK_LATENCY_BOUNDS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000,
+                             60000, 300000, 900000, 3600000, 86400000)
+
+
+def _bump_webhook_stats(cursor, event_type, total=0, processed=0, errors=0, duplicates=0, latency_ms=None):
+    """Suma a los contadores de webhooks del minuto, hora y día actuales y al total (dentro de la transacción)"""
+    now = time.gmtime()
+    buckets = [(granularity, time.strftime(fmt, now)) for granularity, fmt in WEBHOOK_STATS_GRANULARITIES.items()]
+    buckets.append(('total', ''))
+
+    latency_count = 0 if latency_ms is None else 1
+    latency_sum = 0 if latency_ms is None else int(latency_ms)
+    cursor.executemany("""
+        INSERT INTO webhook_stats (
+            granularity, bucket, event_type, total, processed, errors, duplicates, latency_count, latency_sum_ms
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(granularity, bucket, event_type) DO UPDATE SET
+            total = total + excluded.total,
+            processed = processed + excluded.processed,
+            errors = errors + excluded.errors,
+            duplicates = duplicates + excluded.duplicates,
+            latency_count = latency_count + excluded.latency_count,
+            latency_sum_ms = latency_sum_ms + excluded.latency_sum_ms
+    """, [(granularity, bucket, event_type, total, processed, errors, duplicates, latency_count, latency_sum)
+          for granularity, bucket in buckets])
+
+    if latency_ms is not None:
+        le_ms = next((bound for bound in WEBHOOK_LATENCY_BOUNDS_MS if latency_ms <= bound),
+                     WEBHOOK_LATENCY_BOUNDS_MS[-1])
+        cursor.executemany("""
+            INSERT INTO webhook_latency_hist (granularity, bucket, event_type, le_ms, count)
+            VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT(granularity, bucket, event_type, le_ms) DO UPDATE SET count = count + 1
+        """, [(granularity, bucket, event_type, le_ms) for granularity, bucket in buckets])
+
+
+def log_webhook(event_type, payload, task_id=None, list_id=None, folder_id=None, space_id=None, queued=False,
+                dedup_key=None, payload_json=None):
+    """
+    Registra un webhook recibido
+
+    Args:
+        queued: True si el webhook queda en cola para los workers asíncronos.
+                Si es False se procesa en línea y se registra ya reclamado (un intento).
+        dedup_key: clave de idempotencia. Si ya hay un webhook con la misma clave
+                   es un reintento: se suma a su contador de duplicados y se devuelve None.
+                   Si aquel terminó con error, se reutiliza su fila para procesarlo de nuevo.
+        payload_json: payload ya serializado (ej: el cuerpo recibido tal cual), para no volver a serializarlo
+
+    Returns:
+        int: id del webhook a procesar, o None si es un duplicado
+    """
+    if payload_json is None:
+        payload_json = json.dumps(payload)
+
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("""
+            INSERT INTO webhooks_log (
+                event_type, task_id, list_id, folder_id, space_id, payload, claimed_at, attempts, dedup_key,
+                received_ms
+            )
+            VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? THEN NULL ELSE CURRENT_TIMESTAMP END, ?, ?, ?)
+            ON CONFLICT(dedup_key) WHERE dedup_key IS NOT NULL DO NOTHING
+        """, (event_type, task_id, list_id, folder_id, space_id, payload_json,
+              queued, 0 if queued else 1, dedup_key, int(time.time() * 1000)))
+        if cursor.rowcount:
+            webhook_log_id = cursor.lastrowid
+            _bump_webhook_stats(cursor, event_type, total=1)
+            conn.commit()
+            return webhook_log_id
+
+        cursor.execute("""
+            SELECT id, event_type, processed, error FROM webhooks_log WHERE dedup_key = ?
+        """, (dedup_key,))
+        existing = cursor.fetchone()
+
+        if existing['processed'] and existing['error'] is not None:
+            # El intento anterior falló: este reintento se procesa sobre la misma fila
+            cursor.execute("""
+                UPDATE webhooks_log
+                SET processed = 0, processed_at = NULL, error = NULL, payload = ?, received_ms = ?,
+                    claimed_at = CASE WHEN ? THEN NULL ELSE CURRENT_TIMESTAMP END,
+                    attempts = CASE WHEN ? THEN 0 ELSE attempts + 1 END
+                WHERE id = ?
+            """, (payload_json, int(time.time() * 1000), queued, queued, existing['id']))
+            # El intento fallido ya sumó processed y errors: el reintento cuenta como un webhook más
+            # en total (restarlo de los periodos actuales no sirve si falló en otro minuto u hora)
+            _bump_webhook_stats(cursor, existing['event_type'], total=1)
+            conn.commit()
+            return existing['id']
+
+        cursor.execute("UPDATE webhooks_log SET duplicates = duplicates + 1 WHERE id = ?", (existing['id'],))
+        _bump_webhook_stats(cursor, existing['event_type'], duplicates=1)
+        conn.commit()
+        return None
+
+
+def count_webhook_duplicate(dedup_key):
+    """Suma un duplicado al webhook con esa clave (detectado sin pasar por log_webhook)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("UPDATE webhooks_log SET duplicates = duplicates + 1 WHERE dedup_key = ?", (dedup_key,))
+        counted = cursor.rowcount > 0
+        if counted:
+            cursor.execute("SELECT event_type FROM webhooks_log WHERE dedup_key = ?", (dedup_key,))
+            _bump_webhook_stats(cursor, cursor.fetchone()['event_type'], duplicates=1)
+        conn.commit()
+        return counted
+
+
+def mark_webhook_processed(webhook_log_id, error=None):
+    """Marca un webhook como procesado y suma su resultado y su latencia a los contadores"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("""
+            UPDATE webhooks_log
+            SET processed = 1, processed_at = CURRENT_TIMESTAMP, error = ?
+            WHERE id = ?
+        """, (error, webhook_log_id))
+        if cursor.rowcount:
+            cursor.execute("""
+                SELECT event_type, received_ms,
+                       (julianday('now') - julianday(received_at)) * 86400000 as latency_fallback_ms
+                FROM webhooks_log WHERE id = ?
+            """, (webhook_log_id,))
+            row = cursor.fetchone()
+            # Los webhooks anteriores a received_ms solo tienen received_at (resolución de segundos)
+            latency_ms = (time.time() * 1000 - row['received_ms'] if row['received_ms'] is not None
+                          else row['latency_fallback_ms'])
+            _bump_webhook_stats(cursor, row['event_type'], processed=1, errors=1 if error is not None else 0,
+                                latency_ms=max(0, latency_ms))
+        conn.commit()
+
+
+# Webhooks abandonados tras agotar los intentos (parámetros: max_attempts, expiry)
+_ABANDONED_WEBHOOKS_WHERE = """
+    processed = 0 AND attempts >= ?
+    AND claimed_at IS NOT NULL AND claimed_at < datetime('now', ?)
+"""
+
+# Siguiente webhook reclamable (parámetros: max_attempts, expiry, coalesce_seconds, received_ms límite)
+_CLAIMABLE_WEBHOOK_SQL = """
+    SELECT w.* FROM webhooks_log w
+    WHERE w.processed = 0
+      AND w.attempts < ?
+      AND (w.claimed_at IS NULL OR w.claimed_at < datetime('now', ?))
+      AND (w.task_id IS NULL OR NOT EXISTS (
+            SELECT 1 FROM webhooks_log p
+            WHERE p.task_id = w.task_id AND p.processed = 0 AND p.id < w.id
+      ))
+      AND (w.task_id IS NULL OR ? <= 0 OR w.received_ms IS NULL OR w.received_ms <= ?)
+    ORDER BY w.id
+    LIMIT 1
+"""
+
+
+def claim_next_webhook(claim_timeout_seconds=300, max_attempts=5, coalesce_seconds=0, max_coalesced=50):
+    """
+    Reclama el siguiente webhook pendiente de la cola para un worker.
+
+    Un webhook es reclamable si no está procesado, no lo tiene otro worker (o su
+    reclamación caducó porque el proceso murió) y no hay webhooks anteriores
+    pendientes de la misma tarea, para que los eventos de una tarea se apliquen en orden.
+
+    Con coalesce_seconds > 0 los eventos de tarea esperan ese tiempo desde su
+    recepción (received_ms) y se reclaman junto con los eventos siguientes pendientes
+    de la misma tarea (hasta max_coalesced, sin pasar de un taskDeleted), que se
+    devuelven en la clave 'coalesced' para aplicarlos de una vez.
+
+    Primero se comprueba con una lectura si hay trabajo; el bloqueo de escritura
+    (BEGIN IMMEDIATE) solo se toma cuando hay algo que reclamar o cerrar.
+
+    Returns:
+        dict con la fila reclamada (attempts ya incrementado) o None si no hay trabajo
+    """
+    expiry = f'-{int(claim_timeout_seconds)} seconds'
+    params = (max_attempts, expiry, coalesce_seconds, int(time.time() * 1000 - coalesce_seconds * 1000))
+    with get_db() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(f"SELECT EXISTS(SELECT 1 FROM webhooks_log WHERE {_ABANDONED_WEBHOOKS_WHERE})",
+                       (max_attempts, expiry))
+        if not cursor.fetchone()[0]:
+            cursor.execute(_CLAIMABLE_WEBHOOK_SQL, params)
+            if cursor.fetchone() is None:
+                return None
+
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # Webhooks abandonados tras agotar los intentos: cerrarlos para no bloquear su tarea
+        cursor.execute(f"SELECT id, event_type FROM webhooks_log WHERE {_ABANDONED_WEBHOOKS_WHERE}",
+                       (max_attempts, expiry))
+        abandonados = cursor.fetchall()
+        for abandonado in abandonados:
+            cursor.execute("""
+                UPDATE webhooks_log
+                SET processed = 1, processed_at = CURRENT_TIMESTAMP,
+                    error = COALESCE(error, 'Máximo de intentos alcanzado')
+                WHERE id = ?
+            """, (abandonado['id'],))
+            _bump_webhook_stats(cursor, abandonado['event_type'], processed=1, errors=1)
+
+        # Otro worker puede haberlo reclamado entre la lectura y el bloqueo
+        cursor.execute(_CLAIMABLE_WEBHOOK_SQL, params)
+        row = cursor.fetchone()
+
+        if row is None:
+            conn.commit()
+            return None
+
+        claimed = dict(row)
+        claimed['coalesced'] = []
+        if coalesce_seconds > 0 and row['task_id'] and row['event_type'] != 'taskDeleted':
+            cursor.execute("""
+                SELECT * FROM webhooks_log
+                WHERE task_id = ? AND processed = 0 AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """, (row['task_id'], row['id'], max_coalesced))
+            for siguiente in cursor.fetchall():
+                # Solo eventos consecutivos de la tarea que nadie tiene reclamados
+                if (siguiente['event_type'] == 'taskDeleted' or siguiente['claimed_at'] is not None
+                        or siguiente['attempts'] >= max_attempts):
+                    break
+                claimed['coalesced'].append(dict(siguiente, attempts=siguiente['attempts'] + 1))
+
+        ids = [(row['id'],)] + [(siguiente['id'],) for siguiente in claimed['coalesced']]
+        cursor.executemany("""
+            UPDATE webhooks_log
+            SET claimed_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE id = ?
+        """, ids)
+        conn.commit()
+
+        claimed['attempts'] += 1
+        return claimed
+
+
+def get_webhook_coalesce_wait(coalesce_seconds, max_attempts=5):
+    """
+    Segundos hasta que el webhook de tarea pendiente más antiguo que aún está dentro
+    de la ventana de coalescencia pase a ser reclamable (None si no hay ninguno), para
+    que los workers duerman justo hasta entonces.
+    """
+    if coalesce_seconds <= 0:
+        return None
+    now_ms = time.time() * 1000
+    window_ms = coalesce_seconds * 1000
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT MIN(received_ms) FROM webhooks_log
+            WHERE processed = 0 AND claimed_at IS NULL AND attempts < ?
+              AND task_id IS NOT NULL AND received_ms > ?
+        """, (max_attempts, int(now_ms - window_ms)))
+        oldest = cursor.fetchone()[0]
+    if oldest is None:
+        return None
+    return max(0.0, (oldest + window_ms - now_ms) / 1000)
+
+
+def release_webhook(webhook_log_id, error=None):
+    """Devuelve un webhook a la cola tras un fallo para que se reintente"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE webhooks_log
+            SET claimed_at = NULL, error = ?
+            WHERE id = ?
+        """, (error, webhook_log_id))
+        conn.commit()
+
+
+def get_webhook_queue_stats():
+    """Obtiene el estado de la cola asíncrona de webhooks (pendientes y en proceso)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT
+                SUM(CASE WHEN claimed_at IS NULL THEN 1 ELSE 0 END) as pending,
+                SUM(CASE WHEN claimed_at IS NOT NULL THEN 1 ELSE 0 END) as in_progress,
+                MIN(received_at) as oldest_received_at
+            FROM webhooks_log
+            WHERE processed = 0
+        """)
+        row = dict(cursor.fetchone())
+        row['pending'] = row['pending'] or 0
+        row['in_progress'] = row['in_progress'] or 0
+        return row
+
+
+def get_webhook_stats(window_seconds=None):
+    """
+    Estadísticas de webhooks por tipo de evento, leídas de los contadores de webhook_stats.
+
+    Args:
+        window_seconds: solo los últimos N segundos (None = desde el principio). Se usan
+            los periodos de minuto hasta 2 horas, de hora hasta WEBHOOK_STATS_KEEP_DAYS['hour']
+            días y de día para ventanas mayores; la ventana empieza al inicio de su periodo.
+
+    Returns:
+        list: dicts con event_type, total, processed, errors, duplicates y latency
+              (count, avg_ms y percentiles p50/p90/p99 aproximados por el histograma)
+    """
+    if window_seconds is None:
+        granularity, since = 'total', ''
+    else:
+        if window_seconds <= 2 * 3600:
+            granularity = 'minute'
+        elif window_seconds <= WEBHOOK_STATS_KEEP_DAYS['hour'] * 86400:
+            granularity = 'hour'
+        else:
+            granularity = 'day'
+        since = time.strftime(WEBHOOK_STATS_GRANULARITIES[granularity],
+                              time.gmtime(time.time() - window_seconds))
+
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT event_type, SUM(total) as total, SUM(processed) as processed,
+                   SUM(errors) as errors, SUM(duplicates) as duplicates,
+                   SUM(latency_count) as latency_count, SUM(latency_sum_ms) as latency_sum_ms
+            FROM webhook_stats
+            WHERE granularity = ? AND bucket >= ?
+            GROUP BY event_type
+        """, (granularity, since))
+        stats = [dict(row) for row in cursor.fetchall()]
+
+        cursor.execute("""
+            SELECT event_type, le_ms, SUM(count) as count
+            FROM webhook_latency_hist
+            WHERE granularity = ? AND bucket >= ?
+            GROUP BY event_type, le_ms
+            ORDER BY event_type, le_ms
+        """, (granularity, since))
+        histogramas = {}
+        for row in cursor.fetchall():
+            histogramas.setdefault(row['event_type'], []).append((row['le_ms'], row['count']))
+
+    for fila in stats:
+        latency_count = fila.pop('latency_count') or 0
+        latency_sum_ms = fila.pop('latency_sum_ms') or 0
+        latency = {'count': latency_count,
+                   'avg_ms': round(latency_sum_ms / latency_count, 1) if latency_count else None}
+        tramos = histogramas.get(fila['event_type'], [])
+        for nombre, q in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+            # Límite superior del primer tramo que acumula el percentil
+            latency[nombre] = None
+            acumulado = 0
+            for le_ms, count in tramos:
+                acumulado += count
+                if acumulado >= q * latency_count:
+                    latency[nombre] = le_ms
+                    break
+        fila['latency'] = latency
+    return stats
+
+
+def prune_webhook_stats():
+    """Borra los contadores de minuto y hora más antiguos que WEBHOOK_STATS_KEEP_DAYS. Devuelve cuántos"""
+    borrados = 0
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for granularity, keep_days in WEBHOOK_STATS_KEEP_DAYS.items():
+            limite = time.strftime(WEBHOOK_STATS_GRANULARITIES[granularity],
+                                   time.gmtime(time.time() - keep_days * 86400))
+            for table in ('webhook_stats', 'webhook_latency_hist'):
+                cursor.execute(f"DELETE FROM {table} WHERE granularity = ? AND bucket < ?",
+                               (granularity, limite))
+                borrados += cursor.rowcount
+        conn.commit()
+    return borrados
+
+
+# === RETENCIÓN DE WEBHOOKS ===
+# Los webhooks procesados se sacan de webhooks_log tras unos días (ver webhook_archive.py);
+# las estadísticas no cambian porque salen de webhook_stats, no de webhooks_log.
+
+def get_archivable_webhooks(older_than_days, limit=5000):
+    """Webhooks procesados recibidos hace más de older_than_days días, en orden de id"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM webhooks_log
+            WHERE processed = 1 AND received_at < datetime('now', ?)
+            ORDER BY id
+            LIMIT ?
+        """, (f'-{int(older_than_days)} days', limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def delete_archived_webhooks(rows):
+    """
+    Borra de webhooks_log los webhooks ya archivados.
+
+    Returns:
+        int: filas borradas
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.executemany("DELETE FROM webhooks_log WHERE id = ?", [(row['id'],) for row in rows])
+            deleted = cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return deleted
+
+
+def incremental_vacuum(max_pages=2000):
+    """
+    Devuelve al sistema de ficheros hasta max_pages páginas libres de la BD.
+
+    Si la BD no tiene auto_vacuum incremental (creada antes de activarlo) no hace
+    nada: la conversión es un VACUUM completo con bloqueo exclusivo y se lanza a
+    mano con enable_incremental_vacuum().
 
-def log_webhook(event_type, payload, task_id=None, list_id=None, folder_id=None, space_id=None):
-    """Registra un webhook recibido"""
+    Returns:
+        dict: páginas libres antes y después, y si el vacuum incremental está activo
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO webhooks_log (
-                event_type, task_id, list_id, folder_id, space_id, payload
-            )
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (event_type, task_id, list_id, folder_id, space_id, json.dumps(payload)))
-        conn.commit()
-        return cursor.lastrowid
+        freelist_before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        enabled = cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if enabled:
+            # executescript avanza la sentencia hasta el final (execute solo libera una página)
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+        freelist_after = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        return {
+            'enabled': enabled,
+            'freelist_before': freelist_before,
+            'freelist_after': freelist_after,
+            'page_size': cursor.execute("PRAGMA page_size").fetchone()[0]
+        }
 
 
-def mark_webhook_processed(webhook_log_id, error=None):
-    """Marca un webhook como procesado"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE webhooks_log
-            SET processed = 1, processed_at = CURRENT_TIMESTAMP, error = ?
-            WHERE id = ?
-        """, (error, webhook_log_id))
-        conn.commit()
+def enable_incremental_vacuum():
+    """
+    Convierte una BD existente a auto_vacuum incremental con un VACUUM completo.
 
+    Reescribe el fichero entero con un bloqueo exclusivo (las escrituras esperan
+    hasta busy_timeout): ejecutarlo con el servicio parado o en una ventana de
+    mantenimiento.
 
-def get_webhook_stats():
-    """Obtiene estadísticas de webhooks procesados"""
+    Returns:
+        dict: tamaño en páginas antes y después, y si ya estaba activado
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT
-                event_type,
-                COUNT(*) as total,
-                SUM(CASE WHEN processed = 1 THEN 1 ELSE 0 END) as processed,
-                SUM(CASE WHEN error IS NOT NULL THEN 1 ELSE 0 END) as errors
-            FROM webhooks_log
-            GROUP BY event_type
-        """)
-        return [dict(row) for row in cursor.fetchall()]
+        pages_before = cursor.execute("PRAGMA page_count").fetchone()[0]
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return {'already_enabled': True, 'pages_before': pages_before, 'pages_after': pages_before}
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+        return {
+            'already_enabled': False,
+            'pages_before': pages_before,
+            'pages_after': cursor.execute("PRAGMA page_count").fetchone()[0]
+        }
 
 
 # === FUNCIONES PARA TASK STATUS HISTORY ===
 
-def save_status_change(task_id, old_status, new_status, old_status_text=None, new_status_text=None, changed_at=None):
+_INSERT_STATUS_CHANGE_SQL = """
+    INSERT INTO task_status_history (
+        task_id, old_status, new_status, old_status_text, new_status_text, changed_at, webhook_log_id
+    )
+    VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)
+"""
+
+
+def _status_change_row(change):
+    """Convierte un diccionario de cambio de estado en parámetros de _INSERT_STATUS_CHANGE_SQL"""
+    return (
+        change['task_id'],
+        change.get('old_status'),
+        change['new_status'],
+        change.get('old_status_text'),
+        change.get('new_status_text'),
+        change.get('changed_at') or None,
+        change.get('webhook_log_id')
+    )
+
+
+def save_status_change(task_id, old_status, new_status, old_status_text=None, new_status_text=None, changed_at=None,
+                       webhook_log_id=None):
     """
     Registra un cambio de estado de una tarea
 
@@ -607,29 +2200,221 @@ def save_status_change(task_id, old_status, new_status, old_status_text=None, ne
         old_status_text: Texto del estado anterior (opcional)
         new_status_text: Texto del nuevo estado (opcional)
         changed_at: Timestamp del cambio en formato ISO (opcional, usa CURRENT_TIMESTAMP si no se proporciona)
+        webhook_log_id: webhook de webhooks_log que originó el cambio (opcional)
     """
     with get_db() as conn:
         cursor = conn.cursor()
+        row = _status_change_row({
+            'task_id': task_id,
+            'old_status': old_status,
+            'new_status': new_status,
+            'old_status_text': old_status_text,
+            'new_status_text': new_status_text,
+            'changed_at': changed_at,
+            'webhook_log_id': webhook_log_id
+        })
+        try:
+            cursor.execute(_INSERT_STATUS_CHANGE_SQL, row)
+            change_id = cursor.lastrowid
+            _update_time_totals_for_changes(cursor, [row])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return change_id
 
-        if changed_at:
-            # Usar el timestamp proporcionado
-            cursor.execute("""
-                INSERT INTO task_status_history (
-                    task_id, old_status, new_status, old_status_text, new_status_text, changed_at
-                )
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (task_id, old_status, new_status, old_status_text, new_status_text, changed_at))
-        else:
-            # Usar CURRENT_TIMESTAMP si no se proporciona
-            cursor.execute("""
-                INSERT INTO task_status_history (
-                    task_id, old_status, new_status, old_status_text, new_status_text, changed_at
-                )
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            """, (task_id, old_status, new_status, old_status_text, new_status_text))
 
-        conn.commit()
-        return cursor.lastrowid
+def get_recorded_webhook_changes(task_id, webhook_log_ids):
+    """Los webhook_log_id (de entre los dados) que ya registraron un cambio de estado de la tarea"""
+    webhook_log_ids = [webhook_log_id for webhook_log_id in webhook_log_ids if webhook_log_id is not None]
+    if not webhook_log_ids:
+        return set()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        recorded = set()
+        for chunk in _chunks(webhook_log_ids):
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"""
+                SELECT webhook_log_id FROM task_status_history
+                WHERE task_id = ? AND webhook_log_id IN ({placeholders})
+            """, [task_id] + chunk)
+            recorded.update(row['webhook_log_id'] for row in cursor.fetchall())
+        return recorded
+
+
+# === TOTALES DE TIEMPO EN PROGRESO ===
+# task_time_totals guarda, por tarea, el tiempo acumulado de los periodos en progreso
+# ya cerrados y el inicio de la sesión abierta. Se actualiza de forma incremental con
+# cada cambio de estado, así que leer el tiempo de una tarea es una búsqueda por clave.
+
+def _parse_history_timestamp(changed_at, task_id):
+    """Parsea el changed_at de un registro de historial (None si no es válido)"""
+    try:
+        return datetime.fromisoformat(changed_at)
+    except (ValueError, TypeError) as e:
+        print(f"[ERROR] Error al parsear fecha '{changed_at}' para tarea {task_id}: {str(e)}")
+        # Intentar parsear con .replace('Z', '+00:00') por si es formato ISO con Z
+        try:
+            return datetime.fromisoformat(changed_at.replace('Z', '+00:00'))
+        except:
+            print(f"[WARNING] No se pudo parsear fecha '{changed_at}', saltando registro para tarea {task_id}")
+            return None
+
+
+def _apply_status_transition(state, task_id, new_status, changed_at):
+    """
+    Aplica un registro de historial al estado acumulado de una tarea.
+    state es un dict con 'total_seconds' y 'in_progress_start' (datetime o None).
+    """
+    timestamp = _parse_history_timestamp(changed_at, task_id)
+    if timestamp is None:
+        return
+
+    if new_status == 'en_progreso':
+        # Inicio de un periodo en progreso
+        state['in_progress_start'] = timestamp
+    elif state['in_progress_start']:
+        # Fin de un periodo en progreso
+        try:
+            duration = (timestamp - state['in_progress_start']).total_seconds()
+            state['total_seconds'] += duration
+        except Exception as e:
+            print(f"[ERROR] Error al calcular duración para tarea {task_id}: {str(e)}")
+        state['in_progress_start'] = None  # Resetear para evitar cálculos incorrectos
+
+
+def _replay_status_history(cursor, task_id):
+    """Recalcula el estado acumulado de una tarea recorriendo todo su historial"""
+    cursor.execute("""
+        SELECT new_status, changed_at
+        FROM task_status_history
+        WHERE task_id = ?
+        ORDER BY changed_at ASC, id ASC
+    """, (task_id,))
+
+    state = {'total_seconds': 0, 'in_progress_start': None}
+    last_changed_at = None
+    for record in cursor.fetchall():
+        _apply_status_transition(state, task_id, record['new_status'], record['changed_at'])
+        last_changed_at = record['changed_at']
+    return state, last_changed_at
+
+
+def _store_time_totals(cursor, task_id, state, last_changed_at):
+    open_start = state['in_progress_start'].isoformat() if state['in_progress_start'] else None
+    cursor.execute("""
+        INSERT INTO task_time_totals (task_id, accumulated_seconds, open_session_start, last_changed_at, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(task_id) DO UPDATE SET
+            accumulated_seconds = excluded.accumulated_seconds,
+            open_session_start = excluded.open_session_start,
+            last_changed_at = excluded.last_changed_at,
+            updated_at = CURRENT_TIMESTAMP
+    """, (task_id, state['total_seconds'], open_start, last_changed_at))
+    # Avisar a los streams en vivo (se lee tras el commit de la misma transacción)
+    cursor.execute("INSERT INTO task_time_changes (task_id) VALUES (?)", (task_id,))
+
+
+def _rebuild_task_totals(cursor, task_id):
+    state, last_changed_at = _replay_status_history(cursor, task_id)
+    _store_time_totals(cursor, task_id, state, last_changed_at)
+    return state
+
+
+def _update_time_totals_for_changes(cursor, change_rows):
+    """
+    Actualiza task_time_totals tras insertar filas de historial (en la misma transacción).
+    Si un cambio llega fuera de orden (changed_at anterior al último aplicado) o sin
+    timestamp explícito, se recalcula esa tarea desde su historial.
+    """
+    changes_by_task = {}
+    for row in change_rows:
+        changes_by_task.setdefault(row[0], []).append((row[2], row[5]))
+
+    for task_id, changes in changes_by_task.items():
+        cursor.execute("""
+            SELECT accumulated_seconds, open_session_start, last_changed_at
+            FROM task_time_totals WHERE task_id = ?
+        """, (task_id,))
+        current = cursor.fetchone()
+
+        in_order = current is not None
+        last_changed_at = current['last_changed_at'] if current else None
+        for _, changed_at in changes:
+            if changed_at is None or (last_changed_at is not None and changed_at < last_changed_at):
+                in_order = False
+                break
+            last_changed_at = changed_at
+
+        if not in_order:
+            _rebuild_task_totals(cursor, task_id)
+            continue
+
+        state = {
+            'total_seconds': current['accumulated_seconds'] or 0,
+            'in_progress_start': datetime.fromisoformat(current['open_session_start']) if current['open_session_start'] else None
+        }
+        for new_status, changed_at in changes:
+            _apply_status_transition(state, task_id, new_status, changed_at)
+        _store_time_totals(cursor, task_id, state, last_changed_at)
+
+
+def rebuild_task_time_totals(check_only=False, tolerance_seconds=1):
+    """
+    Recalcula task_time_totals desde task_status_history y detecta desviaciones.
+
+    Args:
+        check_only: si es True solo informa de las desviaciones sin corregirlas
+        tolerance_seconds: diferencia máxima aceptada en el tiempo acumulado
+
+    Returns:
+        dict con el número de tareas revisadas, las desviaciones encontradas y las corregidas
+    """
+    drift = []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT task_id FROM task_status_history
+            UNION
+            SELECT task_id FROM task_time_totals
+        """)
+        task_ids = [row['task_id'] for row in cursor.fetchall()]
+
+        try:
+            for task_id in task_ids:
+                cursor.execute("""
+                    SELECT accumulated_seconds, open_session_start
+                    FROM task_time_totals WHERE task_id = ?
+                """, (task_id,))
+                stored = cursor.fetchone()
+
+                state, last_changed_at = _replay_status_history(cursor, task_id)
+                expected_open = state['in_progress_start'].isoformat() if state['in_progress_start'] else None
+
+                if (stored is None
+                        or abs((stored['accumulated_seconds'] or 0) - state['total_seconds']) > tolerance_seconds
+                        or stored['open_session_start'] != expected_open):
+                    drift.append({
+                        'task_id': task_id,
+                        'stored_seconds': stored['accumulated_seconds'] if stored else None,
+                        'expected_seconds': state['total_seconds'],
+                        'stored_session_start': stored['open_session_start'] if stored else None,
+                        'expected_session_start': expected_open
+                    })
+
+                if not check_only:
+                    _store_time_totals(cursor, task_id, state, last_changed_at)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return {
+        'checked': len(task_ids),
+        'drift': drift,
+        'repaired': 0 if check_only else len(drift)
+    }
 
 
 def get_status_history(task_id):
@@ -644,6 +2429,21 @@ def get_status_history(task_id):
         return [dict(row) for row in cursor.fetchall()]
 
 
+def get_tasks_with_progress_entry(task_ids):
+    """Devuelve el subconjunto de task_ids que tienen algún registro de entrada a 'en_progreso'"""
+    result = set()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for chunk in _chunks(task_ids):
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"""
+                SELECT DISTINCT task_id FROM task_status_history
+                WHERE new_status = 'en_progreso' AND task_id IN ({placeholders})
+            """, chunk)
+            result.update(row['task_id'] for row in cursor.fetchall())
+    return result
+
+
 def get_active_in_progress_tasks():
     """Obtiene todas las tareas actualmente en estado 'en_progreso'"""
     with get_db() as conn:
@@ -663,6 +2463,9 @@ def calculate_task_time_in_progress(task_id):
     - total_seconds: segundos totales en progreso
     - current_session_start: timestamp del inicio de la sesión actual (si está en progreso)
     - is_currently_in_progress: boolean indicando si está actualmente en progreso
+
+    Lee el total mantenido en task_time_totals; si la tarea aún no tiene total
+    (p. ej. historial anterior a la tabla), se calcula desde el historial y se guarda.
     """
     with get_db() as conn:
         cursor = conn.cursor()
@@ -672,61 +2475,31 @@ def calculate_task_time_in_progress(task_id):
         row = cursor.fetchone()
         current_status = dict(row)['status'] if row else None
 
-        # Obtener historial de cambios de estado
         cursor.execute("""
-            SELECT new_status, changed_at
-            FROM task_status_history
-            WHERE task_id = ?
-            ORDER BY changed_at ASC
+            SELECT accumulated_seconds, open_session_start
+            FROM task_time_totals WHERE task_id = ?
         """, (task_id,))
+        totals = cursor.fetchone()
 
-        history = [dict(row) for row in cursor.fetchall()]
-
-        # Debug: Solo imprimir si hay problemas (comentado para reducir ruido en logs)
-        # print(f"[DEBUG] Historial completo para tarea {task_id}:")
-        # for i, h in enumerate(history):
-        #     print(f"  [{i}] new_status={h['new_status']}, changed_at={h['changed_at']}")
-        # print(f"[DEBUG] Estado actual de la tarea: {current_status}")
+        if totals:
+            total_seconds = totals['accumulated_seconds'] or 0
+            in_progress_start = totals['open_session_start']
+        else:
+            try:
+                state = _rebuild_task_totals(cursor, task_id)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            total_seconds = state['total_seconds']
+            in_progress_start = state['in_progress_start'].isoformat() if state['in_progress_start'] else None
 
-        total_seconds = 0
         current_session_start = None
-        in_progress_start = None
-
-        # Calcular tiempo acumulado
-        for record in history:
-            status = record['new_status']
-
-            # Parsear timestamp con manejo de errores robusto
-            try:
-                timestamp = datetime.fromisoformat(record['changed_at'])
-            except (ValueError, TypeError) as e:
-                print(f"[ERROR] Error al parsear fecha '{record['changed_at']}' para tarea {task_id}: {str(e)}")
-                # Intentar parsear con .replace('Z', '+00:00') por si es formato ISO con Z
-                try:
-                    timestamp = datetime.fromisoformat(record['changed_at'].replace('Z', '+00:00'))
-                except:
-                    print(f"[WARNING] No se pudo parsear fecha '{record['changed_at']}', saltando registro para tarea {task_id}")
-                    continue  # Saltar este registro y continuar con el siguiente
-
-            if status == 'en_progreso':
-                # Inicio de un periodo en progreso
-                in_progress_start = timestamp
-                # print(f"[DEBUG]   → Inicio período en progreso: {timestamp}")  # Comentado
-            elif in_progress_start:
-                # Fin de un periodo en progreso
-                try:
-                    duration = (timestamp - in_progress_start).total_seconds()
-                    # print(f"[DEBUG]   → Fin período: {timestamp}, duración: {duration}s ({duration/3600:.2f}h)")  # Comentado
-                    total_seconds += duration
-                    in_progress_start = None
-                except Exception as e:
-                    print(f"[ERROR] Error al calcular duración para tarea {task_id}: {str(e)}")
-                    in_progress_start = None  # Resetear para evitar cálculos incorrectos
 
         # Si actualmente está en progreso, el periodo actual está abierto
         is_currently_in_progress = current_status == 'en_progreso'
         if is_currently_in_progress and in_progress_start:
-            current_session_start = in_progress_start.isoformat()
+            current_session_start = in_progress_start
         elif is_currently_in_progress and not in_progress_start:
             # No hay historial de inicio, lo cual significa que no sabemos cuándo empezó
             # NO usar datetime.utcnow() porque haría que el contador se reinicie en cada cálculo
@@ -734,12 +2507,6 @@ def calculate_task_time_in_progress(task_id):
             current_session_start = None
             print(f"[WARNING] Tarea {task_id} está en progreso pero no tiene historial de inicio")
 
-        # Comentar logs de debug detallados para reducir ruido
-        # print(f"[DEBUG] Resultado final para tarea {task_id}:")
-        # print(f"  total_seconds: {total_seconds} ({total_seconds/3600:.2f}h)")
-        # print(f"  is_currently_in_progress: {is_currently_in_progress}")
-        # print(f"  current_session_start: {current_session_start}")
-
         return {
             'total_seconds': total_seconds,
             'current_session_start': current_session_start,
@@ -747,6 +2514,176 @@ def calculate_task_time_in_progress(task_id):
         }
 
 
+def get_time_tracking_bulk(task_ids):
+    """
+    Datos de tiempo en progreso de varias tareas en una consulta por bloque.
+    Devuelve lo mismo que calculate_task_time_in_progress (más task_id y task_name)
+    en un dict {task_id: datos}; las tareas inexistentes se omiten.
+    """
+    result = {}
+    sin_totales = []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for chunk in _chunks(list(dict.fromkeys(task_ids))):
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"""
+                SELECT t.id, t.name, t.status, tt.accumulated_seconds, tt.open_session_start,
+                       tt.task_id IS NOT NULL AS has_totals
+                FROM tasks t
+                LEFT JOIN task_time_totals tt ON tt.task_id = t.id
+                WHERE t.id IN ({placeholders})
+            """, chunk)
+            for row in cursor.fetchall():
+                if not row['has_totals']:
+                    sin_totales.append((row['id'], row['name']))
+                    continue
+                en_progreso = row['status'] == 'en_progreso'
+                result[row['id']] = {
+                    'task_id': row['id'],
+                    'task_name': row['name'],
+                    'total_seconds': row['accumulated_seconds'] or 0,
+                    'current_session_start': row['open_session_start'] if en_progreso else None,
+                    'is_currently_in_progress': en_progreso
+                }
+
+    # Tareas con historial anterior a task_time_totals: se calculan (y guardan) una vez
+    for task_id, name in sin_totales:
+        result[task_id] = dict(calculate_task_time_in_progress(task_id), task_id=task_id, task_name=name)
+    return result
+
+
+def get_last_time_change_id():
+    """
+    Secuencia de cambios de tiempo: último id asignado en task_time_changes (0 si
+    nunca hubo cambios). Crece siempre, también después de purgar el registro.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'task_time_changes'")
+        row = cursor.fetchone()
+        return row['seq'] if row else 0
+
+
+def get_time_changes_between(since_id, until_id):
+    """
+    Tareas cuyo tiempo en progreso cambió en el intervalo (since_id, until_id].
+
+    Returns:
+        lista de task_ids sin repetir, o None si el registro ya se purgó por
+        debajo de since_id (el cliente debe pedir el estado completo)
+    """
+    if since_id >= until_id:
+        return []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(id) FROM task_time_changes")
+        first_id = cursor.fetchone()[0]
+        if first_id is None or since_id < first_id - 1:
+            return None
+        cursor.execute("""
+            SELECT DISTINCT task_id FROM task_time_changes
+            WHERE id > ? AND id <= ?
+        """, (since_id, until_id))
+        return [row['task_id'] for row in cursor.fetchall()]
+
+
+def get_time_changes_since(last_id, limit=5000):
+    """
+    Tareas cuyo tiempo en progreso cambió después de last_id.
+
+    Returns:
+        tuple: (último id leído, lista de task_ids sin repetir)
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, task_id FROM task_time_changes
+            WHERE id > ? ORDER BY id LIMIT ?
+        """, (last_id, limit))
+        rows = cursor.fetchall()
+        if not rows:
+            return last_id, []
+        return rows[-1]['id'], list(dict.fromkeys(row['task_id'] for row in rows))
+
+
+def prune_time_changes(max_age_seconds=3600):
+    """Borra los cambios de tiempo más antiguos que max_age_seconds"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM task_time_changes WHERE created_at < datetime('now', ?)",
+                       (f'-{int(max_age_seconds)} seconds',))
+        conn.commit()
+        return cursor.rowcount
+
+
+def get_in_progress_seconds_by_project(fecha_inicio, fecha_fin):
+    """
+    Calcula en una sola consulta los segundos en progreso de cada lista y carpeta
+    dentro de un rango de fechas.
+
+    Empareja cada entrada a 'en_progreso' con el siguiente cambio de estado de la
+    misma tarea (LEAD sobre task_status_history), recorta los intervalos al rango
+    y los agrupa por lista. Los periodos abiertos de tareas que siguen en progreso
+    terminan en el momento actual.
+
+    Args:
+        fecha_inicio: datetime de inicio del rango (con timezone)
+        fecha_fin: datetime de fin del rango (con timezone)
+
+    Returns:
+        dict con 'lists' ({list_id: segundos}) y 'folders' ({folder_id: segundos})
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            WITH ordered AS (
+                SELECT
+                    task_id,
+                    new_status,
+                    changed_at,
+                    LEAD(changed_at) OVER w AS next_changed_at,
+                    LEAD(new_status) OVER w AS next_status
+                FROM task_status_history
+                WHERE julianday(changed_at) IS NOT NULL
+                WINDOW w AS (PARTITION BY task_id ORDER BY changed_at ASC, id ASC)
+            ),
+            intervals AS (
+                SELECT
+                    t.list_id,
+                    MAX(julianday(o.changed_at), julianday(:inicio)) AS start_jd,
+                    MIN(
+                        CASE
+                            WHEN o.next_changed_at IS NOT NULL THEN julianday(o.next_changed_at)
+                            ELSE julianday('now')
+                        END,
+                        julianday(:fin)
+                    ) AS end_jd
+                FROM ordered o
+                JOIN tasks t ON t.id = o.task_id
+                WHERE o.new_status = 'en_progreso'
+                  -- Dos entradas seguidas a 'en_progreso': solo cuenta la última
+                  AND (o.next_status IS NULL OR o.next_status != 'en_progreso')
+                  -- Un periodo sin cierre solo cuenta si la tarea sigue en progreso
+                  AND (o.next_changed_at IS NOT NULL OR t.status = 'en_progreso')
+            )
+            SELECT
+                i.list_id,
+                l.folder_id,
+                SUM((i.end_jd - i.start_jd) * 86400.0) AS seconds
+            FROM intervals i
+            LEFT JOIN lists l ON l.id = i.list_id
+            WHERE i.end_jd > i.start_jd
+            GROUP BY i.list_id, l.folder_id
+        """, {'inicio': fecha_inicio.isoformat(), 'fin': fecha_fin.isoformat()})
+
+        report = {'lists': {}, 'folders': {}}
+        for row in cursor.fetchall():
+            report['lists'][row['list_id']] = report['lists'].get(row['list_id'], 0) + row['seconds']
+            if row['folder_id']:
+                report['folders'][row['folder_id']] = report['folders'].get(row['folder_id'], 0) + row['seconds']
+        return report
+
+
 def calculate_time_since_last_update(task_id):
     """
     Calcula el tiempo desde la última actualización de la tarea
@@ -805,6 +2742,457 @@ def calculate_time_since_last_update(task_id):
         }
 
 
+# ==================== MARCAS DE SINCRONIZACIÓN ====================
+
+def get_sync_watermark(scope):
+    """
+    Obtiene la marca de sincronización incremental de un ámbito (ej: 'team:123').
+
+    Returns:
+        int: date_updated máximo sincronizado (milisegundos) o None si nunca se sincronizó
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT date_updated_ms FROM sync_watermarks WHERE scope = ?", (scope,))
+        row = cursor.fetchone()
+        return row['date_updated_ms'] if row else None
+
+
+def set_sync_watermark(scope, date_updated_ms):
+    """Guarda la marca de sincronización de un ámbito (nunca la hace retroceder)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO sync_watermarks (scope, date_updated_ms, last_synced_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(scope) DO UPDATE SET
+                date_updated_ms = MAX(date_updated_ms, excluded.date_updated_ms),
+                last_synced_at = CURRENT_TIMESTAMP
+        """, (scope, int(date_updated_ms)))
+        conn.commit()
+
+
+def mark_scope_synced(scope):
+    """Registra que un ámbito (ej: 'list:123') acaba de sincronizarse completo, sin tocar su marca"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO sync_watermarks (scope, date_updated_ms, last_synced_at)
+            VALUES (?, 0, CURRENT_TIMESTAMP)
+            ON CONFLICT(scope) DO UPDATE SET last_synced_at = CURRENT_TIMESTAMP
+        """, (scope,))
+        conn.commit()
+
+
+def get_scope_sync_age(scope):
+    """Segundos desde la última sincronización de un ámbito, o None si nunca (o se invalidó)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT (julianday('now') - julianday(last_synced_at)) * 86400 AS age_seconds
+            FROM sync_watermarks WHERE scope = ?
+        """, (scope,))
+        row = cursor.fetchone()
+        return max(0.0, row['age_seconds']) if row and row['age_seconds'] is not None else None
+
+
+def invalidate_sync_scopes(scope_pattern):
+    """Borra los ámbitos que coinciden con el patrón LIKE (ej: 'hierarchy:space:%'). Devuelve cuántos"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM sync_watermarks WHERE scope LIKE ?", (scope_pattern,))
+        conn.commit()
+        return cursor.rowcount
+
+
+def get_lists_sync_age(list_ids):
+    """
+    Segundos desde la última sincronización de cada lista, ya sea de la propia
+    lista ('list:<id>') o incremental de su team ('team:<id>').
+
+    Returns:
+        dict {list_id: segundos o None si nunca se sincronizó}
+    """
+    result = {}
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for chunk in _chunks(list_ids):
+            values = ','.join(['(?)'] * len(chunk))
+            cursor.execute(f"""
+                WITH ids(id) AS (VALUES {values})
+                SELECT ids.id,
+                       (julianday('now') - MAX(
+                           COALESCE(julianday(wl.last_synced_at), 0),
+                           COALESCE(julianday(wt.last_synced_at), 0)
+                       )) * 86400 AS age_seconds,
+                       wl.last_synced_at IS NULL AND wt.last_synced_at IS NULL AS never
+                FROM ids
+                LEFT JOIN lists l ON l.id = ids.id
+                LEFT JOIN spaces s ON s.id = l.space_id
+                LEFT JOIN sync_watermarks wl ON wl.scope = 'list:' || ids.id
+                LEFT JOIN sync_watermarks wt ON wt.scope = 'team:' || s.team_id
+            """, chunk)
+            for row in cursor.fetchall():
+                result[row['id']] = None if row['never'] else max(0.0, row['age_seconds'])
+    return result
+
+
+def reset_sync_watermarks():
+    """Borra todas las marcas para forzar una sincronización completa. Devuelve cuántas se borraron"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM sync_watermarks")
+        conn.commit()
+        return cursor.rowcount
+
+
+# ==================== CONCESIONES DE LIDERAZGO ====================
+
+def _lease_is_held(cursor, name, holder_id, fencing_token):
+    cursor.execute("""
+        SELECT 1 FROM scheduler_leases
+        WHERE name = ? AND holder_id = ? AND fencing_token = ?
+          AND expires_at > CURRENT_TIMESTAMP
+    """, (name, holder_id, fencing_token))
+    return cursor.fetchone() is not None
+
+
+def acquire_lease(name, holder_id, ttl_seconds):
+    """
+    Obtiene o renueva la concesión `name` para holder_id durante ttl_seconds.
+
+    Si la concesión está libre o caducada, holder_id la toma y el fencing token
+    se incrementa; si ya era suya y sigue vigente, solo se amplía la caducidad.
+    Las fechas se calculan con el reloj de SQLite para que todos los procesos
+    usen la misma referencia.
+
+    Returns:
+        int: fencing token de la concesión, o None si la tiene otro proceso
+    """
+    expires = f'+{int(ttl_seconds)} seconds'
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("""
+            SELECT holder_id, fencing_token, expires_at > CURRENT_TIMESTAMP AS vigente
+            FROM scheduler_leases WHERE name = ?
+        """, (name,))
+        row = cursor.fetchone()
+
+        if row is None:
+            token = 1
+            cursor.execute("""
+                INSERT INTO scheduler_leases (name, holder_id, fencing_token, expires_at)
+                VALUES (?, ?, ?, datetime('now', ?))
+            """, (name, holder_id, token, expires))
+        elif row['vigente'] and row['holder_id'] == holder_id:
+            token = row['fencing_token']
+            cursor.execute("""
+                UPDATE scheduler_leases
+                SET renewed_at = CURRENT_TIMESTAMP, expires_at = datetime('now', ?)
+                WHERE name = ?
+            """, (expires, name))
+        elif not row['vigente']:
+            # Concesión caducada: se toma con un token nuevo (invalida al titular anterior)
+            token = row['fencing_token'] + 1
+            cursor.execute("""
+                UPDATE scheduler_leases
+                SET holder_id = ?, fencing_token = ?, acquired_at = CURRENT_TIMESTAMP,
+                    renewed_at = CURRENT_TIMESTAMP, expires_at = datetime('now', ?)
+                WHERE name = ?
+            """, (holder_id, token, expires, name))
+        else:
+            token = None
+
+        conn.commit()
+        return token
+
+
+def check_lease(name, holder_id, fencing_token):
+    """Comprueba que holder_id sigue teniendo la concesión con ese fencing token"""
+    with get_db() as conn:
+        return _lease_is_held(conn.cursor(), name, holder_id, fencing_token)
+
+
+def release_lease(name, holder_id, fencing_token):
+    """Libera la concesión (la marca como caducada) para que otro proceso la tome sin esperar"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE scheduler_leases
+            SET expires_at = datetime('now', '-1 seconds')
+            WHERE name = ? AND holder_id = ? AND fencing_token = ?
+        """, (name, holder_id, fencing_token))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
+def get_lease(name):
+    """Devuelve el estado de una concesión (titular, token, caducidad) o None"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT name, holder_id, fencing_token, acquired_at, renewed_at, expires_at,
+                   CAST(ROUND((julianday(expires_at) - julianday('now')) * 86400) AS INTEGER) AS expires_in_seconds
+            FROM scheduler_leases WHERE name = ?
+        """, (name,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+# ==================== LÍMITE DE PETICIONES A CLICKUP ====================
+# Token bucket por token de ClickUp, en RATE_LIMIT_DATABASE_PATH (no en la BD principal).
+# Las fechas son time.time() (epoch) para que todos los procesos de la máquina compartan
+# la misma referencia. Perder el estado no importa (el cupo vuelve a empezar lleno), así
+# que se escribe sin fsync.
+
+_rate_limit_local = threading.local()
+
+
+def _rate_limit_db():
+    """Conexión del hilo actual a la BD de cupos (en autocommit; crea la tabla la primera vez)"""
+    conn = getattr(_rate_limit_local, 'conn', None)
+    if conn is not None and _rate_limit_local.pid == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(RATE_LIMIT_DATABASE_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS clickup_rate_limits (
+            bucket_key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            paused_until REAL NOT NULL DEFAULT 0
+        )
+    """)
+    _rate_limit_local.conn = conn
+    _rate_limit_local.pid = os.getpid()
+    return conn
+
+
+def take_rate_limit_token(bucket_key, capacity, per_second):
+    """
+    Consume un token del cupo bucket_key, reponiendo los tokens del tiempo transcurrido.
+
+    Returns:
+        float: 0 si se consumió el token; si no, segundos a esperar antes de reintentar
+    """
+    now = time.time()
+    conn = _rate_limit_db()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("""
+            SELECT tokens, updated_at, paused_until FROM clickup_rate_limits WHERE bucket_key = ?
+        """, (bucket_key,))
+        row = cursor.fetchone()
+        if row is None:
+            tokens, paused_until = float(capacity), 0.0
+        else:
+            tokens = min(capacity, row['tokens'] + max(0.0, now - row['updated_at']) * per_second)
+            paused_until = row['paused_until']
+
+        if now < paused_until:
+            wait = paused_until - now
+        elif tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / per_second
+
+        cursor.execute("""
+            INSERT INTO clickup_rate_limits (bucket_key, tokens, updated_at, paused_until)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(bucket_key) DO UPDATE SET
+                tokens = excluded.tokens,
+                updated_at = excluded.updated_at,
+                paused_until = excluded.paused_until
+        """, (bucket_key, tokens, now, paused_until))
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    return wait
+
+
+def pause_rate_limit(bucket_key, seconds):
+    """Vacía el cupo bucket_key y lo detiene durante unos segundos (tras un 429 de ClickUp)"""
+    now = time.time()
+    _rate_limit_db().execute("""
+        INSERT INTO clickup_rate_limits (bucket_key, tokens, updated_at, paused_until)
+        VALUES (?, 0, ?, ?)
+        ON CONFLICT(bucket_key) DO UPDATE SET
+            tokens = 0,
+            updated_at = excluded.updated_at,
+            paused_until = MAX(paused_until, excluded.paused_until)
+    """, (bucket_key, now, now + seconds))
+
+
+# === BENCHMARKS ===
+# Usados por los subcomandos bench-* de este módulo y de alert_engine.py. Trabajan sobre una BD temporal
+# (no sobre DATABASE_PATH) para que cada pasada empiece desde el mismo estado.
+
+class _UnpooledConnections:
+    """Una conexión nueva en cada get_db() y cerrada al salir, como antes del pool"""
+
+    def __init__(self, database_path, profile=None):
+        self.database_path = database_path
+        self.profile = profile or get_storage_profile()
+        self.stats = {'created': 0}
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        conn = sqlite3.connect(self.database_path, timeout=self.profile['busy_timeout'] / 1000)
+        conn.row_factory = sqlite3.Row
+        apply_storage_profile(conn, self.profile)
+        with self._lock:
+            self.stats['created'] += 1
+        return conn
+
+    def release(self, conn):
+        conn.close()
+
+    def close_all(self):
+        pass
+
+
+@contextmanager
+def _bench_database(make_pool, tasks=500):
+    """
+    BD temporal con tasks tareas para un benchmark; get_db() usa el pool que
+    devuelve make_pool(ruta) mientras dura el bloque.
+
+    Yields:
+        tuple: (pool, ids de las tareas)
+    """
+    global _pool
+    import shutil
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp(prefix='vc_bench_')
+    previous = _pool
+    _pool = make_pool(os.path.join(tmp_dir, 'bench.db'))
+    try:
+        _task_cache.clear()
+        init_db()
+        migrate_db()
+        task_ids = [f'bench{i}' for i in range(tasks)]
+        save_tasks_bulk([{'id': task_id, 'name': f'Tarea {task_id}', 'list_id': 'bench-list',
+                          'status': 'pendiente', 'date_updated': datetime.now().isoformat()}
+                         for task_id in task_ids])
+        yield _pool, task_ids
+    finally:
+        _pool.close_all()
+        _pool = previous
+        _task_cache.clear()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _bench_webhook(task_id, i):
+    """Operaciones de BD de un webhook taskStatusUpdated (las mismas que process_task_event)"""
+    status = 'en_progreso' if i % 2 == 0 else 'pendiente'
+    now = datetime.now().isoformat()
+    webhook_id = log_webhook('taskStatusUpdated', {'task_id': task_id, 'status': status}, task_id=task_id)
+    old_task = get_task(task_id)
+    save_task({'id': task_id, 'name': old_task['name'], 'list_id': old_task['list_id'],
+               'status': status, 'date_updated': now})
+    get_status_history(task_id)
+    save_status_change(task_id, old_task['status'], status, changed_at=now)
+    get_task_alert(task_id)
+    mark_webhook_processed(webhook_id)
+
+
+def _percentile(values, q):
+    """Percentil q (0-1) de una lista de valores (None si está vacía)"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _bench_pool(webhooks, threads):
+    """Conexiones abiertas por webhook y latencia p50/p99 con y sin pool"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    for label, make_pool in (('sin pool', _UnpooledConnections),
+                             ('con pool', lambda path: ConnectionPool(path, max_size=threads + 1))):
+        with _bench_database(make_pool) as (pool, task_ids):
+            created_before = pool.stats['created']
+
+            def medir(i):
+                start = time.perf_counter()
+                _bench_webhook(task_ids[i % len(task_ids)], i)
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                latencies = list(executor.map(medir, range(webhooks)))
+            elapsed = time.perf_counter() - start
+            created = pool.stats['created'] - created_before
+
+        print(f"[BENCH] {label}: {created / webhooks:.3f} conexiones/webhook, "
+              f"{webhooks / elapsed:,.0f} webhooks/s, p50 {_percentile(latencies, 0.5) * 1000:.2f} ms, "
+              f"p99 {_percentile(latencies, 0.99) * 1000:.2f} ms")
+
+
+def _bench_storage(profiles, writers, readers, seconds, batch_size):
+    """
+    Webhooks en paralelo (escritores) contra lecturas de /api/tasks/time-tracking/batch
+    (lectores) con cada perfil de almacenamiento: operaciones por segundo, latencia p99
+    y errores 'database is locked' de cada lado.
+    """
+    import random
+
+    for name in profiles:
+        profile = dict(STORAGE_PROFILES[name])
+
+        def make_pool(path):
+            return ConnectionPool(path, max_size=writers + readers + 1, profile=profile)
+
+        with _bench_database(make_pool) as (pool, task_ids):
+            results = {'webhooks': ([], [0]), 'lecturas': ([], [0])}
+            deadline = time.monotonic() + seconds
+
+            def escritor(n):
+                latencies, errors = results['webhooks']
+                i = n
+                while time.monotonic() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        _bench_webhook(task_ids[i % len(task_ids)], i)
+                        latencies.append(time.perf_counter() - start)
+                    except sqlite3.OperationalError:
+                        errors[0] += 1
+                    i += writers
+
+            def lector(n):
+                latencies, errors = results['lecturas']
+                rng = random.Random(n)
+                while time.monotonic() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        # Lo mismo que el endpoint batch: secuencia de cambios y tiempos del bloque
+                        get_last_time_change_id()
+                        get_time_tracking_bulk(rng.sample(task_ids, min(batch_size, len(task_ids))))
+                        latencies.append(time.perf_counter() - start)
+                    except sqlite3.OperationalError:
+                        errors[0] += 1
+
+            workers = ([threading.Thread(target=escritor, args=(n,)) for n in range(writers)] +
+                       [threading.Thread(target=lector, args=(n,)) for n in range(readers)])
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        for label, (latencies, errors) in results.items():
+            p99 = _percentile(latencies, 0.99)
+            print(f"[BENCH] {name} ({profile['journal_mode']}), {label}: {len(latencies) / seconds:,.0f} ops/s, "
+                  f"p99 {p99 * 1000 if p99 is not None else 0:.2f} ms, {errors[0]} errores de bloqueo")
+
+
 # Inicializar base de datos al importar el módulo
 try:
     print("[DB] Inicializando base de datos...", flush=True)
@@ -817,3 +3205,92 @@ except Exception as e:
     print(f"[DB ERROR] No se pudo inicializar la base de datos: {e}", flush=True)
     import traceback
     traceback.print_exc()
+
+
+if __name__ == '__main__':
+    # Uso: python db.py rebuild-time-totals [--check]
+    #      python db.py reset-sync-watermarks
+    #      python db.py bench-get-task [--iterations N]
+    #      python db.py bench-pool [--webhooks N] [--threads N]
+    #      python db.py bench-storage [--writers N] [--readers N] [--seconds N]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Utilidades de mantenimiento de la base de datos')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild-time-totals',
+        help='Recalcula los totales de tiempo en progreso desde el historial de estados'
+    )
+    rebuild_parser.add_argument('--check', action='store_true',
+                                help='Solo comprobar desviaciones, sin corregirlas')
+
+    subparsers.add_parser(
+        'reset-sync-watermarks',
+        help='Borra las marcas de sincronización para que la próxima sincronización sea completa'
+    )
+
+    bench_parser = subparsers.add_parser(
+        'bench-get-task',
+        help='Mide lecturas por segundo de get_task con y sin caché sobre las tareas existentes'
+    )
+    bench_parser.add_argument('--iterations', type=int, default=20000)
+
+    bench_pool_parser = subparsers.add_parser(
+        'bench-pool',
+        help='Compara conexiones por webhook y latencia p99 de webhooks con y sin pool (en una BD temporal)'
+    )
+    bench_pool_parser.add_argument('--webhooks', type=int, default=2000)
+    bench_pool_parser.add_argument('--threads', type=int, default=4)
+
+    bench_storage_parser = subparsers.add_parser(
+        'bench-storage',
+        help='Webhooks en paralelo contra lecturas del endpoint batch de tiempos con cada perfil de almacenamiento'
+    )
+    bench_storage_parser.add_argument('--profiles', nargs='+', choices=sorted(STORAGE_PROFILES),
+                                      default=['legacy', 'default'])
+    bench_storage_parser.add_argument('--writers', type=int, default=4)
+    bench_storage_parser.add_argument('--readers', type=int, default=4)
+    bench_storage_parser.add_argument('--seconds', type=float, default=10)
+    bench_storage_parser.add_argument('--batch-size', type=int, default=200)
+
+    args = parser.parse_args()
+
+    if args.command == 'rebuild-time-totals':
+        result = rebuild_task_time_totals(check_only=args.check)
+        for item in result['drift']:
+            print(f"[DRIFT] {item['task_id']}: guardado={item['stored_seconds']} esperado={item['expected_seconds']} "
+                  f"sesión guardada={item['stored_session_start']} esperada={item['expected_session_start']}")
+        print(f"[INFO] Tareas revisadas: {result['checked']}, desviaciones: {len(result['drift'])}, "
+              f"corregidas: {result['repaired']}")
+    elif args.command == 'reset-sync-watermarks':
+        print(f"[INFO] Marcas de sincronización borradas: {reset_sync_watermarks()}")
+    elif args.command == 'bench-get-task':
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM tasks ORDER BY date_updated DESC LIMIT ?", (max(1, TASK_CACHE_MAX_ENTRIES),))
+            bench_ids = [row['id'] for row in cursor.fetchall()]
+        if not bench_ids:
+            print("[ERROR] No hay tareas en la base de datos")
+        else:
+            # 'JSON completo' decodifica las cuatro columnas en cada lectura (como antes de la caché)
+            for label, use_cache, read_json in (('sin caché, JSON completo', False, 'all'),
+                                                ('sin caché', False, None),
+                                                ('con caché', True, None),
+                                                ('con caché + tags', True, 'tags')):
+                _task_cache.clear()
+                start = time.perf_counter()
+                for i in range(args.iterations):
+                    task = get_task(bench_ids[i % len(bench_ids)], use_cache=use_cache)
+                    if read_json == 'all':
+                        task.copy()
+                    elif read_json:
+                        task.get(read_json)
+                elapsed = time.perf_counter() - start
+                print(f"[BENCH] get_task {label}: {args.iterations / elapsed:,.0f} lecturas/s "
+                      f"({elapsed / args.iterations * 1e6:.1f} µs por lectura)")
+            print(f"[BENCH] Caché: {get_task_cache_stats()}")
+    elif args.command == 'bench-pool':
+        _bench_pool(args.webhooks, args.threads)
+    elif args.command == 'bench-storage':
+        _bench_storage(args.profiles, args.writers, args.readers, args.seconds, args.batch_size)
@@ -0,0 +1,338 @@
+"""
+Envío de emails a través de una bandeja de salida (tabla email_outbox)
+Los emails se encolan en la BD y un worker los envía por lotes a la API de
+Brevo (messageVersions), con reintentos y backoff exponencial.
+"""
+
+import json
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import db
+
+BREVO_API_URL = os.getenv('BREVO_API_URL', 'https://api.brevo.com/v3/smtp/email')
+
+# Mensajes por petición a Brevo (la API admite hasta 1000 messageVersions)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '2'))
+OUTBOX_BACKOFF_BASE_SECONDS = 30
+OUTBOX_BACKOFF_MAX_SECONDS = 3600
+OUTBOX_CLAIM_TIMEOUT = 300
+BREVO_HTTP_TIMEOUT = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Sesión HTTP compartida (con keep-alive) para la API de Brevo"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                _session = session
+    return _session
+
+
+def backoff_seconds(attempts):
+    """Espera antes del siguiente intento: exponencial con jitter y un máximo de 1 hora"""
+    delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _recipient(email):
+    return {'email': email, 'name': email.split('@')[0]}
+
+
+def post_to_brevo(messages, api_key, sender_email, sender_name='Virtual Controller'):
+    """
+    Envía uno o varios mensajes en una sola petición a Brevo.
+
+    Con más de un mensaje se usa messageVersions (un destinatario, asunto y
+    contenido por versión).
+
+    Args:
+        messages: lista de dicts con to_email, subject y html_content
+
+    Returns:
+        requests.Response
+    """
+    first = messages[0]
+    payload = {
+        'sender': {'name': sender_name, 'email': sender_email},
+        'subject': first['subject'],
+        'htmlContent': first['html_content']
+    }
+    if len(messages) == 1:
+        payload['to'] = [_recipient(first['to_email'])]
+    else:
+        payload['messageVersions'] = [
+            {
+                'to': [_recipient(message['to_email'])],
+                'subject': message['subject'],
+                'htmlContent': message['html_content']
+            }
+            for message in messages
+        ]
+
+    return get_session().post(
+        BREVO_API_URL,
+        headers={
+            'accept': 'application/json',
+            'api-key': api_key,
+            'content-type': 'application/json'
+        },
+        json=payload,
+        timeout=BREVO_HTTP_TIMEOUT
+    )
+
+
+def _is_retryable(status_code):
+    return status_code == 429 or status_code >= 500
+
+
+class OutboxSender:
+    """
+    Worker que vacía la tabla email_outbox.
+
+    Reclama lotes de emails pendientes, los envía a Brevo en una sola petición
+    y los marca como enviados (lo que desactiva la alerta de la tarea). Los
+    fallos temporales (timeouts, 429, 5xx) se reintentan con backoff exponencial;
+    un lote rechazado con 4xx se reenvía mensaje a mensaje para aislar el inválido.
+
+    Args:
+        api_key / sender_email: credenciales de Brevo
+        on_sent: función opcional(filas) llamada tras confirmar el envío
+        fencing: función opcional que devuelve la concesión (name, holder_id, token)
+                 con la que reclamar lotes, o None si este proceso no debe enviar
+    """
+
+    def __init__(self, api_key, sender_email, on_sent=None, batch_size=OUTBOX_BATCH_SIZE, fencing=None):
+        self.api_key = api_key
+        self.sender_email = sender_email
+        self.on_sent = on_sent
+        self.fencing = fencing
+        self.batch_size = max(1, batch_size)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'batches': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def notify(self):
+        """Despierta al worker (hay emails nuevos en la bandeja)"""
+        self._wake.set()
+
+    def _confirm(self, rows, message_ids=None):
+        db.mark_outbox_sent([row['id'] for row in rows], message_ids)
+        self._stats['sent'] += len(rows)
+        if self.on_sent:
+            self.on_sent(rows)
+
+    def _fail(self, rows, error):
+        for row in rows:
+            if row['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                db.mark_outbox_failed(row['id'], error)
+                self._stats['failed'] += 1
+                print(f"[OUTBOX] ❌ Email {row['id']} a {row['to_email']} descartado tras {row['attempts']} intentos: {error}")
+            else:
+                delay = backoff_seconds(row['attempts'])
+                db.mark_outbox_retry(row['id'], error, delay)
+                self._stats['retried'] += 1
+                print(f"[OUTBOX] Email {row['id']} se reintentará en {delay:.0f}s: {error}")
+
+    def _send(self, rows):
+        """Envía un lote; devuelve el código HTTP (o None si no hubo respuesta)"""
+        try:
+            response = post_to_brevo(rows, self.api_key, self.sender_email)
+        except requests.exceptions.RequestException as e:
+            self._fail(rows, f"Error de conexión con Brevo: {str(e)}")
+            return None
+
+        if response.status_code in (200, 201, 202):
+            try:
+                message_ids = response.json().get('messageIds') or [response.json().get('messageId')]
+            except ValueError:
+                message_ids = None
+            self._confirm(rows, message_ids)
+            return response.status_code
+
+        error = f"HTTP {response.status_code}: {response.text[:300]}"
+        if _is_retryable(response.status_code):
+            self._fail(rows, error)
+        elif len(rows) > 1:
+            # Algún mensaje del lote es inválido: enviarlos uno a uno
+            print(f"[OUTBOX] Lote de {len(rows)} rechazado ({error}), enviando individualmente")
+            for row in rows:
+                self._send([row])
+        else:
+            db.mark_outbox_failed(rows[0]['id'], error)
+            self._stats['failed'] += 1
+            print(f"[OUTBOX] ❌ Email {rows[0]['id']} a {rows[0]['to_email']} rechazado por Brevo: {error}")
+        return response.status_code
+
+    def process_once(self):
+        """Envía un lote de la bandeja. Devuelve el número de emails reclamados"""
+        lease = None
+        if self.fencing is not None:
+            lease = self.fencing()
+            if lease is None:
+                return 0
+
+        rows = db.claim_outbox_batch(self.batch_size, OUTBOX_CLAIM_TIMEOUT, lease=lease)
+        if not rows:
+            return 0
+
+        self._stats['batches'] += 1
+        print(f"[OUTBOX] Enviando lote de {len(rows)} emails vía Brevo...")
+        self._send(rows)
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.process_once():
+                    continue
+            except Exception as e:
+                print(f"[OUTBOX] Error en el worker de emails: {str(e)}")
+            self._wake.wait(OUTBOX_POLL_SECONDS)
+            self._wake.clear()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Detiene el worker (los emails reclamados que no se confirmen se reintentan al caducar)"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def get_stats(self):
+        return dict(self._stats, running=self.running, **db.get_outbox_stats())
+
+
+# === SERVIDOR BREVO FALSO ===
+# Para pruebas y benchmarks locales: BREVO_API_URL=http://127.0.0.1:8025/v3/smtp/email
+# Acepta el mismo cuerpo que la API real (to o messageVersions) y responde con un
+# messageId por mensaje, sin enviar nada.
+
+class _FakeBrevoHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+        except ValueError:
+            return self._reply(400, {'code': 'bad_request', 'message': 'JSON inválido'})
+
+        versions = payload.get('messageVersions') or [payload]
+        if not self.headers.get('api-key') or not all(
+                version.get('to') and all('@' in (to.get('email') or '') for to in version['to'])
+                for version in versions):
+            return self._reply(400, {'code': 'invalid_parameter', 'message': 'Destinatario inválido'})
+
+        if server.latency_ms:
+            threading.Event().wait(server.latency_ms / 1000)
+        if server.fail_rate and random.random() < server.fail_rate:
+            return self._reply(503, {'code': 'unavailable', 'message': 'Error simulado'})
+
+        with server.lock:
+            first = server.messages + 1
+            server.requests += 1
+            server.messages += len(versions)
+        ids = [f'<fake-{n}@brevo.local>' for n in range(first, first + len(versions))]
+        self._reply(201, {'messageIds': ids} if 'messageVersions' in payload else {'messageId': ids[0]})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_brevo(port=0, latency_ms=0, fail_rate=0.0):
+    """
+    Arranca el servidor Brevo falso en un hilo (port=0 elige uno libre).
+
+    Returns:
+        ThreadingHTTPServer con url (para BREVO_API_URL) y los contadores requests/messages
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), _FakeBrevoHandler)
+    server.daemon_threads = True
+    server.latency_ms = latency_ms
+    server.fail_rate = fail_rate
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.messages = 0
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/v3/smtp/email'
+    threading.Thread(target=server.serve_forever, name='fake-brevo', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    # Uso: python email_outbox.py fake-brevo [--port N] [--latency-ms N] [--fail-rate X]
+    #      python email_outbox.py bench [--emails N] [--latency-ms N]
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Utilidades de la bandeja de salida de emails')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    fake_parser = subparsers.add_parser('fake-brevo', help='Servidor Brevo falso para pruebas locales')
+    fake_parser.add_argument('--port', type=int, default=8025)
+    fake_parser.add_argument('--latency-ms', type=int, default=0)
+    fake_parser.add_argument('--fail-rate', type=float, default=0.0, help='Fracción de peticiones que responden 503')
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='Mide emails por segundo contra el servidor falso con varios tamaños de lote (en una BD temporal)'
+    )
+    bench_parser.add_argument('--emails', type=int, default=2000)
+    bench_parser.add_argument('--latency-ms', type=int, default=50, help='Latencia simulada de cada petición a Brevo')
+    args = parser.parse_args()
+
+    if args.command == 'fake-brevo':
+        fake = start_fake_brevo(args.port, args.latency_ms, args.fail_rate)
+        print(f"[OUTBOX] Brevo falso escuchando en {fake.url} (Ctrl+C para salir)")
+        try:
+            while True:
+                time.sleep(60)
+                print(f"[OUTBOX] Brevo falso: {fake.requests} peticiones, {fake.messages} mensajes")
+        except KeyboardInterrupt:
+            fake.shutdown()
+    elif args.command == 'bench':
+        fake = start_fake_brevo(latency_ms=args.latency_ms)
+        BREVO_API_URL = fake.url
+        for batch_size in (1, 10, 50, 200):
+            with db._bench_database(db.ConnectionPool, tasks=0):
+                for i in range(args.emails):
+                    db.enqueue_email(f'usuario{i}@example.com', f'Alerta {i}', '<p>Alerta</p>', dedup_key=f'bench-{i}')
+                sender = OutboxSender('bench-key', 'alertas@example.com', batch_size=batch_size)
+                peticiones = fake.requests
+                start = time.perf_counter()
+                while sender.process_once():
+                    pass
+                elapsed = time.perf_counter() - start
+                print(f"[BENCH] Lotes de {batch_size}: {sender.get_stats()['sent'] / elapsed:,.0f} emails/s, "
+                      f"{fake.requests - peticiones} peticiones a Brevo ({elapsed:.2f}s)")
+        fake.shutdown()
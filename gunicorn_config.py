@@ -17,7 +17,8 @@ workers = min(multiprocessing.cpu_count() * 2 + 1, 4)
 
 # Tipo de worker - gthread para aplicaciones Flask estándar
 worker_class = 'gthread'
-threads = 2
+# Cada stream en vivo (/api/tasks/time-tracking/stream) ocupa un hilo mientras está abierto
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
 
 # Timeout para requests HTTP (aumentado para deploy)
 timeout = 300
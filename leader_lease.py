@@ -0,0 +1,168 @@
+"""
+Elección de líder mediante una concesión (lease) guardada en la base de datos
+Solo el proceso que tiene la concesión ejecuta el scheduler de alertas. El líder
+la renueva periódicamente; si muere, caduca y cualquier otro proceso la toma con
+un fencing token nuevo, que invalida lo que el líder anterior intente hacer.
+
+Coordina solo procesos de una misma máquina: la concesión vive en el fichero
+SQLite de la aplicación (en modo WAL), que no puede compartirse entre hosts.
+Con varios nodos cada uno tendría su propia BD y su propio líder.
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+
+import db
+
+# Duración de la concesión y cada cuánto se renueva (o se intenta tomar)
+SCHEDULER_LEASE_TTL_SECONDS = int(os.getenv('SCHEDULER_LEASE_TTL_SECONDS', '15'))
+SCHEDULER_LEASE_HEARTBEAT_SECONDS = float(os.getenv('SCHEDULER_LEASE_HEARTBEAT_SECONDS', '5'))
+
+
+def default_holder_id():
+    """Identificador único del proceso: host, PID y un sufijo aleatorio"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderLease:
+    """
+    Concesión de liderazgo con heartbeat, caducidad y fencing token.
+
+    Un hilo intenta tomar o renovar la concesión cada heartbeat_seconds. Al
+    obtenerla se llama a on_elected(token); al perderla (la tomó otro proceso o
+    no se pudo renovar antes de caducar) se llama a on_demoted().
+
+    Args:
+        name: nombre de la concesión en la tabla scheduler_leases
+        on_elected: función(fencing_token) llamada al convertirse en líder
+        on_demoted: función() llamada al dejar de ser líder
+    """
+
+    def __init__(self, name, on_elected=None, on_demoted=None,
+                 ttl_seconds=SCHEDULER_LEASE_TTL_SECONDS,
+                 heartbeat_seconds=SCHEDULER_LEASE_HEARTBEAT_SECONDS, holder_id=None):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.ttl_seconds = max(2, ttl_seconds)
+        # El heartbeat debe dejar margen para varias renovaciones antes de caducar
+        self.heartbeat_seconds = min(heartbeat_seconds, self.ttl_seconds / 3)
+        self.holder_id = holder_id or default_holder_id()
+
+        self.token = None
+        self._valid_until = 0.0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'elections': 0, 'demotions': 0, 'renew_errors': 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def is_leader(self):
+        """Líder según el estado local: con token y sin haber superado la caducidad"""
+        with self._lock:
+            return self.token is not None and time.monotonic() < self._valid_until
+
+    def fencing(self):
+        """Tupla (name, holder_id, token) para comprobar la concesión en la BD, o None"""
+        with self._lock:
+            if self.token is None or time.monotonic() >= self._valid_until:
+                return None
+            return (self.name, self.holder_id, self.token)
+
+    def check(self):
+        """Comprueba en la BD que este proceso sigue siendo el líder (antes de una acción con efectos)"""
+        fencing = self.fencing()
+        return fencing is not None and db.check_lease(*fencing)
+
+    def _demote(self, reason):
+        with self._lock:
+            if self.token is None:
+                return
+            token, self.token = self.token, None
+            self._valid_until = 0.0
+            self._stats['demotions'] += 1
+        print(f"[LEASE] {self.holder_id} deja de ser líder de '{self.name}' (token {token}): {reason}", flush=True)
+        if self.on_demoted:
+            try:
+                self.on_demoted()
+            except Exception as e:
+                print(f"[LEASE] Error al detener las tareas del líder: {str(e)}")
+
+    def tick(self):
+        """Intenta tomar o renovar la concesión una vez"""
+        started = time.monotonic()
+        try:
+            token = db.acquire_lease(self.name, self.holder_id, self.ttl_seconds)
+        except Exception as e:
+            self._stats['renew_errors'] += 1
+            print(f"[LEASE] Error al renovar la concesión '{self.name}': {str(e)}")
+            # Sin renovar, la concesión caduca en la BD: dejar de actuar antes de que ocurra
+            if self.token is not None and time.monotonic() >= self._valid_until:
+                self._demote('no se pudo renovar antes de caducar')
+            return
+
+        if token is None:
+            self._demote('otro proceso tiene la concesión')
+            return
+
+        if self.token is not None and token != self.token:
+            # La concesión caducó y se volvió a tomar: lo hecho con el token anterior ya no vale
+            self._demote(f'token renovado a {token}')
+
+        with self._lock:
+            elected = self.token is None
+            self.token = token
+            # Margen de un heartbeat respecto a la caducidad de la BD
+            self._valid_until = started + self.ttl_seconds - self.heartbeat_seconds
+
+        if elected:
+            self._stats['elections'] += 1
+            print(f"[LEASE] {self.holder_id} es líder de '{self.name}' (token {token})", flush=True)
+            if self.on_elected:
+                try:
+                    self.on_elected(token)
+                except Exception as e:
+                    print(f"[LEASE] Error al iniciar las tareas del líder: {str(e)}")
+                    import traceback
+                    traceback.print_exc()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.heartbeat_seconds)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'lease-{self.name}', daemon=True)
+        self._thread.start()
+
+    def release(self):
+        """Detiene el heartbeat y libera la concesión para que otro proceso la tome de inmediato"""
+        self._stop.set()
+        fencing = self.fencing()
+        self._demote('proceso detenido')
+        if fencing is not None:
+            try:
+                db.release_lease(*fencing)
+            except Exception as e:
+                print(f"[LEASE] Error al liberar la concesión '{self.name}': {str(e)}")
+
+    def get_stats(self):
+        return dict(
+            self._stats,
+            name=self.name,
+            holder_id=self.holder_id,
+            is_leader=self.is_leader,
+            fencing_token=self.token,
+            running=self.running,
+            lease=db.get_lease(self.name)
+        )
@@ -0,0 +1,217 @@
+"""
+Actualizaciones en vivo del tiempo en progreso (Server-Sent Events)
+Cada proceso tiene un único hilo que lee el registro task_time_changes y reparte
+los cambios entre todas las conexiones abiertas, en lugar de que cada pestaña
+pida el tiempo de todas sus tareas cada pocos segundos.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+import db
+
+# Cada cuántos segundos se lee el registro de cambios
+LIVE_POLL_SECONDS = float(os.getenv('LIVE_POLL_SECONDS', '1'))
+
+# Conexiones en vivo simultáneas por proceso (cada una ocupa un hilo de gunicorn);
+# por encima de este número se responde 503 y el navegador vuelve al polling
+LIVE_STREAM_MAX_CLIENTS = int(os.getenv('LIVE_STREAM_MAX_CLIENTS', '4'))
+
+# Duración máxima de una conexión (el navegador se reconecta solo)
+LIVE_STREAM_MAX_SECONDS = int(os.getenv('LIVE_STREAM_MAX_SECONDS', '600'))
+LIVE_HEARTBEAT_SECONDS = 15
+# Antigüedad máxima de task_time_changes; la purga la programa el proceso líder
+# cada LIVE_PRUNE_INTERVAL_MINUTES, haya o no conexiones en vivo
+LIVE_CHANGE_RETENTION_SECONDS = 3600
+LIVE_PRUNE_INTERVAL_MINUTES = 10
+LIVE_QUEUE_SIZE = 100
+
+# Antigüedad máxima de la secuencia de cambios cacheada en memoria (segundos)
+LIVE_SEQ_CACHE_SECONDS = float(os.getenv('LIVE_SEQ_CACHE_SECONDS', '1'))
+
+
+def prune_changes():
+    """Borra del registro task_time_changes los cambios más antiguos que LIVE_CHANGE_RETENTION_SECONDS"""
+    try:
+        borrados = db.prune_time_changes(LIVE_CHANGE_RETENTION_SECONDS)
+        if borrados:
+            print(f"[LIVE] {borrados} cambios de tiempo antiguos purgados")
+        return borrados
+    except Exception as e:
+        print(f"[LIVE] Error al purgar cambios de tiempo: {str(e)}")
+        return 0
+
+
+def format_sse(data, event=None, event_id=None, retry_ms=None):
+    """Formatea un mensaje Server-Sent Events"""
+    lines = []
+    if retry_ms is not None:
+        lines.append(f"retry: {int(retry_ms)}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    payload = data if isinstance(data, str) else json.dumps(data)
+    lines.extend(f"data: {line}" for line in payload.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+class ChangeSequence:
+    """
+    Secuencia de cambios de tiempo (db.get_last_time_change_id) cacheada durante
+    max_age segundos, para que los polls sin cambios se respondan sin ir a la BD.
+    """
+
+    def __init__(self, max_age=LIVE_SEQ_CACHE_SECONDS):
+        self.max_age = max_age
+        self._value = None
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            if self._value is None or time.monotonic() - self._read_at >= self.max_age:
+                self._value = db.get_last_time_change_id()
+                self._read_at = time.monotonic()
+            return self._value
+
+
+class Subscription:
+    """Conexión en vivo: las tareas que sigue y su cola de cambios pendientes"""
+
+    def __init__(self, task_ids):
+        self.task_ids = set(task_ids)
+        self.queue = queue.Queue(maxsize=LIVE_QUEUE_SIZE)
+        # Si la cola se llena (cliente lento) se envía de nuevo el estado completo
+        self.overflow = False
+
+    def put(self, tasks):
+        try:
+            self.queue.put_nowait(tasks)
+        except queue.Full:
+            self.overflow = True
+
+
+class TimeTrackingBroadcaster:
+    """
+    Reparte los cambios de tiempo en progreso entre las conexiones SSE del proceso.
+
+    Un solo hilo lee task_time_changes cada poll_seconds (solo mientras hay
+    conexiones), carga una vez los datos de las tareas modificadas y los encola
+    en cada conexión que sigue alguna de ellas.
+
+    Args:
+        load_tasks: función(task_ids) -> {task_id: datos de tiempo}
+    """
+
+    def __init__(self, load_tasks=db.get_time_tracking_bulk, poll_seconds=LIVE_POLL_SECONDS,
+                 max_clients=LIVE_STREAM_MAX_CLIENTS):
+        self.load_tasks = load_tasks
+        self.poll_seconds = poll_seconds
+        self.max_clients = max_clients
+
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_id = None
+        self._stats = {'polls': 0, 'changes': 0, 'messages': 0, 'rejected': 0}
+
+    def subscribe(self, task_ids):
+        """Registra una conexión. Devuelve la suscripción o None si se alcanzó el máximo"""
+        with self._lock:
+            if len(self._subscriptions) >= self.max_clients:
+                self._stats['rejected'] += 1
+                return None
+            if not self._subscriptions:
+                # Sin conexiones previas: empezar desde el último cambio, sin reproducir los antiguos
+                self._last_id = db.get_last_time_change_id()
+            subscription = Subscription(task_ids)
+            self._subscriptions.add(subscription)
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='live-time-tracking', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def poll_once(self):
+        """Lee los cambios nuevos y los reparte. Devuelve cuántas tareas cambiaron"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            last_id = self._last_id
+        if not subscriptions:
+            return 0
+
+        new_last_id, changed = db.get_time_changes_since(last_id)
+        self._stats['polls'] += 1
+        with self._lock:
+            self._last_id = new_last_id
+        if not changed:
+            return 0
+
+        self._stats['changes'] += len(changed)
+        seguidas = set().union(*(subscription.task_ids for subscription in subscriptions))
+        wanted = [task_id for task_id in changed if task_id in seguidas]
+        if not wanted:
+            return len(changed)
+
+        tasks = self.load_tasks(wanted)
+        for subscription in subscriptions:
+            subset = {task_id: data for task_id, data in tasks.items() if task_id in subscription.task_ids}
+            if subset:
+                subscription.put(subset)
+                self._stats['messages'] += 1
+        return len(changed)
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"[LIVE] Error al leer cambios de tiempo: {str(e)}")
+
+            with self._lock:
+                idle = not self._subscriptions
+            # Sin conexiones el hilo espera hasta la siguiente suscripción
+            self._wake.wait(None if idle else self.poll_seconds)
+            self._wake.clear()
+
+    def stream(self, subscription):
+        """
+        Generador SSE para una suscripción: estado completo al conectar, después
+        solo los cambios, y un comentario de heartbeat para mantener la conexión.
+        """
+        started = time.monotonic()
+        try:
+            yield format_sse({'tasks': self.load_tasks(list(subscription.task_ids))},
+                             event='snapshot', retry_ms=3000)
+
+            while time.monotonic() - started < LIVE_STREAM_MAX_SECONDS:
+                if subscription.overflow:
+                    subscription.overflow = False
+                    # Los cambios encolados son anteriores al estado completo: descartarlos
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    yield format_sse({'tasks': self.load_tasks(list(subscription.task_ids))}, event='snapshot')
+                    continue
+                try:
+                    tasks = subscription.queue.get(timeout=LIVE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield format_sse({'tasks': tasks}, event='time')
+        finally:
+            self.unsubscribe(subscription)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, clients=len(self._subscriptions), max_clients=self.max_clients,
+                        last_change_id=self._last_id)
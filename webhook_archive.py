@@ -0,0 +1,178 @@
+"""
+Retención de webhooks_log
+Los webhooks procesados de más de WEBHOOK_RETENTION_DAYS días se escriben en
+ficheros JSONL comprimidos (uno por día de recepción) y se borran de la BD (las
+estadísticas salen de webhook_stats y no cambian). También se podan los contadores
+de minuto y hora antiguos. Después se devuelve al disco el espacio libre con un
+vacuum incremental, para que la BD en uso siga siendo pequeña.
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+
+# Días que un webhook procesado permanece en webhooks_log
+WEBHOOK_RETENTION_DAYS = int(os.getenv('WEBHOOK_RETENTION_DAYS', '30'))
+
+# Directorio de los ficheros de archivo ('' = no archivar, solo borrar y contar)
+WEBHOOK_ARCHIVE_DIR = os.getenv('WEBHOOK_ARCHIVE_DIR', 'webhook_archive')
+
+# Días que se conservan los ficheros de archivo (0 = siempre)
+WEBHOOK_ARCHIVE_KEEP_DAYS = int(os.getenv('WEBHOOK_ARCHIVE_KEEP_DAYS', '365'))
+
+# Cada cuántas horas se ejecuta la retención (en el proceso líder)
+WEBHOOK_RETENTION_INTERVAL_HOURS = float(os.getenv('WEBHOOK_RETENTION_INTERVAL_HOURS', '6'))
+
+# Páginas que se devuelven al disco en cada ejecución
+DB_INCREMENTAL_VACUUM_PAGES = int(os.getenv('DB_INCREMENTAL_VACUUM_PAGES', '2000'))
+
+WEBHOOK_ARCHIVE_BATCH = 5000
+ARCHIVE_PREFIX = 'webhooks_'
+ARCHIVE_SUFFIX = '.jsonl.gz'
+
+
+def archive_path(archive_dir, day):
+    """Fichero de archivo de un día ('YYYY-MM-DD')"""
+    return os.path.join(archive_dir, f"{ARCHIVE_PREFIX}{day}{ARCHIVE_SUFFIX}")
+
+
+def write_archive(archive_dir, rows):
+    """
+    Añade las filas a los ficheros de su día de recepción.
+
+    Se añade un miembro gzip nuevo a cada fichero (gzip los lee como uno solo).
+    Si el proceso muere entre escribir y borrar de la BD, el lote se vuelve a
+    archivar en la siguiente ejecución: puede haber filas repetidas, nunca perdidas.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    por_dia = {}
+    for row in rows:
+        por_dia.setdefault(str(row['received_at'])[:10], []).append(row)
+
+    for day, filas in por_dia.items():
+        with gzip.open(archive_path(archive_dir, day), 'at', encoding='utf-8') as f:
+            for row in filas:
+                f.write(json.dumps(row, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    return sorted(por_dia)
+
+
+def rotate_archives(archive_dir, keep_days):
+    """Borra los ficheros de archivo de días anteriores a keep_days. Devuelve cuántos"""
+    if keep_days <= 0 or not os.path.isdir(archive_dir):
+        return 0
+    limite = (datetime.utcnow() - timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    borrados = 0
+    for nombre in os.listdir(archive_dir):
+        if not (nombre.startswith(ARCHIVE_PREFIX) and nombre.endswith(ARCHIVE_SUFFIX)):
+            continue
+        if nombre[len(ARCHIVE_PREFIX):-len(ARCHIVE_SUFFIX)] < limite:
+            os.remove(os.path.join(archive_dir, nombre))
+            borrados += 1
+    return borrados
+
+
+class WebhookRetention:
+    """
+    Archivo, borrado y vacuum de webhooks_log.
+
+    run_once() hace una pasada completa; el proceso líder la programa cada
+    WEBHOOK_RETENTION_INTERVAL_HOURS. También se puede lanzar a mano con
+    python webhook_archive.py run.
+    """
+
+    def __init__(self, retention_days=WEBHOOK_RETENTION_DAYS, archive_dir=WEBHOOK_ARCHIVE_DIR,
+                 keep_days=WEBHOOK_ARCHIVE_KEEP_DAYS, vacuum_pages=DB_INCREMENTAL_VACUUM_PAGES,
+                 batch_size=WEBHOOK_ARCHIVE_BATCH):
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.keep_days = keep_days
+        self.vacuum_pages = vacuum_pages
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'archived': 0, 'errors': 0}
+        self._last_run = None
+
+    def run_once(self):
+        """Archiva y borra los webhooks antiguos, rota los ficheros, poda los contadores y hace el vacuum incremental"""
+        if not self._lock.acquire(blocking=False):
+            return None  # Ya hay una pasada en curso
+        try:
+            started = time.monotonic()
+            archivados = 0
+            dias = set()
+            while True:
+                rows = db.get_archivable_webhooks(self.retention_days, self.batch_size)
+                if not rows:
+                    break
+                if self.archive_dir:
+                    dias.update(write_archive(self.archive_dir, rows))
+                archivados += db.delete_archived_webhooks(rows)
+                if len(rows) < self.batch_size:
+                    break
+
+            rotados = rotate_archives(self.archive_dir, self.keep_days) if self.archive_dir else 0
+            contadores = db.prune_webhook_stats()
+            vacuum = db.incremental_vacuum(self.vacuum_pages)
+
+            result = {
+                'archived': archivados,
+                'days': sorted(dias),
+                'rotated_files': rotados,
+                'pruned_stats': contadores,
+                'vacuum': vacuum,
+                'duration_seconds': round(time.monotonic() - started, 3),
+                'finished_at': datetime.utcnow().isoformat() + 'Z'
+            }
+            self._stats['runs'] += 1
+            self._stats['archived'] += archivados
+            self._last_run = result
+            print(f"[RETENTION] {archivados} webhooks archivados, {rotados} ficheros rotados, "
+                  f"páginas libres {vacuum['freelist_before']} -> {vacuum['freelist_after']}")
+            if not vacuum['enabled']:
+                print("[RETENTION] Vacuum incremental desactivado en esta BD; para activarlo (VACUUM completo, "
+                      "en mantenimiento): python webhook_archive.py enable-incremental-vacuum")
+            return result
+        except Exception as e:
+            self._stats['errors'] += 1
+            print(f"[RETENTION] Error en la retención de webhooks: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return None
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return dict(
+            self._stats,
+            retention_days=self.retention_days,
+            archive_dir=self.archive_dir or None,
+            keep_days=self.keep_days,
+            last_run=self._last_run
+        )
+
+
+if __name__ == '__main__':
+    # Uso: python webhook_archive.py run
+    #      python webhook_archive.py enable-incremental-vacuum   (BD existentes, una vez, con el servicio parado)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Retención de webhooks_log')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('run', help='Archiva los webhooks antiguos y hace el vacuum incremental')
+    subparsers.add_parser('enable-incremental-vacuum',
+                          help='Activa el vacuum incremental en una BD existente (VACUUM completo, bloqueo exclusivo)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        db.init_db()
+        print(json.dumps(WebhookRetention().run_once(), indent=2))
+    elif args.command == 'enable-incremental-vacuum':
+        db.init_db()
+        print(json.dumps(db.enable_incremental_vacuum(), indent=2))
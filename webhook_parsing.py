@@ -0,0 +1,184 @@
+"""
+Lectura del cuerpo de los webhooks
+Camino rápido: un único parseo estricto de los bytes recibidos (con orjson si está
+instalado). La reparación del JSON malformado que a veces envía Make.com (comas
+finales, valores vacíos, extracción de task_id) solo se ejecuta si ese parseo falla.
+"""
+
+import json
+import re
+
+try:
+    import orjson  # Opcional: pip install orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+class WebhookParseError(Exception):
+    """El cuerpo no es JSON válido ni se pudo reparar; details va en la respuesta 400"""
+
+    def __init__(self, message, details):
+        super().__init__(message)
+        self.message = message
+        self.details = details
+
+
+def loads(raw):
+    """Parseo estricto de bytes o texto JSON con el backend disponible"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def parse_webhook_body(raw):
+    """
+    Parsea el cuerpo de un webhook.
+
+    Args:
+        raw: bytes recibidos
+
+    Returns:
+        tuple: (data, modo) donde modo es 'strict' si el cuerpo era JSON válido
+               (y puede guardarse tal cual), 'repaired' si hubo que limpiarlo o
+               'extracted' si solo se pudieron extraer los campos básicos
+
+    Raises:
+        WebhookParseError: si no se pudo obtener nada útil
+    """
+    try:
+        return loads(raw), 'strict'
+    except ValueError:
+        pass
+
+    text = raw.decode('utf-8', errors='replace') if isinstance(raw, bytes) else raw
+    try:
+        # json acepta algunos valores que orjson rechaza (ej: NaN)
+        return json.loads(text), 'repaired'
+    except json.JSONDecodeError as e:
+        return repair_webhook_json(text, e)
+
+
+def repair_webhook_json(raw_data, error):
+    """Intenta recuperar un JSON malformado: limpieza de problemas comunes y, si no, extracción de task_id"""
+    print(f"[ERROR] Error al parsear JSON: {str(error)}")
+    print(f"[DEBUG] Body raw recibido ({len(raw_data)} caracteres):")
+    print(f"[DEBUG] {raw_data[:1000]}")  # Primeros 1000 caracteres para ver el problema
+
+    # Intentar mostrar la línea con el error
+    try:
+        lines = raw_data.split('\n')
+        error_line = error.lineno - 1 if error.lineno <= len(lines) else 0
+        if 0 <= error_line < len(lines):
+            print(f"[DEBUG] Línea {error.lineno}: {lines[error_line]}")
+            print(f"[DEBUG] Posición del error: {' ' * (error.colno - 1)}^")
+    except Exception:
+        pass
+
+    # Intentar limpiar problemas comunes de JSON
+    print("[INFO] Intentando limpiar JSON malformado...")
+    # 1. Trailing commas: {"key": value,}
+    # 2. Valores vacíos: "key": , -> "key": null
+    # 3. Arrays vacíos malformados de Make.com: "assignees": , -> "assignees": []
+    cleaned_data = re.sub(r',\s*}', '}', raw_data)
+    cleaned_data = re.sub(r',\s*]', ']', cleaned_data)
+    cleaned_data = re.sub(r':\s*,', ': null,', cleaned_data)
+    cleaned_data = re.sub(r':\s*\n', ': null\n', cleaned_data)
+    cleaned_data = re.sub(r'"assignees"\s*:\s*null', '"assignees": []', cleaned_data)
+    cleaned_data = re.sub(r'"tags"\s*:\s*null', '"tags": []', cleaned_data)
+    cleaned_data = re.sub(r'"custom_fields"\s*:\s*null', '"custom_fields": {}', cleaned_data)
+
+    try:
+        data = json.loads(cleaned_data)
+        print("[INFO] ✓ JSON limpiado exitosamente")
+        return data, 'repaired'
+    except json.JSONDecodeError as e2:
+        print(f"[ERROR] No se pudo limpiar el JSON: {str(e2)}")
+
+    # Si Make.com está enviando datos malformados, extraer al menos los campos esenciales
+    print("[WARNING] Intentando extraer campos básicos del JSON malformado...")
+    task_id_match = re.search(r'"task_id"\s*:\s*"([^"]+)"', raw_data)
+    event_match = re.search(r'"event"\s*:\s*"([^"]+)"', raw_data)
+
+    if not task_id_match:
+        raise WebhookParseError(
+            'El JSON está malformado y no se pudieron extraer campos básicos',
+            {
+                'details': str(error),
+                'line': error.lineno,
+                'column': error.colno,
+                'suggestion': 'Verifica la configuración del webhook en Make.com. Asegúrate de enviar JSON válido.'
+            }
+        )
+
+    # Objeto mínimo con los datos extraídos; el resto se obtiene desde la API de ClickUp
+    data = {
+        'task_id': task_id_match.group(1),
+        'event': event_match.group(1) if event_match else 'taskStatusUpdated',
+        '_extracted_from_malformed': True,
+        '_original_error': str(error)
+    }
+    print(f"[INFO] ✓ Extraído task_id: {data['task_id']}")
+    print("[INFO] Se obtendrán los detalles completos desde la API de ClickUp")
+    return data, 'extracted'
+
+
+def _payload_de_ejemplo(size_kb):
+    """Payload con la forma de un webhook de tarea enriquecido, de unos size_kb KB"""
+    data = {
+        'event': 'taskUpdated',
+        'task_id': 'abc123',
+        'task_name': 'Tarea de ejemplo',
+        'status': 'in progress',
+        'list_id': '901',
+        'date_updated': '1700000000000',
+        'assignees': [{'id': 1, 'username': 'usuario', 'email': 'usuario@example.com'}],
+        'tags': [],
+        'custom_fields': [],
+        'history_items': [{'id': '1', 'field': 'status', 'before': {'status': 'open'}, 'after': {'status': 'in progress'}}],
+    }
+    i = 0
+    while len(json.dumps(data)) < size_kb * 1024:
+        data['custom_fields'].append({'id': f'cf{i}', 'name': f'Campo {i}', 'type': 'text', 'value': 'x' * 40})
+        i += 1
+    return json.dumps(data, indent=2).encode('utf-8')
+
+
+if __name__ == '__main__':
+    # Uso: python webhook_parsing.py bench [--iterations N]
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Utilidades de lectura de webhooks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='Mide el coste de parsear un webhook por KB (camino anterior frente al rápido)'
+    )
+    bench_parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        print(f"[BENCH] Backend JSON: {JSON_BACKEND}")
+        for size_kb in (1, 4, 16, 64):
+            raw = _payload_de_ejemplo(size_kb)
+            kb = len(raw) / 1024
+
+            # Anterior: parseo, volcado indentado al log y serialización para webhooks_log
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                data = json.loads(raw)
+                json.dumps(data, indent=2)
+                json.dumps(data)
+            anterior = (time.perf_counter() - start) / args.iterations
+
+            # Rápido: un único parseo; el log y webhooks_log reutilizan los bytes recibidos
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                data, _modo = parse_webhook_body(raw)
+                raw.decode('utf-8')
+            rapido = (time.perf_counter() - start) / args.iterations
+
+            print(f"[BENCH] {kb:5.1f} KB: anterior {anterior / kb * 1e6:6.1f} µs/KB, "
+                  f"rápido {rapido / kb * 1e6:6.1f} µs/KB ({anterior / rapido:.1f}x)")